@@ -0,0 +1,268 @@
+"""
+Runtime asyncio do pipeline de ingestão (runtime.mode: asyncio no config.yaml).
+
+Recepção MQTT, decodificação e escrita nos sinks rodam no mesmo event loop:
+    - o socket do paho é registrado no loop (add_reader/add_writer) em vez de loop_forever
+    - a fila entre subscriber e processor é uma asyncio.Queue; quando passa de
+      runtime.queue_size a leitura do socket é pausada (backpressure no broker via TCP)
+    - cada escrita (Postgres, Firestore, Realtime DB) é agendada como tarefa e executada
+      em um pool de threads, com limite de concorrência por sink. Assim as esperas de
+      rede de beacons diferentes se sobrepõem em vez de serem feitas uma após a outra.
+
+O connect() do paho (DNS e TCP bloqueantes) roda no executor padrão, fora do loop.
+
+As escritas de um mesmo beacon continuam em ordem (um asyncio.Lock por beacon_serial,
+descartado quando o beacon não tem escritas pendentes).
+No Postgres a tarefa só entrega a linha ao BatchedPostgresWriter, que grava em lotes nas
+próprias threads (ver postgres_writer.py).
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic_ns
+
+import paho.mqtt.client as mqtt
+import yaml
+
+from ingest_queue import IngestRecord, received_at, shard_for_payload
+from message_processor import MessageProcessor
+from subscriber import BROKER_HOST, BROKER_PORT, PARTITION_COUNT, PARTITION_INDEX, MessageSubscriber
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('runtime') or {}
+RUNTIME_MODE = config.get('mode', 'threads')
+QUEUE_SIZE = int(config.get('queue_size', 10000))
+SINK_CONCURRENCY = int(config.get('sink_concurrency', 8))
+MAX_INFLIGHT_WRITES = int(config.get('max_inflight_writes', 256))
+RECONNECT_MAX_DELAY_S = 60
+
+
+class AsyncioMqttHelper:
+    """Conecta o socket de um cliente paho ao event loop (baseado no exemplo loop_asyncio do paho)"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: mqtt.Client) -> None:
+        self.loop = loop
+        self.client = client
+        self.sock = None
+        self.reading = False
+        self._misc_task = None
+        # O connect() roda no executor: os callbacks de socket chamados por ele vão para o loop
+        client.on_socket_open = functools.partial(self._on_loop, self.on_socket_open)
+        client.on_socket_close = functools.partial(self._on_loop, self.on_socket_close)
+        client.on_socket_register_write = functools.partial(self._on_loop, self.on_socket_register_write)
+        client.on_socket_unregister_write = functools.partial(self._on_loop, self.on_socket_unregister_write)
+
+    def _on_loop(self, callback, *args):
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.sock = sock
+        self.resume_reading()
+        self._misc_task = self.loop.create_task(self._misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.pause_reading()
+        self.sock = None
+        if self._misc_task:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    def pause_reading(self) -> None:
+        if self.sock is not None and self.reading:
+            self.loop.remove_reader(self.sock)
+            self.reading = False
+
+    def resume_reading(self) -> None:
+        if self.sock is not None and not self.reading:
+            self.loop.add_reader(self.sock, self.client.loop_read)
+            self.reading = True
+
+    async def _misc_loop(self):
+        # Keepalive, retransmissões de QoS 1 e detecção de desconexão
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class AsyncMessageSubscriber(MessageSubscriber):
+    """MessageSubscriber dirigido pelo event loop, com pausa de leitura quando a fila enche"""
+
+    def __init__(self, message_queue: asyncio.Queue, queue_size: int = QUEUE_SIZE) -> None:
+        super().__init__(message_queue)
+        self.queue_size = queue_size
+        self.resume_size = queue_size // 2
+        self.helper = None
+        self._disconnected = None
+        self.client.on_disconnect = self.on_disconnect
+
+    def on_message(self, client: mqtt.Client, userdata, message: mqtt.MQTTMessage):
+        # Executado dentro do loop (loop_read é o callback do add_reader), então put_nowait é seguro
+        if PARTITION_COUNT and shard_for_payload(message.payload, PARTITION_COUNT) != PARTITION_INDEX:
+            return  # Beacon de outra instância do cluster
+        self.message_queue.put_nowait(IngestRecord(monotonic_ns(), message.topic, message.payload))
+        if self.message_queue.qsize() >= self.queue_size and self.helper.reading:
+            self.logger.warning(f"Fila com {self.message_queue.qsize()} mensagens, pausando leitura do broker")
+            self.helper.pause_reading()
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        if self._disconnected is not None and not self._disconnected.done():
+            self._disconnected.set_result(rc)
+
+    def resume_if_drained(self) -> None:
+        """Chamado pelo consumidor após cada mensagem; retoma a leitura abaixo da metade do limite"""
+        if self.helper and not self.helper.reading and self.message_queue.qsize() <= self.resume_size:
+            self.logger.info("Fila drenada, retomando leitura do broker")
+            self.helper.resume_reading()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.helper = AsyncioMqttHelper(loop, self.client)
+        delay = 1
+        try:
+            while True:
+                self._disconnected = loop.create_future()
+                try:
+                    await loop.run_in_executor(
+                        None, functools.partial(self.client.connect, BROKER_HOST, BROKER_PORT, keepalive=60))
+                    self.logger.info("Client connected to broker")
+                    delay = 1
+                    rc = await self._disconnected
+                    self.logger.warning(f"Desconectado do broker (rc={rc})")
+                except Exception as e:
+                    self.logger.error(f"Failed to connect to broker: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY_S)
+        finally:
+            self.client.disconnect()
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """
+    MessageProcessor cujas escritas nos sinks são agendadas no event loop.
+
+    add_message/flush_beacon_data continuam síncronos; save_message_to_db apenas cria a
+    tarefa de escrita. O consumidor aguarda quando há mais de max_inflight escritas pendentes.
+    """
+
+    use_sink_dispatcher = False  # Limite por sink com semáforos no próprio loop
+
+    def __init__(self, message_queue: asyncio.Queue, connect: bool = True,
+                 sink_concurrency: int = SINK_CONCURRENCY, max_inflight: int = MAX_INFLIGHT_WRITES) -> None:
+        self.sink_concurrency = sink_concurrency
+        self.max_inflight = max_inflight
+        self.executor = ThreadPoolExecutor(max_workers=2 * sink_concurrency + 1, thread_name_prefix='sink')
+        self.loop = None
+        self._sink_limits = {}
+        self._beacon_locks = {}  # beacon_serial -> [asyncio.Lock, escritas pendentes do beacon]
+        self._pending = set()
+        super().__init__(message_queue, connect=connect)
+
+    def save_message_to_db(self, topic, message_dict):
+        message_dict = self._normalize_message_keys(message_dict)
+        if not self.db_writer:
+            self.logger.error("Sem conexão com o banco de dados!")
+            return
+        seq = self._spool_append(topic, message_dict)
+        # Os sinks rodam em paralelo: o lastTX anterior é lido antes do Realtime DB sobrescrevê-lo
+        self._capture_previous_last_tx(message_dict)
+        task = self.loop.create_task(self._write_sinks(topic, message_dict, seq))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _write_sinks(self, topic, message_dict, seq=None):
+        beacon_serial = message_dict.get('beacon_serial')
+        entry = self._beacon_locks.get(beacon_serial)
+        if entry is None:
+            entry = self._beacon_locks[beacon_serial] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                # O Postgres confirma o seq no spool quando o lote é gravado (BatchedPostgresWriter)
+                await asyncio.gather(
+                    self._call_sink('postgres', self.insert_message_to_postgres, topic, message_dict, seq),
+                    self._call_sink('firestore', functools.partial(self.save_message_to_firestore, seq=seq),
+                                    topic, message_dict, seq=seq),
+                    self._call_sink('realtime_db', self.update_realtime_database, topic, message_dict, seq=seq),
+                )
+        finally:
+            # Sem escritas pendentes o lock sai do dict (beacons de teste em +/Pub não acumulam)
+            entry[1] -= 1
+            if not entry[1]:
+                del self._beacon_locks[beacon_serial]
+
+    async def _call_sink(self, sink, func, *args, seq=None):
+        async with self._sink_limits[sink]:
+            try:
+                result = await self.loop.run_in_executor(self.executor, func, *args)
+            except Exception as e:
+                self.logger.error(f"Erro na escrita em {sink}: {e}")
+                result = False
+            self._spool_settle(sink, seq, result, args[1])
+
+    async def run_async(self, on_consumed=None):
+        """Consome a fila até a sentinela None e espera as escritas pendentes"""
+        self.loop = asyncio.get_running_loop()
+        self._sink_limits = {
+            'postgres': asyncio.Semaphore(1),
+            'firestore': asyncio.Semaphore(self.sink_concurrency),
+            'realtime_db': asyncio.Semaphore(self.sink_concurrency),
+        }
+        try:
+            while True:
+                record = await self.message_queue.get()
+                if record is None:  # Sentinela de parada
+                    break
+                try:
+                    self.process_message(record, received_at(record.recv_ns))
+                except Exception as e:
+                    self.logger.exception("Error in message processing loop: %s", str(e))
+                if on_consumed:
+                    on_consumed()
+                if len(self._pending) >= self.max_inflight:
+                    await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            await self.drain()
+
+    async def drain(self):
+        """Envia os pacotes normais acumulados e espera todas as escritas terminarem"""
+        self.flush_beacon_data()
+        while self._pending:
+            await asyncio.wait(self._pending)
+
+    def cleanup(self):
+        self.executor.shutdown(wait=True)
+        super().cleanup()
+
+
+async def run_pipeline():
+    message_queue = asyncio.Queue()
+    processor = AsyncMessageProcessor(message_queue)
+    subscriber = AsyncMessageSubscriber(message_queue)
+    subscriber_task = asyncio.create_task(subscriber.run())
+    try:
+        await processor.run_async(on_consumed=subscriber.resume_if_drained)
+    finally:
+        subscriber_task.cancel()
+        processor.cleanup()
+
+
+def main():
+    asyncio.run(run_pipeline())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,454 @@
+"""
+Benchmark ponta a ponta do caminho de ingestão (MessageProcessor) com sinks simulados.
+
+Gera pacotes sintéticos válidos a partir de `_load_schema` (mistura de alertas e
+pacotes normais, vários beacons e package_ids duplicados) e os envia por
+`MessageProcessor.run` -> `add_message` -> `flush_beacon_data` com substitutos em
+processo para o psycopg2 (ou o SqlitePool com --sqlite), o Firestore e o `db.reference`
+do Realtime Database (os dois últimos de sinks.py).
+
+Cada tamanho de frota roda em um processo separado para medir o pico de RSS.
+Os resultados são acrescentados em um arquivo JSONL e comparados com a última
+execução equivalente, para que regressões fiquem visíveis.
+
+Exemplos:
+    python benchmark.py
+    python benchmark.py --fleet-sizes 10,1000 --sink-latency-ms 5
+    python benchmark.py --fleet-sizes 1000 --sink-latency-ms 5 --runtime asyncio
+"""
+
+import argparse
+import asyncio
+import contextlib
+import copy
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from queue import Queue
+
+from async_pipeline import AsyncMessageProcessor
+from ingest_queue import IngestRecord
+from message_processor import MessageProcessor
+from postgres_writer import BatchedPostgresWriter
+from firestore_layout import LAYOUTS
+from mac_resolver import MacResolver
+from firestore_writer import BatchedFirestoreWriter
+from rtdb_shadow import RealtimeShadow
+from sinks import MemoryFirestore, MemoryRealtimeDatabase, SqlitePool
+from metrics import LatencyRecorder
+from rollup import ROLLUP_INSERT_SQL, build_rollup_row
+
+DEFAULT_FLEET_SIZES = [10, 100, 1000, 10000, 100000]
+DEFAULT_RESULTS_FILE = 'benchmark_results.jsonl'
+PAYLOAD_LENGTH = 488  # Tamanho dos pacotes reais (rssi termina no caractere 488)
+
+
+# ---------------------------------------------------------------------------
+# Pacotes sintéticos
+# ---------------------------------------------------------------------------
+
+def beacon_serial_for(index: int) -> str:
+    return f"90395E{index:06X}"
+
+
+def equipment_id_for(index: int) -> str:
+    return f"LN2-{index:05d}"
+
+
+def build_payload(schema: list, beacon_serial: str, package_id: int, epoch: int, temp_pt100: float,
+                  temp_ambient: float, vbat_mv: int, angle: int, rssi: int, general_status: int = 4,
+                  level_status: int = 4, angle_status: int = 2, battery_status: int = 4,
+                  foam_status: int = 8, batt_percent: int = 80) -> str:
+    """Monta um pacote hexadecimal escrevendo cada valor nos offsets do schema"""
+    fields = {field['name']: (field['start_idx'], field['end_idx']) for field in schema}
+    chars = ['0'] * PAYLOAD_LENGTH
+
+    def put(name, value: int):
+        start, end = fields[name]
+        width = end - start
+        chars[start:end] = f"{value & ((1 << (4 * width)) - 1):0{width}X}"
+
+    put('start_flag', 0x02)
+    put('package_type', 0x04)
+    put('beacon_serial', int(beacon_serial, 16))
+    put('epochtime_b', epoch)
+    put('epochtime_g', epoch + 2)
+    put('epochtime_btx', epoch + 1)
+    put('package_id', package_id)
+    put('tempa', int(round(temp_ambient * 100)))
+    put('sensor_data_def_id', 0x02)
+    for name, value in (('fw_version_prefix', 1), ('fw_version_major', 1), ('fw_version_minor', 2),
+                        ('fw_version_patch', 1), ('fw_version_build', 2)):
+        put(name, value)
+    put('ln2_level_status', level_status)
+    put('ln2_angle_status', angle_status)
+    put('ln2_battery_status', battery_status)
+    put('batt_percent', batt_percent)
+    put('ln2_foam_status', foam_status)
+    put('ln2_general_status', general_status)
+    put('ln2_acc_data_available', 1)
+    put('ln2_tx_cause_status', 17)
+    put('temp_pt100', int(round(temp_pt100 * 100)))
+    put('temp_ambient', int(round(temp_ambient * 100)))
+    put('angle_to_horizontal', angle)
+    put('vbat_mv', vbat_mv)
+    put('factory_serial', int(beacon_serial[-8:], 16))
+    put('rssi', rssi)
+    return ''.join(chars)
+
+
+def generate_messages(schema: list, fleet_size: int, count: int, alert_ratio: float,
+                      duplicate_ratio: float, seed: int = 0) -> list:
+    """Gera `count` mensagens (topic, payload) em rodízio pelos beacons da frota"""
+    rnd = random.Random(seed)
+    last_package_ids = [0] * fleet_size
+    gateways = max(1, fleet_size // 50)
+    epoch = int(time.time())
+    messages = []
+    for n in range(count):
+        beacon = n % fleet_size
+        if last_package_ids[beacon] and rnd.random() < duplicate_ratio:
+            package_id = last_package_ids[beacon]  # Retransmissão do mesmo pacote
+        else:
+            package_id = last_package_ids[beacon] = (last_package_ids[beacon] + 1) & 0xFFFF
+        alert = rnd.random() < alert_ratio
+        payload = build_payload(
+            schema,
+            beacon_serial=beacon_serial_for(beacon),
+            package_id=package_id,
+            epoch=epoch + n // fleet_size,
+            temp_pt100=rnd.uniform(-196, -150) if not alert else rnd.uniform(-150, 25),
+            temp_ambient=rnd.uniform(18, 30),
+            vbat_mv=rnd.randint(2800, 3100),
+            angle=rnd.randint(0, 90),
+            rssi=rnd.randint(-95, -50),
+            general_status=rnd.choice([5, 6]) if alert else 4,
+            level_status=rnd.choice([9, 10]) if alert else 4,
+        )
+        topic = f"WTAD4D4DA2{beacon % gateways:05X}/Pub"
+        messages.append((topic, payload.encode()))
+    return messages
+
+
+# ---------------------------------------------------------------------------
+# Substitutos em processo para os sinks
+# ---------------------------------------------------------------------------
+
+class FakeCursor:
+    def __init__(self, connection, latency: float = 0.0) -> None:
+        self.connection = connection
+        self.latency = latency
+        self.executed = 0
+
+    def execute(self, sql, params=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.executed += 1
+
+    def mogrify(self, sql, params=None):
+        # Usado por execute_values para montar o VALUES de cada linha (template em bytes)
+        return sql % tuple(repr(p).encode() for p in params)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    """Substituto de conexão psycopg2: conta execuções e commits"""
+
+    encoding = 'UTF8'
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.commits = 0
+        self._cursor = FakeCursor(self, latency)
+
+    def cursor(self, *args, **kwargs):
+        return self._cursor
+
+    def commit(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    """Substituto do PostgresConnectionPool com uma única FakeConnection"""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.conn = FakeConnection(latency)
+
+    def run_transaction(self, work, max_retries: int = 0, description: str = ''):
+        result = work(self.conn)
+        self.conn.commit()
+        return result
+
+    def close(self):
+        pass
+
+
+# ---------------------------------------------------------------------------
+# Execução
+# ---------------------------------------------------------------------------
+
+class BenchmarkProcessor(MessageProcessor):
+    """MessageProcessor instrumentado por estágio (os estágios são aninhados)"""
+
+    def __init__(self, latencies: LatencyRecorder, message_queue=None) -> None:
+        self.latencies = latencies
+        super().__init__(message_queue if message_queue is not None else Queue(), connect=False)
+
+    def process_message(self, message, message_timestamp):
+        with self.latencies.measure('process_message'):
+            return super().process_message(message, message_timestamp)
+
+    def _load_message(self, message, timestamp):
+        with self.latencies.measure('decode'):
+            return super()._load_message(message, timestamp)
+
+    def add_message(self, message_dict, hex_payload, topic=None, timestamp=None):
+        with self.latencies.measure('add_message'):
+            return super().add_message(message_dict, hex_payload, topic=topic, timestamp=timestamp)
+
+    def save_message_to_db(self, topic, message_dict):
+        with self.latencies.measure('sinks'):
+            return super().save_message_to_db(topic, message_dict)
+
+    def save_message_to_firestore(self, topic, message_dict, **kwargs):
+        with self.latencies.measure('firestore'):
+            return super().save_message_to_firestore(topic, message_dict, **kwargs)
+
+    def update_realtime_database(self, topic, message_dict, **kwargs):
+        with self.latencies.measure('realtime_db'):
+            return super().update_realtime_database(topic, message_dict, **kwargs)
+
+    def flush_beacon_data(self, now=None):
+        with self.latencies.measure('flush'):
+            return super().flush_beacon_data(now)
+
+
+class AsyncBenchmarkProcessor(BenchmarkProcessor, AsyncMessageProcessor):
+    """Mesma instrumentação, com as escritas agendadas no event loop ('sinks' mede só o agendamento)"""
+
+
+def run_fleet(fleet_size: int, options: dict) -> dict:
+    """Executa o benchmark de um tamanho de frota (chamado em um processo separado)"""
+    latency = options['sink_latency_ms'] / 1000
+    count = max(options['min_messages'], fleet_size * options['messages_per_beacon'])
+    latencies = LatencyRecorder()
+    devnull = open(os.devnull, 'w')
+
+    if options['runtime'] == 'asyncio':
+        processor = AsyncBenchmarkProcessor(latencies, asyncio.Queue())
+    else:
+        processor = BenchmarkProcessor(latencies)
+    # Logs continuam sendo formatados (fazem parte do custo), mas não vão para o terminal
+    for name in ('message_processor', 'notification_handler'):
+        for handler in logging.getLogger(name).handlers:
+            handler.setStream(devnull)
+
+    tree = {}
+    for index in range(fleet_size):
+        mac = processor._format_mac_address(beacon_serial_for(index))
+        tree[equipment_id_for(index)] = {'STATUS': {'mac': mac}, 'REALTIME': {}}
+    if options['sqlite']:
+        pool = processor.db_pool = SqlitePool(os.path.join(tempfile.mkdtemp(prefix='ln2_bench_'), 'bench.sqlite3'),
+                                              storage=options['storage'])
+    else:
+        pool = processor.db_pool = FakePool(latency)
+    processor.db_writer = BatchedPostgresWriter(processor.db_pool, batch_size=options['batch_size'],
+                                                storage=options['storage'])
+    if processor.rollup is not None:
+        processor.rollup_writer = BatchedPostgresWriter(processor.db_pool, insert_sql=ROLLUP_INSERT_SQL,
+                                                        row_builder=build_rollup_row)
+    processor.firestore_db = MemoryFirestore(latency, store=False)
+    processor.firestore_layout = options['firestore_layout']
+    if options['firestore_batched']:
+        processor.firestore_writer = BatchedFirestoreWriter(processor.firestore_db)
+    processor.realtime_db = MemoryRealtimeDatabase(tree, latency=latency)
+    processor.notification_handler.realtime_db = processor.realtime_db
+    if options['rtdb_shadow']:
+        processor.rtdb_shadow = RealtimeShadow(processor.realtime_db)
+        processor.rtdb_shadow.load(copy.deepcopy(tree))  # Como a leitura inicial da árvore
+    else:
+        processor.rtdb_shadow = None
+    processor.notification_handler.rtdb_shadow = processor.rtdb_shadow
+    processor.mac_resolver = MacResolver(processor.realtime_db)
+    if not options['sink_dispatcher'] and processor.sink_dispatcher:
+        processor.sink_dispatcher.close()
+        processor.sink_dispatcher = None
+    processor.mac_cache_file = os.path.join(tempfile.mkdtemp(prefix='ln2_bench_'), 'mac_equipment_cache.json')
+    processor.last_cache_update = datetime.now(timezone.utc)
+    if not options['cold_mac_cache']:
+        processor.mac_cache = {equipment['STATUS']['mac']: equipment_id for equipment_id, equipment in tree.items()}
+
+    messages = generate_messages(processor.schema, fleet_size, count, options['alert_ratio'],
+                                 options['duplicate_ratio'], seed=options['seed'])
+    for topic, payload in messages:
+        processor.message_queue.put_nowait(IngestRecord(time.monotonic_ns(), topic, payload))
+    processor.message_queue.put_nowait(None)
+
+    with contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if options['runtime'] == 'asyncio':
+            asyncio.run(processor.run_async())  # Inclui o flush final e a espera das escritas
+        else:
+            processor.run()
+            processor.flush_beacon_data()
+            if processor.sink_dispatcher:
+                processor.sink_dispatcher.drain()
+        processor.db_writer.flush()  # Último lote do Postgres entra na medição
+        if processor.rollup_writer:
+            processor.rollup_writer.flush()
+        if processor.firestore_writer:
+            processor.firestore_writer.flush()
+        elapsed = time.perf_counter() - start
+    processor.cleanup()
+
+    return {
+        'fleet_size': fleet_size,
+        'messages': count,
+        'elapsed_s': round(elapsed, 4),
+        'messages_per_s': round(count / elapsed, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'postgres_commits': pool.commits if options['sqlite'] else pool.conn.commits,
+        'firestore_writes': processor.firestore_db.writes,
+        'firestore_commits': processor.firestore_db.commits,
+        'realtime_db_calls': dict(processor.realtime_db.counters),
+        'stages': {stage: {k: round(v, 4) for k, v in stats.items()}
+                   for stage, stats in latencies.summary().items()},
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def _previous_results(path: str, options: dict) -> dict:
+    """Último resultado salvo por tamanho de frota com as mesmas opções"""
+    previous = {}
+    if not os.path.exists(path):
+        return previous
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('options') == options:
+                previous[record['result']['fleet_size']] = record
+    return previous
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline de ingestão com sinks simulados")
+    parser.add_argument('--fleet-sizes', default=','.join(str(n) for n in DEFAULT_FLEET_SIZES),
+                        help="Tamanhos de frota separados por vírgula")
+    parser.add_argument('--messages-per-beacon', type=int, default=2)
+    parser.add_argument('--min-messages', type=int, default=2000)
+    parser.add_argument('--alert-ratio', type=float, default=0.1, help="Fração de pacotes em alerta")
+    parser.add_argument('--duplicate-ratio', type=float, default=0.05, help="Fração de package_ids repetidos")
+    parser.add_argument('--sink-latency-ms', type=float, default=0.0,
+                        help="Latência simulada por chamada de sink (round-trip de rede)")
+    parser.add_argument('--cold-mac-cache', action='store_true',
+                        help="Começa com o cache MAC vazio (cada beacon novo consulta o Realtime DB)")
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads',
+                        help="Loop síncrono do MessageProcessor ou pipeline asyncio (async_pipeline.py)")
+    parser.add_argument('--batch-size', type=int, default=500, help="Linhas por lote no Postgres (1 = commit por linha)")
+    parser.add_argument('--storage', choices=['text', 'compact'], default='text',
+                        help="Formato das linhas do Postgres (ver postgres_writer.py)")
+    parser.add_argument('--firestore-unbatched', action='store_true',
+                        help="Um set() por documento no Firestore em vez do BatchedFirestoreWriter")
+    parser.add_argument('--firestore-layout', choices=LAYOUTS, default='per_message',
+                        help="Layout do histórico no Firestore (ver firestore_layout.py)")
+    parser.add_argument('--sqlite', action='store_true',
+                        help="Grava as linhas em um SQLite temporário (sinks.SqlitePool) em vez de só contar")
+    parser.add_argument('--sequential-sinks', action='store_true',
+                        help="Sinks chamados em sequência na thread do processor, sem o SinkDispatcher")
+    parser.add_argument('--no-rtdb-shadow', action='store_true',
+                        help="Lê REALTIME/STATUS a cada mensagem em vez de usar a sombra local (rtdb_shadow.py)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=DEFAULT_RESULTS_FILE, help="Arquivo JSONL de resultados")
+    parser.add_argument('--label', default=None, help="Rótulo livre salvo junto com o resultado")
+    args = parser.parse_args(argv)
+
+    options = {
+        'messages_per_beacon': args.messages_per_beacon,
+        'min_messages': args.min_messages,
+        'alert_ratio': args.alert_ratio,
+        'duplicate_ratio': args.duplicate_ratio,
+        'sink_latency_ms': args.sink_latency_ms,
+        'cold_mac_cache': args.cold_mac_cache,
+        'runtime': args.runtime,
+        'batch_size': args.batch_size,
+        'storage': args.storage,
+        'rtdb_shadow': not args.no_rtdb_shadow,
+        'firestore_batched': not args.firestore_unbatched,
+        'firestore_layout': args.firestore_layout,
+        'sink_dispatcher': not args.sequential_sinks,
+        'sqlite': args.sqlite,
+        'seed': args.seed,
+    }
+    previous = _previous_results(args.results, options)
+    revision = _git_revision()
+
+    print(f"{'frota':>8}{'msgs':>9}{'msgs/s':>11}{'Δ%':>8}{'p50 ms':>9}{'p99 ms':>9}{'flush ms':>10}{'RSS MB':>9}")
+    for fleet_size in [int(n) for n in args.fleet_sizes.split(',') if n.strip()]:
+        # Processo novo por frota: o pico de RSS de uma execução não contamina a próxima
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            result = executor.submit(run_fleet, fleet_size, options).result()
+
+        stages = result['stages']
+        total = stages.get('process_message', {})
+        delta = ''
+        if fleet_size in previous:
+            before = previous[fleet_size]['result']['messages_per_s']
+            delta = f"{(result['messages_per_s'] - before) / before * 100:+.1f}"
+        print(f"{fleet_size:>8}{result['messages']:>9}{result['messages_per_s']:>11.1f}{delta:>8}"
+              f"{total.get('p50_ms', 0):>9.3f}{total.get('p99_ms', 0):>9.3f}"
+              f"{stages.get('flush', {}).get('max_ms', 0):>10.1f}{result['peak_rss_mb']:>9.1f}")
+        for stage, stats in stages.items():
+            print(f"{'':>8}  {stage:<16} p50 {stats['p50_ms']:.3f} ms  p99 {stats['p99_ms']:.3f} ms  n={stats['count']}")
+
+        record = {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': revision,
+            'label': args.label,
+            'python': sys.version.split()[0],
+            'options': options,
+            'result': result,
+        }
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    print(f"Resultados salvos em {args.results}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""
+Layout do histórico no Firestore: um documento por mensagem ou documentos por hora/dia.
+
+firestore.layout:
+    per_message  <equipamento>/data/<AAAA-MM-DD>/<HH-MM-SS> com os campos da mensagem
+                 (layout original; duas mensagens no mesmo segundo se sobrescrevem)
+    hourly       <equipamento>/history/hourly/<AAAA-MM-DDTHH>
+    daily        <equipamento>/history/daily/<AAAA-MM-DD>
+
+Nos buckets cada mensagem é uma entrada do mapa `samples`, com chave
+"<ms desde o início do bucket>_<package_id>" e valor em array compacto na ordem de
+SAMPLE_FIELDS (o documento guarda essa lista em `fields`). As entradas são acrescentadas
+com set(merge=True), então não há leitura antes da escrita, e pacotes no mesmo segundo não
+colidem. Agregados da janela (rollup.py) vão no mapa `rollups` com a mesma chave; um beacon
+sem pacote normal na janela (só alertas) tem só a entrada em `rollups` (`rollup_write`). Um
+bucket diário com um pacote a cada 5 minutos tem ~300 entradas; com taxas bem maiores
+use hourly (limite de 1 MiB por documento).
+
+`read_history` lê qualquer layout e devolve as amostras como dicts. Ferramentas:
+    python firestore_layout.py export LN2-00100 --from 2025-06-01 --to 2025-06-30 --output hist.jsonl
+    python firestore_layout.py migrate LN2-00100 --from 2025-06-01 --to 2025-06-30 --layout daily [--dry-run]
+O migrate copia o layout per_message para buckets; os documentos antigos não são apagados.
+"""
+
+import argparse
+import json
+import sys
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+
+import yaml
+
+from logger_config import setup_logger
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('firestore') or {}
+FIRESTORE_LAYOUT = config.get('layout', 'per_message')
+
+LAYOUTS = ('per_message', 'hourly', 'daily')
+BUCKET_LAYOUTS = ('hourly', 'daily')
+
+# Ordem dos valores no array de cada amostra
+SAMPLE_FIELDS = ('tempPT100', 'tempAmbient', 'vBat', 'pBat', 'humidity', 'package_id')
+
+logger = setup_logger(__name__)
+
+
+def bucket_start(timestamp: datetime, layout: str) -> datetime:
+    timestamp = timestamp.astimezone(timezone.utc)
+    if layout == 'hourly':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def bucket_id(start: datetime, layout: str) -> str:
+    return start.strftime('%Y-%m-%dT%H') if layout == 'hourly' else start.strftime('%Y-%m-%d')
+
+
+def bucket_ref(client, equipment_id: str, start: datetime, layout: str):
+    return client.collection(equipment_id).document('history').collection(layout).document(bucket_id(start, layout))
+
+
+def sample_key(timestamp: datetime, start: datetime, package_id) -> str:
+    offset_ms = int((timestamp - start).total_seconds() * 1000)
+    return f"{offset_ms:09d}_{package_id if package_id is not None else ''}"
+
+
+def document_write(client, equipment_id: str, firestore_data: dict, timestamp: datetime,
+                   layout: str = FIRESTORE_LAYOUT):
+    """
+    Documento e dados da escrita de uma mensagem no layout: (ref, dados, merge).
+    firestore_data é o dict montado em save_message_to_firestore (com 'rollup', se houver).
+    """
+    if layout == 'per_message':
+        ref = (client.collection(equipment_id).document('data')
+               .collection(timestamp.strftime('%Y-%m-%d')).document(timestamp.strftime('%H-%M-%S')))
+        return ref, firestore_data, False
+
+    start = bucket_start(timestamp, layout)
+    key = sample_key(timestamp, start, firestore_data.get('package_id'))
+    data = {
+        'bucketStart': start,
+        'fields': list(SAMPLE_FIELDS),
+        'samples': {key: [firestore_data.get(field) for field in SAMPLE_FIELDS]},
+        'lastUpdate': timestamp,
+    }
+    if firestore_data.get('mac_equipament'):
+        data['mac_equipament'] = firestore_data['mac_equipament']
+    if firestore_data.get('rollup'):
+        data['rollups'] = {key: firestore_data['rollup']}
+    return bucket_ref(client, equipment_id, start, layout), data, True
+
+
+def rollup_write(client, equipment_id: str, rollup: dict, timestamp: datetime,
+                 layout: str = FIRESTORE_LAYOUT, mac_equipament: str = None):
+    """
+    Documento e dados só com os agregados da janela, para beacons sem pacote normal nela: (ref, dados, merge).
+    rollup é o mapa de firestore_rollup(); timestamp é o fim da janela.
+    """
+    if layout == 'per_message':
+        ref = (client.collection(equipment_id).document('data')
+               .collection(timestamp.strftime('%Y-%m-%d')).document(timestamp.strftime('%H-%M-%S')))
+        data = {'timestamp': timestamp, 'rollup': rollup}
+    else:
+        start = bucket_start(timestamp, layout)
+        ref = bucket_ref(client, equipment_id, start, layout)
+        data = {'bucketStart': start, 'rollups': {sample_key(timestamp, start, None): rollup}, 'lastUpdate': timestamp}
+    if mac_equipament:
+        data['mac_equipament'] = mac_equipament
+    return ref, data, True
+
+
+def _samples_from_bucket(doc: dict) -> list:
+    start = doc.get('bucketStart')
+    fields = doc.get('fields') or list(SAMPLE_FIELDS)
+    rollups = doc.get('rollups') or {}
+    samples = []
+    for key, values in (doc.get('samples') or {}).items():
+        offset_ms = int(key.split('_', 1)[0])
+        sample = dict(zip(fields, values))
+        sample['timestamp'] = start + timedelta(milliseconds=offset_ms)
+        if key in rollups:
+            sample['rollup'] = rollups[key]
+        samples.append(sample)
+    for key in set(rollups) - set(doc.get('samples') or {}):
+        # Janela sem pacote normal: só os agregados
+        offset_ms = int(key.split('_', 1)[0])
+        samples.append({'timestamp': start + timedelta(milliseconds=offset_ms), 'rollup': rollups[key]})
+    return samples
+
+
+def _days(start: datetime, end: datetime):
+    day = start.astimezone(timezone.utc).date()
+    while day <= end.astimezone(timezone.utc).date():
+        yield day
+        day += timedelta(days=1)
+
+
+def read_history(client, equipment_id: str, start: datetime, end: datetime, layout: str = FIRESTORE_LAYOUT) -> list:
+    """Amostras de um equipamento em [start, end], em ordem de timestamp, em qualquer layout"""
+    samples = []
+    if layout == 'per_message':
+        for day in _days(start, end):
+            collection = client.collection(equipment_id).document('data').collection(day.strftime('%Y-%m-%d'))
+            for snapshot in collection.stream():
+                doc = snapshot.to_dict() or {}
+                if 'timestamp' not in doc:
+                    time_of_day = datetime.strptime(snapshot.id, '%H-%M-%S').time()
+                    doc['timestamp'] = datetime.combine(day, time_of_day, tzinfo=timezone.utc)
+                samples.append(doc)
+    else:
+        collection = client.collection(equipment_id).document('history').collection(layout)
+        current = bucket_start(start, layout)
+        step = timedelta(hours=1) if layout == 'hourly' else timedelta(days=1)
+        refs = []
+        while current <= end:
+            refs.append(collection.document(bucket_id(current, layout)))
+            current += step
+        # get_all lê os buckets em uma única chamada
+        for snapshot in client.get_all(refs):
+            if snapshot.exists:
+                samples.extend(_samples_from_bucket(snapshot.to_dict()))
+    samples = [s for s in samples if start <= s['timestamp'] <= end]
+    samples.sort(key=lambda s: s['timestamp'])
+    return samples
+
+
+def migrate(client, equipment_id: str, start: datetime, end: datetime, layout: str,
+            dry_run: bool = False, batch_size: int = 500) -> dict:
+    """Copia o histórico per_message de um equipamento para buckets (sem apagar a origem)"""
+    if layout not in BUCKET_LAYOUTS:
+        raise ValueError(f"layout de destino inválido: {layout} (use {', '.join(BUCKET_LAYOUTS)})")
+    buckets = {}  # caminho -> (ref, dados)
+    samples = read_history(client, equipment_id, start, end, layout='per_message')
+    for sample in samples:
+        ref, data, _ = document_write(client, equipment_id, sample, sample['timestamp'], layout)
+        if ref.path in buckets:
+            existing = buckets[ref.path][1]
+            existing['samples'].update(data['samples'])
+            if 'rollups' in data:
+                existing.setdefault('rollups', {}).update(data['rollups'])
+            existing['lastUpdate'] = max(existing['lastUpdate'], data['lastUpdate'])
+        else:
+            buckets[ref.path] = (ref, data)
+    if not dry_run:
+        entries = list(buckets.values())
+        for i in range(0, len(entries), batch_size):
+            write_batch = client.batch()
+            for ref, data in entries[i:i + batch_size]:
+                write_batch.set(ref, data, merge=True)
+            write_batch.commit()
+    logger.info(f"{equipment_id}: {len(samples)} amostras em {len(buckets)} documentos {layout}"
+                f"{' (dry-run, nada gravado)' if dry_run else ''}")
+    return {'samples': len(samples), 'documents': len(buckets)}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _parse_day(value: str, end: bool = False) -> datetime:
+    day = date.fromisoformat(value)
+    return datetime.combine(day, dt_time.max if end else dt_time.min, tzinfo=timezone.utc)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Histórico do Firestore: exportação e migração entre layouts")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('export', "Exporta o histórico de um equipamento em JSONL"),
+                            ('migrate', "Copia o histórico per_message para documentos por hora/dia")):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('equipment_id', nargs='+', help="Ex: LN2-00100")
+        sub.add_argument('--from', dest='start', required=True, help="Dia inicial (AAAA-MM-DD, UTC)")
+        sub.add_argument('--to', dest='end', required=True, help="Dia final, inclusive")
+    subparsers.choices['export'].add_argument('--layout', choices=LAYOUTS, default=FIRESTORE_LAYOUT,
+                                              help="Layout lido (padrão: firestore.layout)")
+    subparsers.choices['export'].add_argument('--output', default='-', help="Arquivo JSONL (padrão: stdout)")
+    subparsers.choices['migrate'].add_argument('--layout', choices=BUCKET_LAYOUTS, default='daily')
+    subparsers.choices['migrate'].add_argument('--dry-run', action='store_true', help="Só conta, não grava")
+    args = parser.parse_args(argv)
+
+    from message_processor import MessageProcessor  # Inicializa o Firebase com as credenciais do .env
+    from queue import Queue
+    processor = MessageProcessor(Queue(), connect=False)
+    processor._connect_firebase()
+    client = processor.firestore_db
+    start, end = _parse_day(args.start), _parse_day(args.end, end=True)
+
+    try:
+        if client is None:
+            print("Sem conexão com o Firestore", file=sys.stderr)
+            return 1
+        if args.command == 'migrate':
+            for equipment_id in args.equipment_id:
+                migrate(client, equipment_id, start, end, args.layout, dry_run=args.dry_run)
+        else:
+            output = sys.stdout if args.output == '-' else open(args.output, 'w')
+            try:
+                for equipment_id in args.equipment_id:
+                    for sample in read_history(client, equipment_id, start, end, layout=args.layout):
+                        output.write(json.dumps(dict(sample, equipment_id=equipment_id), default=_json_default) + '\n')
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+    finally:
+        processor.cleanup()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""
+Escrita em lote dos documentos de série temporal no Firestore.
+
+save_message_to_firestore entrega o documento (<equipment>/data/<data>/<HH-MM-SS>) ao
+BatchedFirestoreWriter em vez de fazer um set() por mensagem. Threads de escrita juntam
+até firestore.batch_size documentos (limite do Firestore: 500) em um WriteBatch e fazem
+um commit por lote, quando o lote enche ou quando o documento mais antigo espera
+firestore.flush_interval_ms. No envio de 5 minutos, em que todos os beacons escrevem ao
+mesmo tempo, isso troca milhares de round-trips em série por poucos commits em paralelo.
+
+Erros transitórios (indisponibilidade, timeout, cota) são repetidos com espera
+exponencial. Como o WriteBatch é atômico, um lote recusado por causa de um documento é
+regravado documento a documento, e só o inválido é perdido. `stats()` expõe vazão,
+latência do commit e espera na fila, também registradas no log a cada
+firestore.stats_log_interval_s.
+
+Escritas com merge=True no mesmo documento (layout em buckets, ver firestore_layout.py)
+que ainda esperam na fila são combinadas em uma só, então cada bucket recebe no máximo
+uma escrita por lote.
+"""
+
+import threading
+import time
+
+import yaml
+from google.api_core import exceptions as google_exceptions
+
+from logger_config import setup_logger
+from metrics import LatencyRecorder
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('firestore') or {}
+FIRESTORE_BATCHED = bool(config.get('batched', True))
+BATCH_SIZE = int(config.get('batch_size', 500))
+FLUSH_INTERVAL_MS = int(config.get('flush_interval_ms', 1000))
+MAX_PENDING_DOCS = int(config.get('max_pending_docs', 20000))
+WRITER_THREADS = int(config.get('writer_threads', 4))
+MAX_RETRIES = int(config.get('max_retries', 5))
+RETRY_BACKOFF_S = float(config.get('retry_backoff_s', 0.5))
+RETRY_BACKOFF_MAX_S = float(config.get('retry_backoff_max_s', 30))
+STATS_LOG_INTERVAL_S = float(config.get('stats_log_interval_s', 300))
+
+MAX_BATCH_SIZE = 500  # Limite de escritas por WriteBatch do Firestore
+
+# Erros em que vale repetir o lote inteiro (o problema não são os documentos)
+TRANSIENT_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.Aborted,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def merge_into(target: dict, source: dict) -> dict:
+    """Combina source em target como o set(merge=True) do Firestore (mapas aninhados são mesclados)"""
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_into(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class BatchedFirestoreWriter:
+    """
+    Acumula documentos e grava em WriteBatch em threads próprias (firestore.writer_threads).
+
+    `add` só bloqueia quando há mais de max_pending_docs documentos esperando. Com mais de
+    uma thread, lotes diferentes podem ser gravados fora de ordem; documentos de série
+    temporal têm caminhos distintos, então a ordem não altera o resultado.
+
+    `on_batch_done(seqs, written)` segue o contrato do BatchedPostgresWriter (chamado a cada
+    lote, com seqs vazio sem spool): written=True
+    se o documento foi gravado (ou descartado por erro de dados) e False se o Firestore
+    continuou indisponível depois das tentativas (ver spool.py).
+    """
+
+    def __init__(self, client, batch_size: int = BATCH_SIZE, flush_interval_ms: int = FLUSH_INTERVAL_MS,
+                 max_pending_docs: int = MAX_PENDING_DOCS, writer_threads: int = WRITER_THREADS,
+                 max_retries: int = MAX_RETRIES, on_batch_done=None) -> None:
+        self.client = client
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending_docs = max(self.batch_size, max_pending_docs)
+        self.max_retries = max_retries
+        self.on_batch_done = on_batch_done
+        self.logger = setup_logger(__name__)
+
+        self._docs = []  # [ref, dados, seqs do spool, monotonic do add, merge]
+        self._merge_pending = {}  # caminho -> entrada de _docs com merge=True ainda na fila
+        self._oldest_doc_at = None
+        self._in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self.docs_written = 0
+        self.docs_failed = 0
+        self.batches = 0
+        self.retries = 0
+        self._latencies = LatencyRecorder()  # commit e espera na fila, desde o último log de stats
+        self._stats_since = time.monotonic()
+        self._stats_docs = 0
+        self._stats_lock = threading.Lock()  # Um único log de stats por intervalo entre as threads
+
+        self._threads = [threading.Thread(target=self._run, name=f'firestore-writer-{i}', daemon=True)
+                         for i in range(max(1, writer_threads))]
+        for thread in self._threads:
+            thread.start()
+
+    def add(self, ref, data: dict, seq=None, merge: bool = False) -> None:
+        seqs = [seq] if seq is not None else []
+        with self._cond:
+            if merge:
+                pending = self._merge_pending.get(ref.path)
+                if pending is not None:
+                    merge_into(pending[1], data)
+                    pending[2].extend(seqs)
+                    return
+            while len(self._docs) >= self.max_pending_docs and not self._closed:
+                self._cond.wait()
+            doc = [ref, data, seqs, time.monotonic(), merge]
+            if merge:
+                self._merge_pending[ref.path] = doc
+            if not self._docs:
+                self._oldest_doc_at = doc[3]
+            self._docs.append(doc)
+            if len(self._docs) >= self.batch_size:
+                self._cond.notify_all()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._docs) + self._in_flight
+
+    def flush(self) -> None:
+        """Grava imediatamente todos os documentos pendentes e espera os lotes em andamento"""
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                break
+            self._write_and_release(batch)
+        with self._cond:
+            while self._in_flight:
+                self._cond.wait()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self.flush()
+        self._log_stats()
+
+    def stats(self) -> dict:
+        """Vazão e latências desde o último log de stats, mais os contadores totais"""
+        with self._cond:
+            elapsed = time.monotonic() - self._stats_since
+            return {
+                'docs_per_s': self._stats_docs / elapsed if elapsed > 0 else 0.0,
+                'pending': len(self._docs) + self._in_flight,
+                'docs_written': self.docs_written,
+                'docs_failed': self.docs_failed,
+                'batches': self.batches,
+                'retries': self.retries,
+                'latency': self._latencies.summary(),
+            }
+
+    def _take_batch(self) -> list:
+        with self._cond:
+            batch = self._docs[:self.batch_size]
+            del self._docs[:self.batch_size]
+            for ref, _, _, _, merge in batch:
+                if merge:
+                    self._merge_pending.pop(ref.path, None)
+            self._oldest_doc_at = self._docs[0][3] if self._docs else None
+            self._in_flight += len(batch)
+            self._cond.notify_all()  # Libera quem esperava em add
+            return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._docs) >= self.batch_size:
+                        break
+                    if self._docs:
+                        remaining = self._oldest_doc_at + self.flush_interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait(STATS_LOG_INTERVAL_S)
+                        self._maybe_log_stats()
+                if self._closed:
+                    return  # O restante é gravado por close()
+            batch = self._take_batch()
+            if batch:
+                self._write_and_release(batch)
+                self._maybe_log_stats()
+
+    def _write_and_release(self, batch: list) -> None:
+        try:
+            self._write(batch)
+        finally:
+            with self._cond:
+                self._in_flight -= len(batch)
+                self._cond.notify_all()
+
+    def _commit(self, batch: list) -> None:
+        """Um WriteBatch com todos os documentos, repetido em erros transitórios"""
+        delay = RETRY_BACKOFF_S
+        for attempt in range(self.max_retries + 1):
+            write_batch = self.client.batch()
+            for ref, data, _, _, merge in batch:
+                write_batch.set(ref, data, merge=merge)
+            try:
+                with self._latencies.measure('commit'):
+                    write_batch.commit()
+                return
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                with self._cond:
+                    self.retries += 1
+                self.logger.warning(f"Falha transitória no lote de {len(batch)} documentos do Firestore "
+                                    f"(tentativa {attempt + 1}/{self.max_retries}): {e}; nova tentativa em {delay:.1f} s")
+                time.sleep(delay)
+                delay = min(delay * 2, RETRY_BACKOFF_MAX_S)
+
+    def _write(self, batch: list) -> None:
+        """Commit do lote; se um documento for recusado, regrava o lote documento a documento"""
+        try:
+            self._commit(batch)
+            now = time.monotonic()
+            for _, _, _, added_at, _ in batch:
+                self._latencies.record('queue_wait', now - added_at)
+            with self._cond:
+                self.docs_written += len(batch)
+                self._stats_docs += len(batch)
+                self.batches += 1
+            self.logger.debug(f"Lote de {len(batch)} documentos gravado no Firestore")
+            self._batch_done(batch, True)
+        except TRANSIENT_ERRORS as e:
+            with self._cond:
+                self.docs_failed += len(batch)
+            if any(doc_seqs for _, _, doc_seqs, _, _ in batch):
+                self.logger.error(f"Firestore indisponível após várias tentativas, {len(batch)} documentos ficam no spool: {e}")
+            else:
+                self.logger.error(f"Firestore indisponível após várias tentativas, {len(batch)} documentos perdidos: {e}")
+            self._batch_done(batch, False)
+        except Exception as e:
+            if len(batch) == 1:
+                with self._cond:
+                    self.docs_failed += 1
+                self.logger.error(f"Erro ao salvar {batch[0][0].path} no Firestore: {e}")
+                self._batch_done(batch, True)
+                return
+            self.logger.error(f"Erro ao gravar lote de {len(batch)} documentos no Firestore, gravando um a um: {e}")
+            for doc in batch:
+                self._write([doc])
+
+    def _batch_done(self, batch: list, written: bool) -> None:
+        if self.on_batch_done:
+            self.on_batch_done([seq for _, _, doc_seqs, _, _ in batch for seq in doc_seqs], written)
+
+    def _maybe_log_stats(self) -> None:
+        if time.monotonic() - self._stats_since < STATS_LOG_INTERVAL_S or not self._stats_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._stats_since >= STATS_LOG_INTERVAL_S:
+                self._log_stats()
+        finally:
+            self._stats_lock.release()
+
+    def _log_stats(self) -> None:
+        stats = self.stats()
+        latency = stats['latency']
+        if stats['docs_per_s'] or stats['pending']:
+            commit = latency.get('commit', {})
+            wait = latency.get('queue_wait', {})
+            self.logger.info(f"Firestore: {stats['docs_per_s']:.1f} docs/s, commit p50 {commit.get('p50_ms', 0):.0f} ms "
+                             f"p99 {commit.get('p99_ms', 0):.0f} ms, espera p99 {wait.get('p99_ms', 0):.0f} ms, "
+                             f"pendentes {stats['pending']}, repetições {stats['retries']}")
+        with self._cond:
+            self._latencies = LatencyRecorder()
+            self._stats_since = time.monotonic()
+            self._stats_docs = 0
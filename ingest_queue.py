@@ -0,0 +1,280 @@
+"""
+Fila de ingestão limitada entre o MessageSubscriber e o MessageProcessor.
+
+Mesma interface da queue.Queue usada até aqui (put/get/qsize, sentinela None), com
+tamanho máximo (ingest_queue.max_size, <= 0 = sem limite) e uma política para quando
+a fila está cheia (ingest_queue.overload_policy):
+
+    block               o put espera; como on_message roda na thread de rede do paho,
+                        a leitura do socket para e o broker sente a backpressure
+    drop_oldest_normal  descarta o pacote normal mais antigo da fila para abrir espaço
+    coalesce_latest     substitui pelo novo o último pacote do mesmo beacon na fila, se for
+                        normal; caso contrário (ou sem pacote do beacon na fila), espera
+
+Pacotes de alerta (ln2_general_status != 04) nunca são descartados nem substituídos:
+se não houver pacote normal para descartar, o put espera como na política block.
+"""
+
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+from datetime import datetime, timezone
+from queue import Empty, Full
+
+import yaml
+
+from logger_config import setup_logger
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('ingest_queue') or {}
+MAX_SIZE = int(config.get('max_size', 10000))
+OVERLOAD_POLICY = config.get('overload_policy', 'block')
+STATS_LOG_INTERVAL_S = float(config.get('stats_log_interval_s', 60))
+
+OVERLOAD_POLICIES = ('block', 'drop_oldest_normal', 'coalesce_latest')
+
+# Item da fila: instante de recepção (time.monotonic_ns), tópico e payload bruto do MQTTMessage.
+# Tem .topic e .payload, então serve direto como mensagem para MessageProcessor.process_message
+IngestRecord = namedtuple('IngestRecord', ['recv_ns', 'topic', 'payload'])
+
+# Âncora fixa entre o relógio monotônico e o de parede (a conversão é feita no consumidor)
+_MONOTONIC_TO_WALL_NS = time.time_ns() - time.monotonic_ns()
+
+# Offsets em caracteres hex do pacote (ver MessageProcessor._load_schema)
+BEACON_SERIAL_SLICE = slice(4, 16)
+GENERAL_STATUS_SLICE = slice(100, 102)
+NORMAL_GENERAL_STATUS = b'04'
+
+
+def is_alert_payload(topic: str, payload: bytes) -> bool:
+    """Alerta = pacote de beacon com ln2_general_status diferente de 04 (pacotes curtos contam como alerta)"""
+    return 'Pub' in topic and payload[GENERAL_STATUS_SLICE] != NORMAL_GENERAL_STATUS
+
+
+def shard_for_payload(payload: bytes, shards: int, stride: int = 1) -> int:
+    """
+    Partição estável do beacon do pacote (crc32 é igual entre processos, ao contrário de hash()).
+
+    `stride` permite um segundo nível sem correlação com o primeiro: o cluster usa
+    crc % instâncias e os workers de cada instância usam (crc // instâncias) % workers.
+    """
+    return (zlib.crc32(payload[BEACON_SERIAL_SLICE]) // stride) % shards
+
+
+def received_at(recv_ns: int) -> datetime:
+    """Converte o recv_ns de um IngestRecord para datetime UTC (com fuso: é o relógio das janelas do processor)"""
+    return datetime.fromtimestamp((recv_ns + _MONOTONIC_TO_WALL_NS) / 1e9, tz=timezone.utc)
+
+
+class _Entry:
+    __slots__ = ('item', 'droppable', 'beacon', 'alive')
+
+    def __init__(self, item, droppable: bool, beacon) -> None:
+        self.item = item
+        self.droppable = droppable  # Pacote normal que a política pode descartar ou substituir
+        self.beacon = beacon
+        self.alive = True
+
+
+class BoundedIngestQueue:
+    """
+    Fila FIFO limitada com política de sobrecarga por beacon.
+
+    Itens descartados viram lápides (alive=False) e são pulados no get, então descartar
+    o normal mais antigo é O(1). `stats()` expõe profundidade, pico e contadores.
+    """
+
+    def __init__(self, max_size: int = MAX_SIZE, overload_policy: str = OVERLOAD_POLICY,
+                 stats_log_interval_s: float = STATS_LOG_INTERVAL_S) -> None:
+        if overload_policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"overload_policy inválida: {overload_policy} (use {', '.join(OVERLOAD_POLICIES)})")
+        self.max_size = max_size
+        self.overload_policy = overload_policy
+        self.stats_log_interval_s = stats_log_interval_s
+        self.logger = setup_logger(__name__)
+        # Na política block nada é descartado, então o put não precisa classificar o pacote
+        self._classify = overload_policy != 'block'
+
+        self._entries = deque()          # Todos os itens em ordem de chegada (incluindo lápides)
+        self._normals = deque()          # Só os normais, para achar o mais antigo
+        self._newest = {}                # beacon -> _Entry mais recente do beacon na fila
+        self._size = 0
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._waiting_getters = 0
+        self._waiting_putters = 0
+
+        self.high_water = 0
+        self.enqueued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked_puts = 0
+        self._last_stats_log = time.monotonic()
+
+    # -- interface queue.Queue ----------------------------------------------------------
+
+    def qsize(self) -> int:
+        with self._mutex:
+            return self._size
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        with self._mutex:
+            return self._is_full()
+
+    def put(self, item, block=True, timeout=None):
+        if item is None:
+            # Sentinela de parada: sempre aceita, independente do limite
+            with self._mutex:
+                self._append(_Entry(None, False, None))
+            return
+
+        if self._classify:
+            droppable = not is_alert_payload(item.topic, item.payload)
+            beacon = item.payload[BEACON_SERIAL_SLICE]
+        else:
+            droppable, beacon = False, None
+        with self._mutex:
+            if self._is_full():
+                outcome = self._apply_overload_policy(item, droppable, beacon)
+                self._maybe_log_stats()
+                if outcome in ('coalesced', 'dropped'):
+                    return
+                if outcome == 'wait':
+                    self._wait_not_full(block, timeout)
+            self._append(_Entry(item, droppable, beacon))
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._size == 0:
+                if not block:
+                    raise Empty
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                self._waiting_getters += 1
+                try:
+                    self._not_empty.wait(remaining)
+                finally:
+                    self._waiting_getters -= 1
+            entry = self._entries.popleft()
+            while not entry.alive:
+                entry = self._entries.popleft()
+            self._remove(entry)
+            if entry.droppable:
+                # O normal consumido é sempre o primeiro vivo de _normals
+                while self._normals and self._normals[0] is not entry and not self._normals[0].alive:
+                    self._normals.popleft()
+                if self._normals and self._normals[0] is entry:
+                    self._normals.popleft()
+            if self._waiting_putters:
+                self._not_full.notify()
+            return entry.item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    # -- métricas -------------------------------------------------------------------------
+
+    def stats(self) -> dict:
+        with self._mutex:
+            return {
+                'depth': self._size,
+                'max_size': self.max_size,
+                'high_water': self.high_water,
+                'overload_policy': self.overload_policy,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'blocked_puts': self.blocked_puts,
+            }
+
+    # -- internos (chamados com _mutex) ---------------------------------------------------
+
+    def _is_full(self) -> bool:
+        return 0 < self.max_size <= self._size
+
+    def _wait_not_full(self, block: bool, timeout) -> None:
+        if not block:
+            raise Full
+        self.blocked_puts += 1
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._is_full():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise Full
+            self._waiting_putters += 1
+            try:
+                self._not_full.wait(remaining)
+            finally:
+                self._waiting_putters -= 1
+
+    def _append(self, entry: _Entry) -> None:
+        self._entries.append(entry)
+        if entry.droppable:
+            self._normals.append(entry)
+        if entry.beacon is not None:
+            self._newest[entry.beacon] = entry
+        self._size += 1
+        self.enqueued += 1
+        if self._size > self.high_water:
+            self.high_water = self._size
+        if self._waiting_getters:
+            self._not_empty.notify()
+
+    def _remove(self, entry: _Entry) -> None:
+        entry.alive = False
+        self._size -= 1
+        if entry.beacon is not None and self._newest.get(entry.beacon) is entry:
+            del self._newest[entry.beacon]
+
+    def _apply_overload_policy(self, item, droppable: bool, beacon) -> str:
+        """
+        Fila cheia: retorna 'room' (espaço liberado), 'coalesced' (item absorvido por outro
+        já na fila), 'dropped' (item descartado) ou 'wait' (o put deve esperar)
+        """
+        if self.overload_policy == 'coalesce_latest' and droppable:
+            # Só substitui se o normal for o item mais recente do beacon, para não passar na frente de um alerta
+            queued = self._newest.get(beacon)
+            if queued is not None and queued.droppable:
+                queued.item = item
+                self.coalesced += 1
+                return 'coalesced'
+        elif self.overload_policy == 'drop_oldest_normal':
+            while self._normals:
+                oldest = self._normals.popleft()
+                if oldest.alive:
+                    self._remove(oldest)
+                    oldest.item = None
+                    self.dropped += 1
+                    self._compact()
+                    return 'room'
+            if droppable:
+                # Fila cheia só de alertas: o normal que chega é o mais antigo disponível
+                self.dropped += 1
+                return 'dropped'
+        return 'wait'
+
+    def _compact(self) -> None:
+        # Sem consumidor (banco fora do ar) as lápides se acumulariam em _entries indefinidamente
+        if len(self._entries) > 2 * self._size + 1024:
+            self._entries = deque(entry for entry in self._entries if entry.alive)
+
+    def _maybe_log_stats(self) -> None:
+        now = time.monotonic()
+        if now - self._last_stats_log < self.stats_log_interval_s:
+            return
+        self._last_stats_log = now
+        if self.dropped or self.coalesced or self.blocked_puts:
+            self.logger.warning(
+                f"Fila de ingestão: profundidade {self._size}/{self.max_size} (pico {self.high_water}), "
+                f"descartados {self.dropped}, coalescidos {self.coalesced}, puts bloqueados {self.blocked_puts}")
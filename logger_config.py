@@ -8,6 +8,10 @@ def setup_logger(name=__name__):
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
 
+    # Loggers são globais: com vários MessageProcessors no mesmo processo o handler seria duplicado
+    if logger.handlers:
+        return logger
+
     # Create handler and set level
     handler = logging.StreamHandler(stdout)
 
@@ -0,0 +1,354 @@
+"""
+Resolução MAC -> equipment_id no Realtime Database sem baixar a árvore inteira.
+
+Antes, um MAC fora do cache (e a atualização do cache a cada hora) fazia realtime_db.get()
+na raiz, trazendo NOTIFICATIONS, REDUNDANCY etc. de todos os equipamentos (dezenas de MB)
+para depois percorrer a árvore. Agora:
+
+1. MAC_INDEX/<MAC sem ':'> -> equipment_id, um nó pequeno mantido pelo próprio processor.
+   A entrada é conferida lendo só <equipamento>/STATUS/mac.
+2. Consulta indexada order_by_child('STATUS/mac').equal_to(mac), que exige a regra
+   ".indexOn": ["STATUS/mac"] na raiz. Sem a regra o Firebase recusa a consulta; ela é
+   desligada e o passo 3 é usado.
+3. Listagem rasa das chaves da raiz (get(shallow=True)) e leitura de STATUS/mac de cada
+   equipamento, em mac_resolver.scan_threads threads.
+
+MACs não encontrados ficam em cache negativo por mac_resolver.negative_ttl_s, então
+beacons de teste que publicam em +/Pub não repetem a busca a cada pacote. `scan()` é a
+atualização periódica do cache: passo 3 para todos os equipamentos, regravando MAC_INDEX
+quando ele diverge.
+
+MacCacheSync mantém o cache do processor atualizado em segundo plano, fora do caminho
+das mensagens: um listen() em MAC_INDEX (mudanças feitas por outras instâncias chegam em
+segundos), uma listagem rasa a cada mac_resolver.new_keys_interval_s para equipamentos
+novos e o scan() completo a cada mac_resolver.full_scan_interval_s. O listen() na raiz ou
+em cada STATUS/mac não serve: o SDK não escuta consultas, e a raiz traz a árvore inteira e
+cada escrita em REALTIME.
+
+MAC_INDEX só é gravado pelo processor. Um MAC novo chega ao cache na primeira mensagem
+dele (resolve) e tira do cache o MAC anterior do equipamento; já um MAC que passa para
+outro equipamento (STATUS/mac alterado por fora) continua apontando para o antigo até o
+scan completo, em até full_scan_interval_s. Para valer em segundos, quem troca o
+STATUS/mac também grava MAC_INDEX/<MAC sem ':'> = equipment_id (ou roda rebuild-index).
+
+    python mac_resolver.py rebuild-index   # recria MAC_INDEX a partir de STATUS/mac
+    python mac_resolver.py lookup 90:39:5E:0A:E8:A7
+"""
+
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from logger_config import setup_logger
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('mac_resolver') or {}
+INDEX_NODE = config.get('index_node', 'MAC_INDEX')
+USE_QUERY = bool(config.get('use_query', True))
+NEGATIVE_TTL_S = float(config.get('negative_ttl_s', 600))
+SCAN_THREADS = int(config.get('scan_threads', 8))
+LISTEN_ENABLED = bool(config.get('listen', True))
+NEW_KEYS_INTERVAL_S = float(config.get('new_keys_interval_s', 30))
+FULL_SCAN_INTERVAL_S = float(config.get('full_scan_interval_s', 3600))
+
+EQUIPMENT_PREFIX = 'LN2-'
+
+logger = setup_logger(__name__)
+
+
+def index_key(mac_address: str) -> str:
+    """Chave do MAC em MAC_INDEX (90:39:5E:0A:E8:A7 -> 90395E0AE8A7)"""
+    return mac_address.replace(':', '').upper()
+
+
+def mac_from_key(key: str) -> str:
+    """MAC de uma chave de MAC_INDEX (90395E0AE8A7 -> 90:39:5E:0A:E8:A7)"""
+    if len(key) == 12:
+        return ':'.join(key[i:i + 2] for i in range(0, 12, 2))
+    return key
+
+
+def apply_mapping(mac_cache: dict, mapping: dict, resolver=None) -> int:
+    """
+    Aplica {mac: equipment_id ou None} a um cache {mac: equipment_id}; retorna quantas entradas
+    mudaram. O equipamento tem um MAC só: um MAC novo dele tira o anterior do cache.
+    """
+    changed = 0
+    for mac_address, equipment_id in mapping.items():
+        if equipment_id is None:
+            if mac_cache.pop(mac_address, None) is not None:
+                changed += 1
+        elif mac_cache.get(mac_address) != equipment_id:
+            for old_mac in [m for m, e in list(mac_cache.items()) if e == equipment_id and m != mac_address]:
+                mac_cache.pop(old_mac, None)
+                logger.info(f"Mapeamento removido: {old_mac} (agora {mac_address} -> {equipment_id})")
+            mac_cache[mac_address] = equipment_id
+            if resolver is not None:
+                resolver.forget(mac_address)
+            logger.info(f"Mapeamento atualizado: {mac_address} -> {equipment_id}")
+            changed += 1
+    return changed
+
+
+class MacResolver:
+    """Busca de equipment_id por MAC no Realtime Database, com cache negativo"""
+
+    def __init__(self, realtime_db, index_node: str = INDEX_NODE, use_query: bool = USE_QUERY,
+                 negative_ttl_s: float = NEGATIVE_TTL_S, scan_threads: int = SCAN_THREADS) -> None:
+        self.realtime_db = realtime_db
+        self.index_node = index_node
+        self.use_query = use_query
+        self.negative_ttl_s = negative_ttl_s
+        self.scan_threads = max(1, scan_threads)
+        self.logger = setup_logger(__name__)
+        self._negative = {}  # mac -> monotonic de expiração
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.negative_hits = 0
+
+    def resolve(self, mac_address: str):
+        """equipment_id do MAC, ou None (não encontrado ou em cache negativo)"""
+        now = time.monotonic()
+        with self._lock:
+            expires = self._negative.get(mac_address)
+            if expires is not None:
+                if expires > now:
+                    self.negative_hits += 1
+                    return None
+                del self._negative[mac_address]
+
+        self.lookups += 1
+        equipment_id = self._from_index(mac_address)
+        if equipment_id is None:
+            equipment_id = self._from_query(mac_address) if self.use_query else None
+            if equipment_id is None and not self.use_query:
+                equipment_id = self.scan().get(mac_address)
+            if equipment_id is not None:
+                self.write_index({mac_address: equipment_id})
+
+        if equipment_id is None:
+            with self._lock:
+                self._negative[mac_address] = now + self.negative_ttl_s
+            self.logger.warning(f"Equipamento não encontrado para MAC {mac_address} "
+                                f"(nova busca em {self.negative_ttl_s:.0f} s)")
+        return equipment_id
+
+    def forget(self, mac_address: str = None) -> None:
+        """Remove um MAC (ou todos) do cache negativo"""
+        with self._lock:
+            if mac_address is None:
+                self._negative.clear()
+            else:
+                self._negative.pop(mac_address, None)
+
+    def scan(self) -> dict:
+        """{mac: equipment_id} de todos os equipamentos, lendo só STATUS/mac de cada um"""
+        mapping = self.read_macs(self.list_equipment())
+
+        index = self._index_get()
+        stale = {index_key(mac): equipment_id for mac, equipment_id in mapping.items()
+                 if index.get(index_key(mac)) != equipment_id}
+        current_keys = {index_key(mac) for mac in mapping}
+        removed = {key: None for key in index if key not in current_keys}
+        if stale or removed:
+            try:
+                self.realtime_db.child(self.index_node).update({**stale, **removed})
+                self.logger.info(f"{self.index_node} atualizado: {len(stale)} entradas gravadas, {len(removed)} removidas")
+            except Exception as e:
+                self.logger.error(f"Erro ao atualizar {self.index_node}: {e}")
+        # Um equipamento novo pode ser um MAC que estava em cache negativo
+        with self._lock:
+            for mac in mapping:
+                self._negative.pop(mac, None)
+        return mapping
+
+    def read_macs(self, equipment_ids) -> dict:
+        """{mac: equipment_id} lendo STATUS/mac só dos equipamentos informados"""
+        equipment_ids = list(equipment_ids)
+        if not equipment_ids:
+            return {}
+        with ThreadPoolExecutor(max_workers=self.scan_threads) as executor:
+            macs = executor.map(self._read_mac, equipment_ids)
+            return {mac: equipment_id for equipment_id, mac in zip(equipment_ids, macs) if mac}
+
+    def list_equipment(self) -> list:
+        keys = self.realtime_db.get(shallow=True) or {}
+        return [key for key in keys if key.startswith(EQUIPMENT_PREFIX)]
+
+    def _read_mac(self, equipment_id: str):
+        try:
+            mac = self.realtime_db.child(equipment_id).child('STATUS').child('mac').get()
+            return mac if isinstance(mac, str) else None
+        except Exception as e:
+            self.logger.error(f"Erro ao ler STATUS/mac de {equipment_id}: {e}")
+            return None
+
+    def _index_get(self) -> dict:
+        try:
+            index = self.realtime_db.child(self.index_node).get()
+            return index if isinstance(index, dict) else {}
+        except Exception as e:
+            self.logger.error(f"Erro ao ler {self.index_node}: {e}")
+            return {}
+
+    def write_index(self, mapping: dict) -> None:
+        """Grava entradas {mac: equipment_id} em MAC_INDEX"""
+        try:
+            self.realtime_db.child(self.index_node).update(
+                {index_key(mac): equipment_id for mac, equipment_id in mapping.items()})
+        except Exception as e:
+            self.logger.error(f"Erro ao gravar {self.index_node}: {e}")
+
+    def _from_index(self, mac_address: str):
+        try:
+            equipment_id = self.realtime_db.child(self.index_node).child(index_key(mac_address)).get()
+        except Exception as e:
+            self.logger.error(f"Erro ao ler {self.index_node} para {mac_address}: {e}")
+            return None
+        if not isinstance(equipment_id, str):
+            return None
+        # Confere a entrada: o MAC pode ter sido movido para outro equipamento
+        if self._read_mac(equipment_id) == mac_address:
+            return equipment_id
+        self.logger.info(f"Entrada de {self.index_node} desatualizada para {mac_address} ({equipment_id})")
+        return None
+
+    def _from_query(self, mac_address: str):
+        try:
+            result = self.realtime_db.order_by_child('STATUS/mac').equal_to(mac_address).get()
+        except Exception as e:
+            self.logger.warning(f"Consulta indexada por STATUS/mac indisponível ({e}); "
+                                f"usando listagem rasa. Adicione \".indexOn\": [\"STATUS/mac\"] às regras da raiz.")
+            self.use_query = False
+            return self.scan().get(mac_address)
+        for equipment_id in (result or {}):
+            if equipment_id.startswith(EQUIPMENT_PREFIX):
+                return equipment_id
+        return None
+
+
+class MacCacheSync:
+    """
+    Atualiza um cache {mac: equipment_id} em segundo plano (listen em MAC_INDEX e listagens
+    periódicas). `refresh` é o scan completo do dono do cache e `on_change` é chamado
+    depois de cada mudança (ex: salvar o arquivo do cache).
+    """
+
+    def __init__(self, resolver: MacResolver, mac_cache: dict, refresh=None, on_change=None,
+                 new_keys_interval_s: float = NEW_KEYS_INTERVAL_S,
+                 full_scan_interval_s: float = FULL_SCAN_INTERVAL_S) -> None:
+        self.resolver = resolver
+        self.mac_cache = mac_cache
+        self.refresh = refresh
+        self.on_change = on_change
+        self.new_keys_interval_s = new_keys_interval_s
+        self.full_scan_interval_s = full_scan_interval_s
+        self.logger = setup_logger(__name__)
+        self._registration = None
+        self._without_mac = set()  # Equipamentos sem STATUS/mac, relidos só no scan completo
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='mac-cache-sync', daemon=True)
+
+    def start(self) -> None:
+        try:
+            self._registration = self.resolver.realtime_db.child(self.resolver.index_node).listen(self._on_event)
+            self.logger.info(f"Escutando {self.resolver.index_node} para atualizar o cache de MAC")
+        except Exception as e:
+            self.logger.error(f"Erro ao escutar {self.resolver.index_node}: {e}; só as listagens periódicas")
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._registration is not None:
+            try:
+                self._registration.close()
+            except Exception as e:
+                self.logger.error(f"Erro ao fechar o listener de {self.resolver.index_node}: {e}")
+            self._registration = None
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def apply(self, mapping: dict) -> int:
+        """Aplica {mac: equipment_id ou None} ao cache; retorna quantas entradas mudaram"""
+        changed = apply_mapping(self.mac_cache, mapping, self.resolver)
+        if changed and self.on_change:
+            self.on_change()
+        return changed
+
+    def _on_event(self, event) -> None:
+        """Evento do listen(): put/patch na raiz de MAC_INDEX ou em uma chave"""
+        try:
+            key = event.path.strip('/')
+            if event.event_type == 'put' and not key:
+                # Primeiro evento (ou nó substituído): o índice inteiro
+                # (só acrescenta: o cache pode ter MACs que ainda não estão no índice)
+                index = event.data if isinstance(event.data, dict) else {}
+                mapping = {mac_from_key(k): v for k, v in index.items() if isinstance(v, str)}
+            elif event.event_type == 'put':
+                mapping = {mac_from_key(key): event.data if isinstance(event.data, str) else None}
+            elif event.event_type == 'patch':
+                mapping = {mac_from_key(k): v if isinstance(v, str) else None for k, v in (event.data or {}).items()}
+            else:
+                return
+            self.apply(mapping)
+        except Exception as e:
+            self.logger.error(f"Erro ao processar evento de {self.resolver.index_node}: {e}")
+
+    def _run(self) -> None:
+        last_full_scan = time.monotonic()
+        while not self._stop.wait(self.new_keys_interval_s):
+            try:
+                if self.refresh and time.monotonic() - last_full_scan >= self.full_scan_interval_s:
+                    last_full_scan = time.monotonic()
+                    self._without_mac.clear()
+                    self.refresh()
+                    continue
+                known = set(self.mac_cache.values()) | self._without_mac
+                new_ids = [eid for eid in self.resolver.list_equipment() if eid not in known]
+                if new_ids:
+                    mapping = self.resolver.read_macs(new_ids)
+                    self._without_mac.update(set(new_ids) - set(mapping.values()))
+                    if mapping and self.apply(mapping):
+                        self.resolver.write_index(mapping)
+            except Exception as e:
+                self.logger.error(f"Erro ao atualizar o cache de MAC em segundo plano: {e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Índice MAC -> equipment_id no Realtime Database")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('rebuild-index', help=f"Recria {INDEX_NODE} a partir de STATUS/mac de cada equipamento")
+    lookup = subparsers.add_parser('lookup', help="Resolve um MAC (ex: 90:39:5E:0A:E8:A7)")
+    lookup.add_argument('mac')
+    args = parser.parse_args(argv)
+
+    from message_processor import MessageProcessor  # Inicializa o Firebase com as credenciais do .env
+    from queue import Queue
+    processor = MessageProcessor(Queue(), connect=False)
+    processor._connect_firebase()
+    try:
+        if processor.realtime_db is None:
+            print("Sem conexão com o Realtime Database", file=sys.stderr)
+            return 1
+        resolver = MacResolver(processor.realtime_db)
+        if args.command == 'rebuild-index':
+            mapping = resolver.scan()
+            print(f"{len(mapping)} equipamentos em {resolver.index_node}")
+        else:
+            equipment_id = resolver.resolve(args.mac.upper())
+            print(equipment_id or "não encontrado")
+            if equipment_id is None:
+                return 1
+    finally:
+        processor.cleanup()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
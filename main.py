@@ -1,10 +1,34 @@
 from subscriber import MessageSubscriber
 from message_processor import MessageProcessor
-from queue import Queue
+from workers import ShardedProcessorPool, WORKERS
+import async_pipeline
+from ingest_queue import BoundedIngestQueue
 from concurrent.futures import ThreadPoolExecutor
+from schema_manager import start_schema_maintenance
+from state_api import start_state_api
 
 def main():
-    message_queue = Queue()
+    # Partições de mqtt_messages criadas/retiradas em segundo plano (ver schema_manager.py)
+    start_schema_maintenance()
+    # API local com o último estado de cada beacon (ver state_api.py)
+    start_state_api()
+
+    if async_pipeline.RUNTIME_MODE == 'asyncio':
+        async_pipeline.main()
+        return
+
+    if WORKERS > 1:
+        # Pacotes distribuídos por beacon entre N processors (ver workers.py)
+        pool = ShardedProcessorPool()
+        pool.start()
+        subscriber = MessageSubscriber(pool.router)
+        try:
+            subscriber.run()
+        finally:
+            pool.stop()
+        return
+
+    message_queue = BoundedIngestQueue()
     processor = MessageProcessor(message_queue)
     subscriber = MessageSubscriber(message_queue)
     
@@ -14,4 +38,4 @@ def main():
 
 if __name__ == '__main__':
     
-    main()
\ No newline at end of file
+    main()
@@ -1,4 +1,5 @@
 import json
+import logging
 import yaml
 from logger_config import setup_logger
 from datetime import datetime, timedelta, timezone
@@ -6,14 +7,26 @@ import os
 from paho.mqtt.client import MQTTMessage
 from collections import deque, defaultdict
 from queue import Queue
-import struct
 import psycopg2
 import psycopg2
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 import firebase_admin
 from firebase_admin import credentials, firestore, db
 from dotenv import load_dotenv
-from notification_handler import NotificationHandler, NotificationConfig
+from notification_handler import PREVIOUS_LAST_TX_FIELD, NotificationHandler, NotificationConfig
+from payload_decoder import PayloadDecoder
+from ingest_queue import IngestRecord, received_at
+from postgres_pool import PostgresConnectionPool
+from postgres_writer import BatchedPostgresWriter
+from rtdb_shadow import RTDB_SHADOW_ENABLED, RealtimeShadow
+from mac_resolver import LISTEN_ENABLED as MAC_LISTEN_ENABLED, MacCacheSync, MacResolver, apply_mapping
+from rollup import ROLLUP_ENABLED, ROLLUP_INSERT_SQL, RollupAggregator, build_rollup_row, firestore_rollup
+from spool import QUEUED, SPOOL_DIR, SPOOL_ENABLED, SpoolReplayer, WriteAheadSpool
+from firestore_writer import FIRESTORE_BATCHED, BatchedFirestoreWriter
+from firestore_layout import FIRESTORE_LAYOUT, document_write, rollup_write
+from sink_dispatcher import SINK_DISPATCHER_ENABLED, SinkDispatcher
+from sinks import SINK_BACKEND, SqlitePool, local_firebase, state_path
+from state_api import STATE_API_ENABLED, STATE_INDEX
 
 # Carregar variáveis de ambiente do arquivo .env
 load_dotenv()
@@ -27,12 +40,26 @@ SAMPLE_RATE_MS = config['sample_rate_ms']
 NUM_IDS_TO_STORE_PER_BEACON = config['num_ids_to_store_per_beacon']
 BEACONS = config['beacons']
 
+# PostgreSQL (Cloud SQL)
+DB_CONFIG = {
+    "dbname": "ln2-monitor-postgresql",
+    "user": "postgres",
+    "password": "wta@2025",
+    "host": "34.31.34.87", # 34.31.34.87 #
+    "port": 5432,
+}
+
 
 class MessageProcessor:
-    def __init__(self, message_queue: Queue[tuple[datetime, MQTTMessage]]) -> None:
+    # Sinks despachados em filas próprias (ver sink_dispatcher.py); o runtime asyncio tem o próprio agendamento
+    use_sink_dispatcher = True
+
+    def __init__(self, message_queue: Queue[IngestRecord], connect: bool = True, spool_dir: str = None) -> None:
         timestamp_now = datetime.now(timezone.utc)
         self.messages = []  # Lista de pacotes "normais" a serem enviados a cada 5 min
-        self.last_messages_reset_timestamp = timestamp_now
+        # Janelas de 5 minutos no relógio das mensagens: recepção ao vivo, epochtime_g/timestamp no replay
+        self.last_messages_reset_timestamp = None  # Começa na primeira mensagem
+        self.last_message_timestamp = None
         self.messages_reset_interval = timedelta(minutes=5)
         self.duplicates_dict = defaultdict(lambda: deque(maxlen=NUM_IDS_TO_STORE_PER_BEACON))
         self.sample_rate_ms = SAMPLE_RATE_MS
@@ -40,9 +67,15 @@ class MessageProcessor:
         self.output_path = OUTPUT_PATH
         self.message_queue = message_queue
         self.schema = self._load_schema()
+        self.decoder = PayloadDecoder(self.schema, self._get_status_comment)  # Schema compilado uma única vez
 
         # Armazenar o último pacote "normal" de cada beacon
         self.last_beacon_data = {}  # beacon_serial -> (timestamp, message_dict, hex_payload, topic)
+        # Min/max/média/último por beacon de todos os pacotes da janela (ver rollup.py)
+        self.rollup = RollupAggregator() if ROLLUP_ENABLED else None
+        self.rollup_window_start = timestamp_now
+        # Último estado de cada beacon para a API local de leitura (ver state_api.py)
+        self.state_index = STATE_INDEX if STATE_API_ENABLED else None
 
         # Controle de alertas por beacon
         self.alerts_per_beacon = defaultdict(list)  # beacon_serial -> [timestamps dos alertas enviados na última hora]
@@ -50,21 +83,108 @@ class MessageProcessor:
         self.ALERT_STATUS_VALUE = "04"  # Valor considerado "normal" para status
 
         # PostgreSQL connection (Cloud SQL)
-        try:
-            self.db_conn = psycopg2.connect(
-                dbname="ln2-monitor-postgresql",
-                user="postgres",
-                password="wta@2025",
-                host="34.31.34.87", # 34.31.34.87 #
-                port=5432
-            ) 
-            self.db_cursor = self.db_conn.cursor()
-        except Exception as e:
-            self.logger.error(f"Erro ao conectar ao PostgreSQL: {e}")
-            self.db_conn = None
-            self.db_cursor = None
+        # Conexões vêm do pool sob demanda: se o banco estiver fora do ar, as linhas esperam a reconexão
+        self.db_pool = None
+        self.db_writer = None
+        self.rollup_writer = None
+        # Spool local: registros ficam em disco até cada sink confirmar (ver spool.py)
+        self.spool = None
+        self.spool_replayer = None
+        if connect and SPOOL_ENABLED:
+            self.spool = WriteAheadSpool(spool_dir or state_path(SPOOL_DIR))
+        if connect:
+            # sinks.backend local: SQLite no lugar do Cloud SQL (ver sinks.py)
+            self.db_pool = SqlitePool() if SINK_BACKEND == 'local' else PostgresConnectionPool(DB_CONFIG)
+            self.db_writer = BatchedPostgresWriter(self.db_pool, on_batch_done=self._postgres_batch_done)
+            if self.rollup is not None:
+                self.rollup_writer = BatchedPostgresWriter(
+                    self.db_pool, writer_threads=1, insert_sql=ROLLUP_INSERT_SQL, row_builder=build_rollup_row)
 
         # Firestore connection
+        self.firestore_db = None
+        self.firestore_writer = None
+        # Um documento por mensagem ou amostras em documentos por hora/dia (ver firestore_layout.py)
+        self.firestore_layout = FIRESTORE_LAYOUT
+        self.realtime_db = None
+        # Sombra local de REALTIME/STATUS: diferenças sem ler o banco a cada mensagem (ver rtdb_shadow.py)
+        self.rtdb_shadow = None
+        if connect:
+            self._connect_firebase()
+        if self.firestore_db and FIRESTORE_BATCHED:
+            # Documentos gravados em WriteBatch em threads próprias (ver firestore_writer.py)
+            self.firestore_writer = BatchedFirestoreWriter(self.firestore_db, on_batch_done=self._firestore_batch_done)
+        if self.realtime_db and RTDB_SHADOW_ENABLED:
+            self.rtdb_shadow = RealtimeShadow(self.realtime_db)
+        # MAC -> equipment_id sem baixar a árvore inteira (ver mac_resolver.py)
+        self.mac_resolver = MacResolver(self.realtime_db) if self.realtime_db else None
+        if self.rtdb_shadow and self.mac_resolver:
+            # Carrega a sombra uma vez; o que faltar é lido no primeiro uso
+            try:
+                self.rtdb_shadow.warm(self.mac_resolver.list_equipment(), threads=self.mac_resolver.scan_threads)
+            except Exception as e:
+                self.logger.warning(f"Erro ao carregar a sombra do Realtime Database: {e}")
+        if self.spool:
+            self.spool_replayer = SpoolReplayer(self.spool, {
+                'postgres': lambda seq, topic, message_dict, timestamp:
+                    self.insert_message_to_postgres(topic, message_dict, seq=seq),
+                'firestore': lambda seq, topic, message_dict, timestamp:
+                    self.save_message_to_firestore(topic, message_dict, timestamp=timestamp, notify=False, seq=seq),
+                'realtime_db': lambda seq, topic, message_dict, timestamp:
+                    self.update_realtime_database(topic, message_dict, timestamp=timestamp),
+            })
+            self.spool_replayer.start()
+
+        # Cada sink com fila, threads, repetição e circuit breaker próprios (ver sink_dispatcher.py)
+        self.sink_dispatcher = None
+        if SINK_DISPATCHER_ENABLED and self.use_sink_dispatcher:
+            self.sink_dispatcher = SinkDispatcher({
+                'postgres': lambda topic, message_dict, seq:
+                    self.insert_message_to_postgres(topic, message_dict, seq=seq),
+                'firestore': lambda topic, message_dict, seq:
+                    self.save_message_to_firestore(topic, message_dict, seq=seq),
+                'realtime_db': lambda topic, message_dict, seq:
+                    self.update_realtime_database(topic, message_dict),
+            }, settle=self._spool_settle)
+            if self.state_index is not None:
+                self.state_index.add_sink_dispatcher(self.sink_dispatcher)
+
+        # Cache de MAC para Equipment ID
+        self.mac_cache_file = state_path("mac_equipment_cache.json")  # sinks.backend local: sinks.local_state_dir
+        self.mac_cache = {}
+        self.cache_update_interval = timedelta(hours=1)  # Atualizar cache a cada 1 hora
+        self.last_cache_update = datetime.min.replace(tzinfo=timezone.utc)
+        self._load_mac_cache()
+        # O arquivo é o ponto de partida; listen em MAC_INDEX e listagens periódicas o mantêm atual
+        self.mac_sync = None
+        if self.mac_resolver and MAC_LISTEN_ENABLED:
+            self.mac_sync = MacCacheSync(self.mac_resolver, self.mac_cache,
+                                         refresh=self._update_mac_cache_from_realtime_db,
+                                         on_change=self._save_mac_cache)
+            self.mac_sync.start()
+
+        # Inicializar sistema de notificações
+        notification_config = NotificationConfig()
+        self.notification_handler = NotificationHandler(
+            config=notification_config,
+            realtime_db=self.realtime_db,
+            message_processor=self  # Passar referência para acessar _get_status_comment
+        )
+        self.notification_handler.rtdb_shadow = self.rtdb_shadow
+        if self.state_index is not None:
+            self.state_index.add_notification_handler(self.notification_handler)
+        # Iniciar o sistema de notificações
+        if self.realtime_db:
+            self.notification_handler.start()
+            self.logger.info("Sistema de notificações iniciado")
+        else:
+            self.logger.warning("Sistema de notificações não iniciado - Realtime Database indisponível")
+
+    def _connect_firebase(self):
+        """Inicializa o app Firebase e os clientes do Firestore e do Realtime Database"""
+        if SINK_BACKEND == 'local':
+            # Firestore e Realtime Database em memória, sem credenciais nem rede (ver sinks.py)
+            self.firestore_db, self.realtime_db = local_firebase()
+            return
         try:
             if not firebase_admin._apps:
                 # Usar credenciais das variáveis de ambiente
@@ -98,188 +218,88 @@ class MessageProcessor:
             self.firestore_db = None
             self.realtime_db = None
 
-        # Cache de MAC para Equipment ID
-        self.mac_cache_file = "mac_equipment_cache.json"
-        self.mac_cache = {}
-        self.cache_update_interval = timedelta(hours=1)  # Atualizar cache a cada 1 hora
-        self.last_cache_update = datetime.min.replace(tzinfo=timezone.utc)
-        self._load_mac_cache()
-
-        # Inicializar sistema de notificações
-        notification_config = NotificationConfig()
-        self.notification_handler = NotificationHandler(
-            config=notification_config,
-            realtime_db=self.realtime_db,
-            message_processor=self  # Passar referência para acessar _get_status_comment
-        )
-        # Iniciar o sistema de notificações
-        if self.realtime_db:
-            self.notification_handler.start()
-            self.logger.info("Sistema de notificações iniciado")
-        else:
-            self.logger.warning("Sistema de notificações não iniciado - Realtime Database indisponível")
-
     def save_message_to_db(self, topic, message_dict):
-        import math
-        # Mapeamento explícito para garantir nomes idênticos ao banco
-        def normalize_keys(d):
-            mapping = {
-                "topic": "topic",
-                "start_flag": "start_flag",
-                "package_type": "package_type",
-                "beacon_serial": "beacon_serial",
-                # "vccbat": "vccbat",
-                "epochtime_b": "epochtime_b",
-                "epochtime_btx": "epochtime_btx",
-                "epochtime_g": "epochtime_g",
-                "crc": "crc",
-                "rssi": "rssi",
-                "package_id": "package_id",
-                "tempa": "tempa",
-                "r1": "r1",
-                "r2": "r2",
-                "r3": "r3",
-                "r4": "r4",
-                "r5": "r5",
-                "r6": "r6",
-                "r7": "r7",
-                "r8": "r8",
-                "r9": "r9",
-                "r10": "r10",
-                "r11": "r11",
-                "sensor_data_def_id": "sensor_data_def_id",
-                "fw_version_prefix": "fw_version_prefix",
-                "fw_version_major": "fw_version_major",
-                "fw_version_minor": "fw_version_minor",
-                "fw_version_patch": "fw_version_patch",
-                "fw_version_build": "fw_version_build",
-                "acc_mode_full": "acc_mode_full",
-                "ton_toff": "ton_toff",
-                "ln2_level_status": "ln2_level_status",
-                "ln2_angle_status": "ln2_angle_status",
-                "ln2_battery_status": "ln2_battery_status",
-                "batt_percent": "batt_percent",
-                "ln2_foam_status": "ln2_foam_status",
-                "ln2_general_status": "ln2_general_status",
-                "status_osc_cnt": "status_osc_cnt",
-                "ln2_acc_data_available": "ln2_acc_data_available",
-                "ln2_tx_cause_status": "ln2_tx_cause_status",
-                "temp_pt100": "temp_pt100",
-                "temp_ambient": "temp_ambient",
-                "angle_to_horizontal": "angle_to_horizontal",
-                "vbat_mv": "vbat_mv",
-                "factory_serial": "factory_serial",
-                "ln2vibration": "ln2vibration",
-                "ln2vibrationstatus": "ln2vibrationstatus",
-                "original_payload": "original_payload",
-            }
-            normalized = {}
-            for k, v in d.items():
-                key = k.lower().replace("-", "_")
-                if key in mapping:
-                    normalized[mapping[key]] = v
-                elif key.upper() in mapping:
-                    normalized[mapping[key.upper()]] = v
-                else:
-                    normalized[key] = v
-            return normalized
-        message_dict = normalize_keys(message_dict)
-        if not self.db_cursor:
+        message_dict = self._normalize_message_keys(message_dict)
+        if not self.db_writer:
             self.logger.error("Sem conexão com o banco de dados!")
             return
-        sql = (
-            "INSERT INTO mqtt_messages ("
-            "topic, start_flag, package_type, beacon_serial, epochtime_b, epochtime_btx, epochtime_g, crc, package_id, tempa, "
-            "r1, r2, r3, r4, r5, r6, r7, r8, r9, r10, r11, "
-            "sensor_data_def_id, fw_version_prefix, fw_version_major, fw_version_minor, fw_version_patch, fw_version_build, "
-            "acc_mode_full, ton_toff, ln2_level_status, ln2_angle_status, ln2_battery_status, batt_percent, ln2_foam_status, ln2_general_status, "
-            "status_osc_cnt, ln2_acc_data_available, ln2_tx_cause_status, temp_pt100, temp_ambient, angle_to_horizontal, vbat_mv, "
-            "factory_serial, ln2vibration, ln2vibrationstatus, rssi, original_payload"
-            ") VALUES ("
-            + ",".join(["%s"] * 47) + ")"
-        )
-        def safe_float(val):
-            try:
-                if val is None or (isinstance(val, float) and math.isnan(val)):
-                    return None
-                return float(val)
-            except Exception:
-                return None
-        def safe_int(val):
-            try:
-                if val is None or (isinstance(val, float) and math.isnan(val)):
-                    return None
-                return int(val)
-            except Exception:
-                return None
-        values = (
-            topic,  # 1
-            message_dict.get("start_flag"),  # 2
-            message_dict.get("package_type"),  # 3
-            message_dict.get("beacon_serial"),  # 4
-            # safe_float(message_dict.get("vccbat")),  # 5
-            message_dict.get("epochtime_b"),  # 6
-            message_dict.get("epochtime_btx"),  # 7
-            message_dict.get("epochtime_g"),  # 8
-            message_dict.get("crc"),  # 9
-            safe_int(message_dict.get("package_id")),  # 10
-            safe_float(message_dict.get("tempa")),  # 11
-            message_dict.get("r1"),  # 12
-            message_dict.get("r2"),  # 13
-            message_dict.get("r3"),  # 14
-            message_dict.get("r4"),  # 15
-            message_dict.get("r5"),  # 16
-            message_dict.get("r6"),  # 17
-            message_dict.get("r7"),  # 18
-            message_dict.get("r8"),  # 19
-            message_dict.get("r9"),  # 20
-            message_dict.get("r10"),  # 21
-            message_dict.get("r11"),  # 22
-            message_dict.get("sensor_data_def_id"),  # 23
-            message_dict.get("fw_version_prefix"),  # 24
-            message_dict.get("fw_version_major"),  # 25
-            message_dict.get("fw_version_minor"),  # 26
-            message_dict.get("fw_version_patch"),  # 27
-            message_dict.get("fw_version_build"),  # 28
-            message_dict.get("acc_mode_full"),  # 29
-            message_dict.get("ton_toff"),  # 30
-            message_dict.get("ln2_level_status"),  # 31
-            message_dict.get("ln2_angle_status"),  # 32
-            message_dict.get("ln2_battery_status"),  # 33
-            message_dict.get("batt_percent"),  # 34
-            message_dict.get("ln2_foam_status"),  # 35
-            message_dict.get("ln2_general_status"),  # 36
-            message_dict.get("status_osc_cnt"),  # 37
-            message_dict.get("ln2_acc_data_available"),  # 38
-            message_dict.get("ln2_tx_cause_status"),  # 39
-            safe_float(message_dict.get("temp_pt100")),  # 40
-            safe_float(message_dict.get("temp_ambient")),  # 41
-            safe_float(message_dict.get("angle_to_horizontal")),  # 42
-            safe_float(message_dict.get("vbat_mv")),  # 43
-            message_dict.get("factory_serial"),  # 34
-            message_dict.get("ln2vibration"),  # 35
-            message_dict.get("ln2vibrationstatus"),  # 36
-            safe_int(message_dict.get("rssi")),
-            message_dict.get("original_payload"),  # 44
-        )
-        try:
-            # Debug: conferir número de argumentos e tipos
-            # print(len(values), values)
-            # print("JSON enviado:", json.dumps(message_dict, indent=4, ensure_ascii=False))
-            # print("Valores enviados para o banco:", values)
-            # print("Nº de %s no SQL:", sql.count('%s'))
-            # print("Nº de valores:", len(values))
-            self.db_cursor.execute(sql, list(values))
-            self.db_conn.commit()
-            print(f"Mensagem publicada no SQL para o beacon {message_dict.get('beacon_serial')} (package_id={message_dict.get('package_id')}) no tópico '{topic}' em {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        except Exception as e:
-            self.logger.error(f"Erro ao inserir no banco: {e}")
+        seq = self._spool_append(topic, message_dict)
+        if self.sink_dispatcher:
+            self._capture_previous_last_tx(message_dict)
+            self.sink_dispatcher.dispatch(topic, message_dict, seq)
+            return
+        self.insert_message_to_postgres(topic, message_dict, seq=seq)
         
         # Também salvar no Firestore
-        self.save_message_to_firestore(topic, message_dict)
+        self._spool_settle('firestore', seq, self.save_message_to_firestore(topic, message_dict, seq=seq), message_dict)
         
         # Também atualizar Realtime Database
-        self.update_realtime_database(topic, message_dict)
+        self._spool_settle('realtime_db', seq, self.update_realtime_database(topic, message_dict), message_dict)
+
+    def _capture_previous_last_tx(self, message_dict):
+        """
+        Guarda no message_dict o lastTX anterior ao pacote. Os sinks rodam em paralelo: o do
+        Realtime DB grava o lastTX deste pacote enquanto o do Firestore verifica a conexão nas
+        notificações, que precisa do valor anterior para detectar o intervalo sem comunicação.
+        """
+        handler = getattr(self, 'notification_handler', None)
+        if not handler or not handler.realtime_db or not handler.config.connection_check_enabled:
+            return
+        equipment_id = self._equipment_id_from_cache(message_dict.get('beacon_serial') or '')
+        if not equipment_id:
+            return  # Equipamento ainda fora do cache: a verificação lê o lastTX ela mesma
+        try:
+            message_dict[PREVIOUS_LAST_TX_FIELD] = handler.read_last_tx(equipment_id)
+        except Exception as e:
+            self.logger.error(f"Erro ao ler o lastTX anterior de {equipment_id}: {e}")
+
+    def _spool_append(self, topic, message_dict):
+        """Grava o registro no spool antes dos sinks; retorna o seq (None sem spool)"""
+        if not self.spool:
+            return None
+        try:
+            return self.spool.append(topic, message_dict)
+        except Exception as e:
+            self.logger.error(f"Erro ao gravar no spool, registro segue sem proteção: {e}")
+            return None
+
+    def _spool_settle(self, sink, seq, result, message_dict):
+        """Confirma o registro para o sink, ou o deixa pendente para o replay se a escrita falhou (False)"""
+        if seq is None or result == QUEUED:  # QUEUED: o writer em lote confirma quando gravar
+            return
+        if result is False:
+            self.spool.nack(sink, seq)
+        else:
+            self.spool.ack(sink, seq, key=message_dict.get('beacon_serial'))
+
+    def _spool_batch_done(self, sink, seqs, written):
+        """Resultado de um lote dos writers: breaker do sink no dispatcher e confirmação no spool"""
+        # Os writers começam antes do dispatcher existir
+        sink_dispatcher = getattr(self, 'sink_dispatcher', None)
+        if sink_dispatcher:
+            sink_dispatcher.record(sink, written)
+        if not self.spool:
+            return
+        for seq in seqs:
+            if written:
+                self.spool.ack(sink, seq)
+            else:
+                self.spool.nack(sink, seq)
+
+    def _postgres_batch_done(self, seqs, written):
+        self._spool_batch_done('postgres', seqs, written)
+
+    def _firestore_batch_done(self, seqs, written):
+        self._spool_batch_done('firestore', seqs, written)
+
+    def _normalize_message_keys(self, d):
+        """Nomes de campo idênticos às colunas do banco (minúsculas, '-' vira '_')"""
+        return {k.lower().replace("-", "_"): v for k, v in d.items()}
+
+    def insert_message_to_postgres(self, topic, message_dict, seq=None):
+        """Enfileira um pacote (já normalizado) para a tabela mqtt_messages; a gravação é feita em lotes"""
+        self.db_writer.add(topic, message_dict, seq=seq)
+        return QUEUED
 
     def _process_battery_percent(self, batt_percent_hex):
         """
@@ -331,9 +351,10 @@ class MessageProcessor:
         except (ValueError, TypeError):
             return None
 
-    def update_realtime_database(self, topic, message_dict):
+    def update_realtime_database(self, topic, message_dict, timestamp=None):
         """
-        Atualiza campos específicos do Realtime Database seguindo a estrutura do sistema
+        Atualiza campos específicos do Realtime Database seguindo a estrutura do sistema.
+        Retorna False se a escrita falhou (o spool guarda o registro para o replay).
         """
         if not self.realtime_db:
             self.logger.error("Sem conexão com o Realtime Database!")
@@ -370,7 +391,7 @@ class MessageProcessor:
                 return status_str
             
             # Mapear dados MQTT para estrutura do Realtime Database
-            current_time = datetime.now(timezone.utc)
+            current_time = timestamp or datetime.now(timezone.utc)
             epoch_timestamp = str(int(current_time.timestamp()))
             
             # Atualizar seção REALTIME
@@ -477,6 +498,16 @@ class MessageProcessor:
                 # Fallback se houver erro na conversão
                 status_data['versionFW'] = f"v{fw_major}.{fw_major}.{fw_minor}.{fw_patch}.{fw_build}"
             
+            # Com a sombra: diferença local e um único update multi-path, sem leituras
+            if self.rtdb_shadow:
+                updates = self.rtdb_shadow.write(equipment_id, {'REALTIME': realtime_data, 'STATUS': status_data})
+                if updates:
+                    self.logger.debug(f"Realtime Database atualizado para {equipment_id}: {updates}")
+                    self.logger.info(f"Realtime Database atualizado para {equipment_id} (MAC: {mac_equipament})")
+                else:
+                    self.logger.debug(f"Realtime Database sem mudanças para {equipment_id} (MAC: {mac_equipament})")
+                return True
+
             # Atualizar no Realtime Database com otimização (só escrever se valor mudou)
             equipment_ref = self.realtime_db.child(equipment_id)
             
@@ -523,13 +554,18 @@ class MessageProcessor:
                 self.logger.info(f"Realtime Database atualizado para {equipment_id} (MAC: {mac_equipament})")
             else:
                 self.logger.debug(f"Realtime Database sem mudanças para {equipment_id} (MAC: {mac_equipament})")
+            return True
             
         except Exception as e:
             self.logger.error(f"Erro ao atualizar Realtime Database: {e}")
+            return False
         
-    def save_message_to_firestore(self, topic, message_dict):
+    def save_message_to_firestore(self, topic, message_dict, timestamp=None, notify=True, seq=None):
         """
-        Salva dados específicos no Firestore seguindo a estrutura solicitada
+        Salva dados específicos no Firestore seguindo a estrutura solicitada.
+        No replay do spool recebe o instante original e não dispara notificações.
+        Retorna False se a escrita falhou, ou QUEUED se o documento foi entregue ao
+        BatchedFirestoreWriter (o seq do spool é confirmado quando o lote for gravado).
         """
         if not self.firestore_db:
             self.logger.error("Sem conexão com o Firestore!")
@@ -545,8 +581,8 @@ class MessageProcessor:
             # Converter beacon_serial para formato MAC
             mac_equipament = self._format_mac_address(beacon_serial)
             
-            # Atualizar cache periodicamente
-            if self._should_update_cache():
+            # Atualizar cache periodicamente (com o MacCacheSync isso roda em segundo plano)
+            if not self.mac_sync and self._should_update_cache():
                 self.logger.info("Atualizando cache de equipamentos...")
                 self._update_mac_cache_from_realtime_db()
             
@@ -556,10 +592,7 @@ class MessageProcessor:
                 self.logger.error(f"Equipment ID não encontrado para MAC {mac_equipament} (beacon_serial: {beacon_serial})")
                 return
             
-            # Data formatada para a coleção (formato YYYY-MM-DD)
-            now = datetime.now(timezone.utc)
-            formatted_date = now.strftime('%Y-%m-%d')
-            formatted_time = now.strftime('%H-%M-%S')
+            now = timestamp or datetime.now(timezone.utc)
             
             # Mapeamento dos dados para o Firestore usando funções compartilhadas
             firestore_data = {
@@ -575,21 +608,30 @@ class MessageProcessor:
             
             # Remover valores None para não salvar campos vazios
             firestore_data = {k: v for k, v in firestore_data.items() if v is not None}
+
+            # Agregados da janela (min/max/média/último de todos os pacotes do beacon)
+            rollup = message_dict.get('rollup')
+            if rollup:
+                firestore_data['rollup'] = firestore_rollup(rollup)
             
-            # Estrutura: Equipment_ID (Collection) > data (Document) > 2025-06-09 (Collection) > 09-45-00 (Document) > firestore_data
-            collection_ref = self.firestore_db.collection(equipment_id)
-            data_doc_ref = collection_ref.document('data')
-            date_collection_ref = data_doc_ref.collection(formatted_date)
-            time_doc_ref = date_collection_ref.document(formatted_time)
-            
-            # Salvar no Firestore
-            time_doc_ref.set(firestore_data)
+            # Documento conforme firestore.layout: por mensagem
+            # (Equipment_ID > data > 2025-06-09 > 09-45-00) ou bucket por hora/dia (Equipment_ID > history > daily > 2025-06-09)
+            doc_ref, doc_data, merge = document_write(
+                self.firestore_db, equipment_id, firestore_data, now, self.firestore_layout)
             
-            self.logger.info(f"Dados salvos no Firestore: {equipment_id}/data/{formatted_date}/{formatted_time} - MAC: {mac_equipament}")
-            print(f"Mensagem publicada no Firestore para {equipment_id} (MAC: {mac_equipament}) em {formatted_date} às {formatted_time}")
+            # Salvar no Firestore (em lote pelo writer, ou um set() por mensagem)
+            if self.firestore_writer:
+                self.firestore_writer.add(doc_ref, doc_data, seq=seq, merge=merge)
+                result = QUEUED
+                self.logger.debug(f"Documento enfileirado para o Firestore: {doc_ref.path}")
+            else:
+                doc_ref.set(doc_data, merge=merge)
+                result = True
+                self.logger.info(f"Dados salvos no Firestore: {doc_ref.path} - MAC: {mac_equipament}")
+                print(f"Mensagem publicada no Firestore para {equipment_id} (MAC: {mac_equipament}) em {doc_ref.path}")
             
             # Processar notificações após salvar no Firestore
-            if hasattr(self, 'notification_handler') and self.notification_handler:
+            if notify and hasattr(self, 'notification_handler') and self.notification_handler:
                 try:
                     self.notification_handler.process_mqtt_data(equipment_id, message_dict)
                 except Exception as notification_error:
@@ -601,7 +643,29 @@ class MessageProcessor:
             # Adicionar mais detalhes para debug
             import traceback
             self.logger.error(f"Traceback completo: {traceback.format_exc()}")
+            return False
+        return result
         
+    def save_rollup_to_firestore(self, beacon_serial, rollup, timestamp):
+        """Grava no Firestore só os agregados da janela de um beacon que não teve pacote normal nela"""
+        if not self.firestore_db:
+            return
+        try:
+            mac_equipament = self._format_mac_address(beacon_serial)
+            equipment_id = self._get_equipment_id_by_mac(mac_equipament)
+            if not equipment_id:
+                self.logger.error(f"Equipment ID não encontrado para MAC {mac_equipament} (agregados de {beacon_serial})")
+                return
+            doc_ref, doc_data, merge = rollup_write(self.firestore_db, equipment_id, firestore_rollup(rollup),
+                                                    timestamp, self.firestore_layout, mac_equipament)
+            if self.firestore_writer:
+                self.firestore_writer.add(doc_ref, doc_data, merge=merge)
+            else:
+                doc_ref.set(doc_data, merge=merge)
+                self.logger.info(f"Agregados salvos no Firestore: {doc_ref.path} - MAC: {mac_equipament}")
+        except Exception as e:
+            self.logger.error(f"Erro ao salvar agregados de {beacon_serial} no Firestore: {e}")
+
     def _twos_comp(self, val, bits):
         """compute the 2's complement of int value val"""
         if (val & (1 << (bits - 1))) != 0:
@@ -682,50 +746,11 @@ class MessageProcessor:
 
 
     def _parse_hex_string(self, hex_string: str, timestamp: datetime) -> dict:
-        values = {field['name']: hex_string[field['start_idx']: field['end_idx']] for field in self.schema}
-        parsed_hex = {}
+        return self.decoder.decode(hex_string)
 
-        for k, v in values.items():
-            if k in ['temp_pt100', 'temp_ambient']:
-                # Interpretar como int16_t em centésimos de grau Celsius
-                try:
-                    raw_bytes = bytes.fromhex(v)
-                    parsed_hex[k] = struct.unpack('>h', raw_bytes)[0] / 100
-                except Exception:
-                    parsed_hex[k] = v  # fallback para depuração se falhar
-            elif k == 'vbat_mv':
-                raw_bytes = bytes.fromhex(v)
-                vbat = struct.unpack('>H', raw_bytes)[0]
-                parsed_hex[k] = vbat
-            elif k == 'angle_to_horizontal':
-                raw_bytes = bytes.fromhex(v)
-                angle = struct.unpack('>H', raw_bytes)[0]
-                parsed_hex[k] = angle
-            elif 'rssi' in k:
-                parsed_hex[k] = self._twos_comp(int(v, 16), 8)
-            elif 'epochtime' in k:
-                parsed_hex[k] = int(v, 16)
-                parsed_hex[k] = datetime.fromtimestamp(parsed_hex[k], tz=timezone.utc).strftime("%Y-%m-%d %H-%M-%S.%f")[:-3]
-            elif 'package_id' in k:
-                parsed_hex[k] = int(v, 16)
-            elif 'vccbat' in k:
-                parsed_hex[k] = int(v, 16) / 1000
-            elif 'tempa' in k:
-                parsed_hex[k] = int(v, 16) / 100
-            elif k.endswith('Status') or 'status' in k.lower():
-                try:
-                    # Tenta converter para int (pode ser signed ou unsigned)
-                    status_val = int(v, 16)
-                    # Ajusta para signed se necessário (assume 8 bits)
-                    if status_val >= 0x80:
-                        status_val -= 0x100
-                    parsed_hex[k] = self._get_status_comment(status_val)
-                except Exception:
-                    parsed_hex[k] = v
-            else:
-                parsed_hex[k] = v
-
-        return parsed_hex
+    def decode_batch(self, hex_payloads: list[str]) -> dict:
+        """Decodifica vários pacotes de uma vez em colunas NumPy (backfills, replays, análises)"""
+        return self.decoder.decode_batch(hex_payloads)
 
 
     def _convert_hex_to_float(self, hex_char, bits, desired_range:tuple=(-4, 4)):
@@ -754,10 +779,11 @@ class MessageProcessor:
         
 
 
-    def add_message(self, message_dict:dict, hex_payload:str, topic:str=None):
+    def add_message(self, message_dict:dict, hex_payload:str, topic:str=None, timestamp:datetime=None):
         """
         Acumula mensagens por beacon_serial para envio a cada 5 minutos.
         Se detectar condição de alerta, envia imediatamente (respeitando o limite de alertas por hora).
+        `timestamp` é o instante da mensagem (padrão: agora); o limite de alertas usa esse relógio.
         """
         print(hex_payload)
         print(json.dumps(message_dict, indent=4))
@@ -765,7 +791,13 @@ class MessageProcessor:
 
         message_dict['original_payload'] = hex_payload
         beacon_serial = message_dict.get('beacon_serial')
-        now = datetime.now(timezone.utc)
+        now = timestamp or datetime.now(timezone.utc)
+
+        # Todos os pacotes (inclusive alertas e os que não serão enviados) entram nos agregados
+        if self.rollup is not None:
+            self.rollup.add(beacon_serial, message_dict, topic)
+        if self.state_index is not None:
+            self.state_index.update(beacon_serial, message_dict, now, self._equipment_id_from_cache)
 
         # --- Verificação de condição de alerta ---
         # Se qualquer status for diferente de ALERT_STATUS_VALUE, é alerta
@@ -789,19 +821,35 @@ class MessageProcessor:
                 self.logger.info(f"Alerta descartado para {beacon_serial} (limite de {self.ALERTS_PER_HOUR_LIMIT} por hora atingido)")
             return  # Não armazena para envio normal
 
-        # --- Acumulação normal: só armazena o primeiro pacote do beacon até o próximo ciclo de 5 min ---
-        if beacon_serial not in self.last_beacon_data:
+        # --- Acumulação normal: um pacote por beacon até o próximo ciclo de 5 min ---
+        # Com rollup fica o mais recente (os demais já estão nos agregados); sem rollup, o primeiro
+        if self.rollup is not None or beacon_serial not in self.last_beacon_data:
             self.last_beacon_data[beacon_serial] = (now, message_dict, hex_payload, topic)
-        # Se já existe, descarta os demais até o próximo ciclo
 
-    def flush_beacon_data(self):
+    def flush_beacon_data(self, now: datetime = None):
         """
-        Envia para o banco o último pacote "normal" de cada beacon e limpa o cache.
+        Envia para o banco o pacote "normal" de cada beacon, com os agregados da janela, e limpa o cache.
+        `now` é o fim da janela (padrão: instante da última mensagem, ou agora).
         """
+        now = now or self.last_message_timestamp or datetime.now(timezone.utc)
+        rollups = self.rollup.drain(self.rollup_window_start, now) if self.rollup is not None else {}
+        self.rollup_window_start = now
+        with_sample = set()
         for beacon_serial, (ts, message_dict, hex_payload, topic) in self.last_beacon_data.items():
             if topic is not None:
+                if beacon_serial in rollups:
+                    message_dict['rollup'] = rollups[beacon_serial]
+                    with_sample.add(beacon_serial)
                 self.save_message_to_db(topic, message_dict)
         self.last_beacon_data.clear()
+        # Beacons sem pacote normal na janela (ex: só alertas): os agregados vão sozinhos para o Firestore
+        for beacon_serial, rollup in rollups.items():
+            if beacon_serial not in with_sample:
+                self.save_rollup_to_firestore(beacon_serial, rollup, now)
+        # Uma linha por beacon da janela em mqtt_rollups (inclusive beacons que só enviaram alertas)
+        if self.rollup_writer:
+            for rollup in rollups.values():
+                self.rollup_writer.add(rollup['topic'], rollup)
 
     def is_duplicate(self, message_dict:dict) -> bool:
         return message_dict['package_id'] in self.duplicates_dict[message_dict['beacon_serial']]
@@ -835,35 +883,50 @@ class MessageProcessor:
     
 
 
-    def run(self):
-        while True:
-            try:
-                message_timestamp, message = self.message_queue.get()
-                # Beacon messages
-                if 'Pub' in message.topic:
-                    gateway_serial, message_dict = self._load_message(message, message_timestamp)
+    def process_message(self, message: MQTTMessage, message_timestamp: datetime) -> None:
+        """Processa um pacote recebido (usado pelo loop `run` e pelo replay); message_timestamp deve ter fuso"""
+        if message_timestamp.tzinfo is None:
+            # As janelas, os agregados e os buckets do Firestore são comparados com datetimes UTC
+            raise ValueError(f"message_timestamp sem fuso horário: {message_timestamp}")
+        # Beacon messages
+        if 'Pub' in message.topic:
+            gateway_serial, message_dict = self._load_message(message, message_timestamp)
+
+            # Filter beacons
+            # if BEACONS and message_dict['beacon_serial'] not in BEACONS:
+            #     return
+
+            # Filter out duplicates
+            #if self.is_duplicate(message_dict):
+            #    return
 
-                    # Filter beacons
-                    # if BEACONS and message_dict['beacon_serial'] not in BEACONS:
-                    #     continue
+            if self.last_messages_reset_timestamp is None or message_timestamp < self.last_messages_reset_timestamp:
+                # Primeira mensagem, ou replay de dados anteriores à janela atual: a janela começa aqui
+                self.last_messages_reset_timestamp = self.rollup_window_start = message_timestamp
+            self.last_message_timestamp = message_timestamp
 
-                    # Filter out duplicates
-                    #if self.is_duplicate(message_dict):
-                    #    continue
+            self.add_message(message_dict, message.payload.decode(), topic=message.topic, timestamp=message_timestamp)
 
-                    self.add_message(message_dict, message.payload.decode(), topic=message.topic)
+            self.duplicates_dict[message_dict['beacon_serial']].append(message_dict['package_id'])
 
-                    self.duplicates_dict[message_dict['beacon_serial']].append(message_dict['package_id'])
+            # A cada ciclo de 5 minutos (no relógio das mensagens), envia o último pacote normal de cada beacon
+            if message_timestamp - self.last_messages_reset_timestamp >= self.messages_reset_interval:
+                self.flush_beacon_data(message_timestamp)
+                self.last_messages_reset_timestamp = message_timestamp
 
-                    # A cada ciclo de 5 minutos, envia o último pacote normal de cada beacon
-                    timestamp_now = datetime.now(timezone.utc)
-                    if timestamp_now - self.last_messages_reset_timestamp >= self.messages_reset_interval:
-                        self.flush_beacon_data()
-                        self.last_messages_reset_timestamp = timestamp_now
+        # Gateway messages
+        if 'tempHum' in message.topic:
+            return
 
-                # Gateway messages
-                if 'tempHum' in message.topic:
-                    continue
+    def run(self):
+        while True:
+            try:
+                record = self.message_queue.get()
+                if record is None:  # Sentinela de parada
+                    break
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Received message from topic: %s, payload: %s", record.topic, record.payload)
+                self.process_message(record, received_at(record.recv_ns))
 
             except Exception as e:
                 self.logger.exception("Error in message processing loop: %s", str(e))
@@ -909,9 +972,10 @@ class MessageProcessor:
         """Salva o cache de MAC para Equipment ID no arquivo local"""
         try:
             cache_data = {
-                'mac_mapping': self.mac_cache,
+                'mac_mapping': dict(self.mac_cache),  # Cópia: o MacCacheSync altera o cache em outra thread
                 'last_update': datetime.now(timezone.utc).isoformat()
             }
+            os.makedirs(os.path.dirname(self.mac_cache_file) or '.', exist_ok=True)
             with open(self.mac_cache_file, 'w') as f:
                 json.dump(cache_data, f, indent=2)
             self.logger.info(f"Cache MAC salvo: {len(self.mac_cache)} equipamentos")
@@ -924,6 +988,10 @@ class MessageProcessor:
             return ':'.join([beacon_serial[i:i+2] for i in range(0, 12, 2)])
         return beacon_serial
 
+    def _equipment_id_from_cache(self, beacon_serial):
+        """Equipment ID pelo cache de MAC, sem consultar o Realtime Database"""
+        return self.mac_cache.get(self._format_mac_address(beacon_serial))
+
     def _should_update_cache(self):
         """Verifica se o cache deve ser atualizado"""
         try:
@@ -938,91 +1006,54 @@ class MessageProcessor:
             return True
 
     def _update_mac_cache_from_realtime_db(self):
-        """Atualiza o cache consultando apenas equipamentos não conhecidos no Realtime Database"""
-        if not self.realtime_db:
+        """Atualiza o cache lendo só STATUS/mac de cada equipamento (ver mac_resolver.py)"""
+        if not self.mac_resolver:
             self.logger.error("Realtime Database não disponível para atualização do cache")
             return
 
         try:
-            # Buscar todos os equipamentos do Realtime Database
-            all_equipment = self.realtime_db.get()
-            if not all_equipment:
+            mapping = self.mac_resolver.scan()
+            if not mapping:
                 self.logger.warning("Nenhum equipamento encontrado no Realtime Database")
                 return
+            # MACs novos ou movidos; o MAC anterior de um equipamento sai do cache
+            before = dict(self.mac_cache)
+            changed = apply_mapping(self.mac_cache, mapping, self.mac_resolver)
 
-            new_mappings = 0
-            updated_mappings = 0
-
-            for equipment_id in all_equipment.keys():
-                if equipment_id.startswith('LN2-'):
-                    try:
-                        # Verificar se já temos esse equipamento no cache
-                        equipment_data = all_equipment[equipment_id]
-                        if isinstance(equipment_data, dict) and 'STATUS' in equipment_data:
-                            status = equipment_data['STATUS']
-                            if isinstance(status, dict) and 'mac' in status:
-                                mac_address = status['mac']
-                                
-                                # Verificar se o MAC mudou ou é novo
-                                if mac_address not in self.mac_cache or self.mac_cache[mac_address] != equipment_id:
-                                    if mac_address in self.mac_cache:
-                                        updated_mappings += 1
-                                    else:
-                                        new_mappings += 1
-                                    
-                                    self.mac_cache[mac_address] = equipment_id
-                                    self.logger.info(f"Mapeamento atualizado: {mac_address} -> {equipment_id}")
-                    
-                    except Exception as e:
-                        self.logger.error(f"Erro ao processar equipamento {equipment_id}: {e}")
+            # Relê REALTIME/STATUS no próximo uso só dos equipamentos cujo MAC mudou
+            if self.rtdb_shadow:
+                moved = set(before.items()) ^ set(self.mac_cache.items())
+                for equipment_id in {equipment_id for _, equipment_id in moved}:
+                    self.rtdb_shadow.invalidate(equipment_id)
 
             # Salvar cache atualizado
             self._save_mac_cache()
             self.last_cache_update = datetime.now(timezone.utc)
             
-            self.logger.info(f"Cache atualizado: {new_mappings} novos, {updated_mappings} atualizados. Total: {len(self.mac_cache)}")
+            self.logger.info(f"Cache atualizado: {changed} mapeamentos alterados. Total: {len(self.mac_cache)}")
 
         except Exception as e:
             self.logger.error(f"Erro ao atualizar cache do Realtime Database: {e}")
 
     def _get_equipment_id_by_mac(self, mac_address):
-        """Busca o Equipment ID pelo MAC address, usando cache otimizado"""
+        """Busca o Equipment ID pelo MAC address: cache local, depois MacResolver"""
         # Verificar se está no cache
         if mac_address in self.mac_cache:
             return self.mac_cache[mac_address]
 
         # MAC não encontrado no cache - buscar no Realtime Database
-        if not self.realtime_db:
+        if not self.mac_resolver:
             self.logger.error("Realtime Database não disponível para busca de equipamento")
             return None
 
         try:
-            self.logger.info(f"Buscando equipamento para MAC {mac_address} no Realtime Database...")
-            
-            # Buscar todos os equipamentos (otimização: poderia ser feita uma query mais específica)
-            all_equipment = self.realtime_db.get()
-            if not all_equipment:
-                return None
-
-            for equipment_id in all_equipment.keys():
-                if equipment_id.startswith('LN2-'):
-                    try:
-                        equipment_data = all_equipment[equipment_id]
-                        if isinstance(equipment_data, dict) and 'STATUS' in equipment_data:
-                            status = equipment_data['STATUS']
-                            if isinstance(status, dict) and 'mac' in status:
-                                stored_mac = status['mac']
-                                if stored_mac == mac_address:
-                                    # Encontrado! Adicionar ao cache
-                                    self.mac_cache[mac_address] = equipment_id
-                                    self._save_mac_cache()
-                                    self.logger.info(f"Equipamento encontrado: {mac_address} -> {equipment_id}")
-                                    return equipment_id
-                    except Exception as e:
-                        self.logger.error(f"Erro ao verificar equipamento {equipment_id}: {e}")
-
-            self.logger.warning(f"Equipamento não encontrado para MAC {mac_address}")
-            return None
+            equipment_id = self.mac_resolver.resolve(mac_address)
+            if equipment_id:
+                # Encontrado! Adicionar ao cache (um MAC anterior do equipamento sai)
+                apply_mapping(self.mac_cache, {mac_address: equipment_id})
+                self._save_mac_cache()
+                self.logger.info(f"Equipamento encontrado: {mac_address} -> {equipment_id}")
+            return equipment_id
 
         except Exception as e:
             self.logger.error(f"Erro ao buscar equipamento por MAC: {e}")
@@ -1031,17 +1062,45 @@ class MessageProcessor:
     def cleanup(self):
         """Limpa recursos ao finalizar o MessageProcessor"""
         try:
+            # Escritas já despachadas terminam antes de parar notificações e writers
+            if self.sink_dispatcher:
+                self.sink_dispatcher.close()
+                if self.state_index is not None:
+                    self.state_index.remove_sink_dispatcher(self.sink_dispatcher)
+                self.sink_dispatcher = None
+
             # Parar sistema de notificações
             if hasattr(self, 'notification_handler') and self.notification_handler:
                 self.notification_handler.stop()
                 self.logger.info("Sistema de notificações finalizado")
+                if self.state_index is not None:
+                    self.state_index.remove_notification_handler(self.notification_handler)
             
-            # Fechar conexões do banco
-            if self.db_cursor:
-                self.db_cursor.close()
-            if self.db_conn:
-                self.db_conn.close()
-                self.logger.info("Conexão PostgreSQL fechada")
+            if self.spool_replayer:
+                self.spool_replayer.stop()
+                self.spool_replayer = None
+            if self.mac_sync:
+                self.mac_sync.stop()
+                self.mac_sync = None
+
+            # Gravar o último lote pendente e fechar conexões do banco
+            if self.db_writer:
+                self.db_writer.close()
+                self.db_writer = None
+            if self.rollup_writer:
+                self.rollup_writer.close()
+                self.rollup_writer = None
+            if self.firestore_writer:
+                self.firestore_writer.close()
+                self.firestore_writer = None
+            if self.db_pool:
+                self.db_pool.close()
+                self.db_pool = None
+
+            # Depois do último lote, para o acks.json refletir o que foi gravado
+            if self.spool:
+                self.spool.close()
+                self.spool = None
                 
         except Exception as e:
             self.logger.error(f"Erro durante cleanup: {e}")
@@ -0,0 +1,54 @@
+"""
+Métricas simples de latência por estágio do pipeline (replay, benchmark, sinks).
+"""
+
+import time
+from array import array
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict
+
+
+class LatencyRecorder:
+    """Acumula latências (em segundos) por estágio e calcula percentis"""
+
+    def __init__(self) -> None:
+        self._samples: Dict[str, array] = defaultdict(lambda: array('d'))
+
+    def record(self, stage: str, seconds: float) -> None:
+        self._samples[stage].append(seconds)
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._samples[stage].append(time.perf_counter() - start)
+
+    def count(self, stage: str) -> int:
+        return len(self._samples.get(stage, ()))
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Retorna {estágio: {count, mean_ms, p50_ms, p99_ms, max_ms}}"""
+        result = {}
+        for stage, samples in self._samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            n = len(ordered)
+            result[stage] = {
+                'count': n,
+                'mean_ms': sum(ordered) / n * 1000,
+                'p50_ms': ordered[min(n - 1, int(n * 0.50))] * 1000,
+                'p99_ms': ordered[min(n - 1, int(n * 0.99))] * 1000,
+                'max_ms': ordered[-1] * 1000,
+            }
+        return result
+
+    def format_summary(self) -> str:
+        lines = [f"{'estágio':<24}{'n':>10}{'média ms':>12}{'p50 ms':>10}{'p99 ms':>10}{'máx ms':>10}"]
+        for stage, stats in self.summary().items():
+            lines.append(f"{stage:<24}{stats['count']:>10}{stats['mean_ms']:>12.3f}"
+                         f"{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['max_ms']:>10.3f}")
+        return '\n'.join(lines)
@@ -9,8 +9,19 @@ Características:
 - Detecção de conexão via lastTX
 - Notificações de recuperação
 - Rate limiting de segurança
+
+Detecção de notificações removidas pelo usuário:
+- Polling: a cada polling_interval_minutes, um get() de <device>/NOTIFICATIONS para cada
+  device com notificações ativas (baixa a lista inteira de cada um).
+- Listener: um listen() em <device>/NOTIFICATIONS enquanto o device tem notificações ativas;
+  a remoção chega como evento em segundos e o custo acompanha as mudanças, não o tamanho
+  da frota. Não há um stream único para todos os devices: o SDK não escuta caminhos com
+  curinga, e o listen() na raiz traria a árvore inteira e cada escrita em REALTIME. Cada
+  listen() é uma conexão HTTP e uma thread do SDK, então no máximo listener_max_devices
+  ficam abertos; os demais devices continuam no polling.
 """
 
+import heapq
 import json
 import os
 import uuid
@@ -23,6 +34,12 @@ import time
 from logger_config import setup_logger
 
 
+# Campo do message_dict com o lastTX anterior ao pacote, lido pelo processor antes de despachar
+# para os sinks: o sink do Realtime DB grava o lastTX do pacote em paralelo com a verificação
+# de conexão, que precisa do valor anterior
+PREVIOUS_LAST_TX_FIELD = 'previous_last_tx'
+
+
 class NotificationMode(Enum):
     LISTENER = "listener"
     POLLING = "polling"
@@ -41,6 +58,7 @@ class NotificationConfig:
     # Modo de operação
     mode: NotificationMode = NotificationMode.POLLING
     polling_interval_minutes: int = 10
+    listener_max_devices: int = 200  # listen() abertos ao mesmo tempo no modo listener
     
     # Conexão/LastTX
     connection_timeout_hours: float = 1.0
@@ -100,6 +118,7 @@ class NotificationHandler:
         self.config = config or NotificationConfig()
         self.realtime_db = realtime_db
         self.message_processor = message_processor
+        self.rtdb_shadow = None  # RealtimeShadow do processor: lastTX sem ler o banco
         self.logger = setup_logger(__name__)
         
         # Cache de estados dos dispositivos
@@ -110,6 +129,16 @@ class NotificationHandler:
         self._polling_thread = None
         self._listener_thread = None
         self._grouping_thread = None
+        self._listeners_changed = threading.Event()  # Acorda o listener worker (nova notificação, stop)
+        
+        # Agrupamento: heap de (prazo em time.monotonic(), device_id), um por grupo pendente
+        self._group_deadlines: List[tuple] = []
+        self._grouping_condition = threading.Condition()  # Protege o heap e os pending_notifications
+        
+        # Listeners do modo listener: device_id -> ListenerRegistration de <device>/NOTIFICATIONS
+        self._listeners: Dict[str, Any] = {}
+        self._listen_failed_at: Dict[str, float] = {}  # device_id -> time.monotonic() da última falha
+        self._listeners_lock = threading.Lock()
         
         # Cache de notificações ativas (para detecção de remoção)
         self.active_notifications_cache: Dict[str, Dict[str, Any]] = {}  # device_id -> {notification_id: data}
@@ -132,6 +161,8 @@ class NotificationHandler:
                     self.config.mode = NotificationMode(config_data['mode'])
                 if 'polling_interval_minutes' in config_data:
                     self.config.polling_interval_minutes = config_data['polling_interval_minutes']
+                if 'listener_max_devices' in config_data:
+                    self.config.listener_max_devices = config_data['listener_max_devices']
                 if 'connection_timeout_hours' in config_data:
                     self.config.connection_timeout_hours = config_data['connection_timeout_hours']
                 if 'connection_check_enabled' in config_data:
@@ -164,6 +195,7 @@ class NotificationHandler:
             config_data = {
                 'mode': self.config.mode.value,
                 'polling_interval_minutes': self.config.polling_interval_minutes,
+                'listener_max_devices': self.config.listener_max_devices,
                 'connection_timeout_hours': self.config.connection_timeout_hours,
                 'connection_check_enabled': self.config.connection_check_enabled,
                 'max_notifications_per_device_per_hour': self.config.max_notifications_per_device_per_hour,
@@ -187,6 +219,8 @@ class NotificationHandler:
             self.logger.error("Realtime Database not configured")
             return
         
+        self._stop_event.clear()  # Permite reiniciar depois de stop() (toggle_mode)
+        
         # Iniciar thread de agrupamento
         self._grouping_thread = threading.Thread(target=self._grouping_worker, daemon=True)
         self._grouping_thread.start()
@@ -201,12 +235,16 @@ class NotificationHandler:
     def stop(self):
         """Para o handler de notificações"""
         self._stop_event.set()
+        self._listeners_changed.set()
+        with self._grouping_condition:
+            self._grouping_condition.notify_all()
         if self._polling_thread:
             self._polling_thread.join(timeout=5)
         if self._listener_thread:
             self._listener_thread.join(timeout=5)
         if self._grouping_thread:
             self._grouping_thread.join(timeout=5)
+        self._close_listeners()
         
         self.logger.info("NotificationHandler parado")
     
@@ -227,44 +265,133 @@ class NotificationHandler:
         while not self._stop_event.is_set():
             try:
                 self._check_notification_removals()
-                time.sleep(self.config.polling_interval_minutes * 60)
+                self._stop_event.wait(self.config.polling_interval_minutes * 60)
             except Exception as e:
                 self.logger.error(f"Error in polling worker: {e}")
                 time.sleep(30)  # Espera 30s antes de tentar novamente
     
     def _listener_worker(self):
-        """Worker para modo listener"""
-        # TODO: Implementar Firebase listener
-        # Por enquanto, fazer polling mais frequente como fallback
-        self.logger.warning("Listener mode not implemented yet, using fast polling as fallback")
+        """Worker para modo listener: abre/fecha os listen() e faz polling só dos devices sem listener"""
+        polling_interval = self.config.polling_interval_minutes * 60
+        last_poll = time.monotonic()
         while not self._stop_event.is_set():
             try:
-                self._check_notification_removals()
-                time.sleep(60)  # Check a cada minuto no modo listener
+                self._sync_listeners()
+                if time.monotonic() - last_poll >= polling_interval:
+                    last_poll = time.monotonic()
+                    with self._listeners_lock:
+                        listened = set(self._listeners)
+                    unlistened = [d for d in list(self.active_notifications_cache) if d not in listened]
+                    if unlistened:
+                        self._check_notification_removals(unlistened)
             except Exception as e:
                 self.logger.error(f"Error in listener worker: {e}")
-                time.sleep(30)
+            # Acorda ao enviar uma notificação ou no stop(); o timeout cobre remoções do cache
+            self._listeners_changed.wait(timeout=5)
+            self._listeners_changed.clear()
+        self._close_listeners()
+    
+    def _sync_listeners(self):
+        """Um listen() por device com notificações ativas (até listener_max_devices)"""
+        active = [d for d, notifications in list(self.active_notifications_cache.items()) if notifications]
+        active_set = set(active)
+        with self._listeners_lock:
+            idle = [d for d in self._listeners if d not in active_set]
+            to_close = [self._listeners.pop(d) for d in idle]
+            to_open = [d for d in active if d not in self._listeners]
+        for registration in to_close:
+            self._close_registration(registration)
+        
+        retry_after = self.config.polling_interval_minutes * 60
+        for device_id in to_open:
+            with self._listeners_lock:
+                if len(self._listeners) >= self.config.listener_max_devices:
+                    break
+            failed_at = self._listen_failed_at.get(device_id)
+            if failed_at is not None and time.monotonic() - failed_at < retry_after:
+                continue
+            try:
+                registration = self.realtime_db.child(f"{device_id}/NOTIFICATIONS").listen(
+                    lambda event, device_id=device_id: self._on_notifications_event(device_id, event))
+            except Exception as e:
+                # Fica no polling até a próxima tentativa
+                self._listen_failed_at[device_id] = time.monotonic()
+                self.logger.error(f"Error listening to {device_id}/NOTIFICATIONS: {e}")
+                continue
+            self._listen_failed_at.pop(device_id, None)
+            with self._listeners_lock:
+                self._listeners[device_id] = registration
+    
+    def _close_listeners(self):
+        with self._listeners_lock:
+            registrations = list(self._listeners.values())
+            self._listeners.clear()
+        for registration in registrations:
+            self._close_registration(registration)
+    
+    def _close_registration(self, registration):
+        try:
+            registration.close()
+        except Exception as e:
+            self.logger.error(f"Error closing notification listener: {e}")
+    
+    def _on_notifications_event(self, equipment_id: str, event):
+        """Evento do listen() em <device>/NOTIFICATIONS: put/patch com None em uma notificação = removida"""
+        try:
+            cached = self.active_notifications_cache.get(equipment_id)
+            if not cached:
+                return
+            base = [part for part in event.path.split('/') if part]
+            if event.event_type == 'put':
+                changes = [(base, event.data)]
+            elif event.event_type == 'patch':
+                changes = [(base + [part for part in key.split('/') if part], value)
+                           for key, value in (event.data or {}).items()]
+            else:
+                return
+            
+            removed_ids = set()
+            for parts, value in changes:
+                if not parts:
+                    # Primeiro evento, reconexão ou lista substituída: o nó inteiro
+                    current = value if isinstance(value, dict) else {}
+                    removed_ids.update(set(list(cached)) - set(current))
+                elif len(parts) == 1 and value is None:
+                    removed_ids.add(parts[0])
+            self._remove_cached_notifications(equipment_id, removed_ids)
+        except Exception as e:
+            self.logger.error(f"Error processing notification event for {equipment_id}: {e}")
     
     def _grouping_worker(self):
-        """Worker para agrupar notificações pendentes"""
+        """Worker para agrupar notificações pendentes: dorme até o próximo prazo do heap"""
         while not self._stop_event.is_set():
             try:
-                current_time = datetime.now(timezone.utc)
-                for device_id, device_status in self.device_cache.items():
-                    if device_status.pending_notifications:
-                        # Verificar se há notificações pendentes antigas o suficiente para enviar
-                        oldest_notification = min(device_status.pending_notifications, 
-                                                key=lambda x: x.get('created_at', current_time))
-                        time_since_oldest = (current_time - oldest_notification.get('created_at', current_time)).total_seconds()
-                        
-                        if time_since_oldest >= self.config.max_group_delay_seconds:
-                            self._send_grouped_notifications(device_id)
-                
-                time.sleep(5)  # Check a cada 5 segundos
+                with self._grouping_condition:
+                    if not self._group_deadlines:
+                        self._grouping_condition.wait()  # Acordado por um grupo novo ou pelo stop()
+                        continue
+                    deadline, device_id = self._group_deadlines[0]
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        self._grouping_condition.wait(timeout=remaining)
+                        continue
+                    heapq.heappop(self._group_deadlines)
+                self._send_grouped_notifications(device_id)
             except Exception as e:
                 self.logger.error(f"Error in grouping worker: {e}")
                 time.sleep(10)
     
+    def _add_pending_notifications(self, equipment_id: str, notifications: List[Dict[str, Any]]):
+        """Acrescenta ao grupo do device; o primeiro pendente agenda o envio em max_group_delay_seconds"""
+        device_status = self.device_cache[equipment_id]
+        with self._grouping_condition:
+            starts_group = not device_status.pending_notifications
+            device_status.pending_notifications.extend(notifications)
+            if starts_group:
+                deadline = time.monotonic() + self.config.max_group_delay_seconds
+                heapq.heappush(self._group_deadlines, (deadline, equipment_id))
+                self._grouping_condition.notify()
+    
     def process_mqtt_data(self, equipment_id: str, message_dict: Dict[str, Any]):
         """
         Processa dados MQTT e gera notificações se necessário
@@ -327,7 +454,7 @@ class NotificationHandler:
                 # Adicionar timestamp de criação
                 for notif in notifications_to_add:
                     notif['created_at'] = datetime.now(timezone.utc)
-                device_status.pending_notifications.extend(notifications_to_add)
+                self._add_pending_notifications(equipment_id, notifications_to_add)
             else:
                 # Enviar imediatamente
                 for notification in notifications_to_add:
@@ -391,16 +518,28 @@ class NotificationHandler:
             "view_status": "unread"
         }
     
+    def read_last_tx(self, equipment_id: str) -> Optional[int]:
+        """lastTX atual do equipamento (sombra local ou Realtime Database), ou None"""
+        if self.rtdb_shadow:
+            device_data = self.rtdb_shadow.get(equipment_id, 'STATUS')
+        else:
+            device_data = self.realtime_db.child(equipment_id).child('STATUS').get()
+        if not device_data or 'lastTX' not in device_data:
+            return None
+        return int(device_data['lastTX'])
+    
     def _check_connection_status(self, equipment_id: str, message_dict: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Verifica status de conexão baseado em lastTX"""
         
-        # Obter lastTX do Realtime Database (não dos dados MQTT)
+        # Obter lastTX do Realtime Database (não dos dados MQTT); o anterior ao pacote, se o processor o leu
         try:
-            device_data = self.realtime_db.child(equipment_id).child('STATUS').get()
-            if not device_data or 'lastTX' not in device_data:
+            if PREVIOUS_LAST_TX_FIELD in message_dict:
+                last_tx_epoch = message_dict[PREVIOUS_LAST_TX_FIELD]
+            else:
+                last_tx_epoch = self.read_last_tx(equipment_id)
+            if last_tx_epoch is None:
                 return None
             
-            last_tx_epoch = int(device_data['lastTX'])
             last_tx_time = datetime.fromtimestamp(last_tx_epoch, tz=timezone.utc)
             current_time = datetime.now(timezone.utc)
             
@@ -528,11 +667,14 @@ class NotificationHandler:
     def _send_grouped_notifications(self, equipment_id: str):
         """Envia notificações agrupadas para um dispositivo"""
         device_status = self.device_cache.get(equipment_id)
-        if not device_status or not device_status.pending_notifications:
+        if not device_status:
             return
         
-        notifications = device_status.pending_notifications.copy()
-        device_status.pending_notifications.clear()
+        with self._grouping_condition:
+            notifications = device_status.pending_notifications.copy()
+            device_status.pending_notifications.clear()
+        if not notifications:
+            return
         
         if len(notifications) == 1:
             # Apenas uma notificação, enviar normalmente
@@ -598,6 +740,7 @@ class NotificationHandler:
             if equipment_id not in self.active_notifications_cache:
                 self.active_notifications_cache[equipment_id] = {}
             self.active_notifications_cache[equipment_id][notification_id] = notification_to_send
+            self._listeners_changed.set()
             
             self.logger.info(f"Notificação enviada para {equipment_id}: {notification['type']} - {notification['message']}")
             
@@ -621,28 +764,22 @@ class NotificationHandler:
         else:
             return data
     
-    def _check_notification_removals(self):
-        """Checks if notifications were removed by user (polling/listener)"""
+    def _check_notification_removals(self, equipment_ids: List[str] = None):
+        """Checks if notifications were removed by user (polling; devices sem listener no modo listener)"""
         
         if not self.realtime_db:
             return
         
         try:
-            for equipment_id in self.active_notifications_cache.keys():
+            for equipment_id in equipment_ids if equipment_ids is not None else list(self.active_notifications_cache):
                 try:
                     # Buscar notificações atuais no Realtime Database
                     current_notifications = self.realtime_db.child(f"{equipment_id}/NOTIFICATIONS").get() or {}
                     current_ids = set(current_notifications.keys())
-                    cached_ids = set(self.active_notifications_cache[equipment_id].keys())
+                    cached_ids = set(list(self.active_notifications_cache.get(equipment_id, {})))
                     
                     # Identificar notificações removidas
-                    removed_ids = cached_ids - current_ids
-                    
-                    for removed_id in removed_ids:
-                        removed_notification = self.active_notifications_cache[equipment_id].pop(removed_id, None)
-                        if removed_notification:
-                            self.logger.info(f"Notification removed by user: {equipment_id}/{removed_id}")
-                            # Here can implement additional logic when notification is removed
+                    self._remove_cached_notifications(equipment_id, cached_ids - current_ids)
                 
                 except Exception as e:
                     self.logger.error(f"Error checking removals for {equipment_id}: {e}")
@@ -650,6 +787,15 @@ class NotificationHandler:
         except Exception as e:
             self.logger.error(f"General error checking notification removals: {e}")
     
+    def _remove_cached_notifications(self, equipment_id: str, removed_ids):
+        """Tira do cache as notificações que o usuário removeu"""
+        cached = self.active_notifications_cache.get(equipment_id, {})
+        for removed_id in removed_ids:
+            removed_notification = cached.pop(removed_id, None)
+            if removed_notification:
+                self.logger.info(f"Notification removed by user: {equipment_id}/{removed_id}")
+                # Here can implement additional logic when notification is removed
+    
     def get_status_summary(self) -> Dict[str, Any]:
         """Retorna resumo do status do sistema de notificações"""
         return {
@@ -657,6 +803,8 @@ class NotificationHandler:
             "devices_monitored": len(self.device_cache),
             "total_active_notifications": sum(len(notifs) for notifs in self.active_notifications_cache.values()),
             "polling_interval_minutes": self.config.polling_interval_minutes,
+            "active_listeners": len(self._listeners),
+            "pending_groups": len(self._group_deadlines),
             "connection_timeout_hours": self.config.connection_timeout_hours,
             "last_check": datetime.now(timezone.utc).isoformat()
         }
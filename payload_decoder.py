@@ -0,0 +1,311 @@
+"""
+Decodificador compilado dos pacotes hexadecimais enviados pelos beacons LN2.
+
+O schema de `MessageProcessor._load_schema` é compilado uma única vez: todos os
+campos numéricos de largura fixa são lidos com um único `struct.Struct` sobre os
+bytes do pacote e cada campo recebe um conversor escolhido antecipadamente.
+O resultado é idêntico ao do parser original, campo a campo.
+"""
+
+import struct
+import time
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Formatos struct sem sinal por largura do campo (em bytes)
+_UNSIGNED_FORMATS = {1: 'B', 2: 'H', 4: 'I'}
+
+
+def _twos_comp(val, bits):
+    """compute the 2's complement of int value val"""
+    if (val & (1 << (bits - 1))) != 0:
+        val = val - (1 << bits)
+    return val
+
+
+_day_prefix_cache: Dict[int, str] = {}
+_time_of_day_cache: Dict[int, str] = {}  # No máximo 86400 entradas
+
+
+def _format_epoch(epoch: int) -> str:
+    """Mesmo formato de datetime.strftime("%Y-%m-%d %H-%M-%S.%f")[:-3] para epochs inteiros"""
+    day, seconds = divmod(epoch, 86400)
+    prefix = _day_prefix_cache.get(day)
+    if prefix is None:
+        prefix = _day_prefix_cache[day] = time.strftime("%Y-%m-%d ", time.gmtime(day * 86400))
+    time_of_day = _time_of_day_cache.get(seconds)
+    if time_of_day is None:
+        time_of_day = _time_of_day_cache[seconds] = "%02d-%02d-%02d.000" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return prefix + time_of_day
+
+
+def _field_kind(name: str) -> str:
+    """Classifica o campo seguindo a mesma ordem de testes do parser original"""
+    if name in ('temp_pt100', 'temp_ambient'):
+        return 'temp'
+    if name in ('vbat_mv', 'angle_to_horizontal'):
+        return 'uint16'
+    if 'rssi' in name:
+        return 'rssi'
+    if 'epochtime' in name:
+        return 'epochtime'
+    if 'package_id' in name:
+        return 'package_id'
+    if 'vccbat' in name:
+        return 'vccbat'
+    if 'tempa' in name:
+        return 'tempa'
+    if name.endswith('Status') or 'status' in name.lower():
+        return 'status'
+    return 'raw'
+
+
+_hex_table = None
+
+
+def _hex_lookup(np):
+    """Tabela byte ASCII -> valor do nibble (0xFF para caracteres não-hex)"""
+    global _hex_table
+    if _hex_table is None:
+        table = np.full(256, 0xFF, dtype=np.uint8)
+        for i, c in enumerate('0123456789ABCDEF'):
+            table[ord(c)] = i
+            table[ord(c.lower())] = i
+        _hex_table = table
+    return _hex_table
+
+
+class PayloadDecoder:
+    """
+    Decodificador de pacotes gerado a partir do schema de campos.
+
+    `decode` executa uma função gerada em `_compile`, que converte o pacote para
+    bytes uma única vez e desempacota todos os campos numéricos em uma só chamada
+    de `struct.unpack`, montando o dict diretamente. Pacotes curtos ou
+    com caracteres inválidos usam o caminho campo a campo (`decode_legacy`),
+    que preserva exatamente o comportamento anterior.
+    """
+
+    def __init__(self, schema: List[dict], status_comment: Callable[[int], str]) -> None:
+        self.schema = schema
+        self._status_comment = status_comment
+        # Tabela de rótulos para status de 1 byte (valor bruto 0..255 -> "4 - Good")
+        self._status_table = tuple(self._status_label(raw) for raw in range(256))
+        self._status_cache: Dict[int, str] = {}
+        self._legacy_plan = [(field['name'], slice(field['start_idx'], field['end_idx']),
+                              self._legacy_converter(field['name'])) for field in schema]
+        self._compile()
+
+    def _status_label(self, raw: int) -> str:
+        # Ajusta para signed se necessário (assume 8 bits), como no parser original
+        if raw >= 0x80:
+            raw -= 0x100
+        return self._status_comment(raw)
+
+    def _cached_status_label(self, raw: int) -> str:
+        label = self._status_cache.get(raw)
+        if label is None:
+            label = self._status_cache[raw] = self._status_label(raw)
+        return label
+
+    def _compile(self) -> None:
+        """Gera a função de decodificação a partir do schema (struct único + conversores)"""
+        numeric = []  # (start_byte, width, name, fmt, expressão de conversão)
+        for field in self.schema:
+            name, start, end = field['name'], field['start_idx'], field['end_idx']
+            if start % 2 or (end - start) % 2:
+                continue
+            compiled = self._numeric_converter(name, (end - start) // 2)
+            if compiled is not None:
+                numeric.append((start // 2, (end - start) // 2, name, compiled[0], compiled[1]))
+
+        # Campos numéricos sobrepostos não cabem em um único struct sequencial
+        numeric.sort(key=lambda item: item[0])
+        fmt = '>'
+        offset = 0
+        struct_fields = {}
+        for start, width, name, field_fmt, expression in numeric:
+            if start < offset or name in struct_fields:
+                continue
+            if start > offset:
+                fmt += f'{start - offset}x'
+            fmt += field_fmt
+            struct_fields[name] = expression.format(f'nums[{len(struct_fields)}]')
+            offset = start + width
+
+        self._struct = struct.Struct(fmt)
+        self._min_length = max([field['end_idx'] for field in self.schema] + [offset * 2])
+        if self._min_length % 2:
+            self._min_length += 1
+
+        namespace = {
+            '_unpack': self._struct.unpack,
+            '_fromhex': bytes.fromhex,
+            '_format_epoch': _format_epoch,
+            '_status_table': self._status_table,
+            '_status_label': self._cached_status_label,
+        }
+        lines = [
+            'def decode(hex_string):',
+            f'    nums = _unpack(_fromhex(hex_string[:{self._min_length}]))',
+            '    return {',
+        ]
+        for i, (name, field_slice, legacy_converter) in enumerate(self._legacy_plan):
+            if name in struct_fields:
+                value = struct_fields[name]
+            else:
+                value = f'hex_string[{field_slice.start}:{field_slice.stop}]'
+                if legacy_converter is not None:
+                    namespace[f'_legacy_{i}'] = legacy_converter
+                    value = f'_legacy_{i}({value})'
+            lines.append(f'        {name!r}: {value},')
+        lines.append('    }')
+        exec(compile('\n'.join(lines), f'<PayloadDecoder {len(self.schema)} campos>', 'exec'), namespace)
+        self._decode_compiled = namespace['decode']
+
+    def _numeric_converter(self, name: str, width: int):
+        """Retorna (formato struct, expressão de conversão) ou None se o campo deve ser lido como texto"""
+        kind = _field_kind(name)
+        if kind == 'temp':
+            return ('h', '{} / 100') if width == 2 else None
+        if kind == 'uint16':
+            return ('H', '{}') if width == 2 else None
+        if kind == 'rssi':
+            return ('b', '{}') if width == 1 else None
+        if kind == 'epochtime':
+            return ('I', '_format_epoch({})') if width == 4 else None
+        if width not in _UNSIGNED_FORMATS:
+            return None
+        fmt = _UNSIGNED_FORMATS[width]
+        if kind == 'package_id':
+            return (fmt, '{}')
+        if kind == 'vccbat':
+            return (fmt, '{} / 1000')
+        if kind == 'tempa':
+            return (fmt, '{} / 100')
+        if kind == 'status':
+            return (fmt, '_status_table[{}]' if width == 1 else '_status_label({})')
+        return None
+
+    def _legacy_converter(self, name: str) -> Optional[Callable[[str], object]]:
+        """Conversor texto -> valor idêntico ao if/elif do parser original"""
+        kind = _field_kind(name)
+        if kind == 'temp':
+            def convert(v):
+                # Interpretar como int16_t em centésimos de grau Celsius
+                try:
+                    return struct.unpack('>h', bytes.fromhex(v))[0] / 100
+                except Exception:
+                    return v  # fallback para depuração se falhar
+            return convert
+        if kind == 'uint16':
+            return lambda v: struct.unpack('>H', bytes.fromhex(v))[0]
+        if kind == 'rssi':
+            return lambda v: _twos_comp(int(v, 16), 8)
+        if kind == 'epochtime':
+            return lambda v: datetime.fromtimestamp(int(v, 16), tz=timezone.utc).strftime("%Y-%m-%d %H-%M-%S.%f")[:-3]
+        if kind == 'package_id':
+            return lambda v: int(v, 16)
+        if kind == 'vccbat':
+            return lambda v: int(v, 16) / 1000
+        if kind == 'tempa':
+            return lambda v: int(v, 16) / 100
+        if kind == 'status':
+            def convert(v):
+                try:
+                    return self._status_label(int(v, 16))
+                except Exception:
+                    return v
+            return convert
+        return None
+
+    def decode(self, hex_string: str) -> dict:
+        """Decodifica um pacote hexadecimal em um dict com os campos do schema"""
+        if len(hex_string) >= self._min_length:
+            try:
+                return self._decode_compiled(hex_string)
+            except (ValueError, struct.error):
+                # Caracteres não-hex, ou espaços (bytes.fromhex os ignora e o tamanho não fecha)
+                pass
+        return self.decode_legacy(hex_string)
+
+    def decode_batch(self, hex_payloads: Sequence[str]) -> Dict[str, "np.ndarray"]:
+        """
+        Decodifica N pacotes de uma vez em colunas NumPy, uma por campo do schema.
+
+        Campos numéricos são desempacotados de forma vetorizada (int16/uint16
+        big-endian, rssi em complemento de 2); temperaturas e tempa viram float64,
+        epochtimes viram datetime64[s] e status viram códigos int16 acompanhados de
+        uma coluna `<campo>_label` ("4 - Good") obtida por tabela de consulta.
+        Campos de texto (r1..r11, crc, beacon_serial...) viram arrays de bytes
+        (dtype S), que podem ser convertidos com `.astype(str)` quando necessário.
+
+        Pacotes curtos ou com caracteres não-hex são ignorados; a coluna
+        `row_index` indica a posição na entrada de cada linha decodificada.
+        """
+        import numpy as np
+
+        ml = self._min_length
+        rows = np.array([i for i, payload in enumerate(hex_payloads) if len(payload) >= ml], dtype=np.int64)
+        text = ''.join([hex_payloads[i][:ml] for i in rows])
+        chars = np.frombuffer(text.encode('ascii', 'replace'), dtype=np.uint8).reshape(len(rows), ml)
+        try:
+            data = np.frombuffer(bytes.fromhex(text), dtype=np.uint8)
+            if data.size * 2 != chars.size:
+                raise ValueError("espaços no pacote")
+            data = data.reshape(len(rows), ml // 2)
+        except ValueError:
+            # Há linhas inválidas: conversão hex -> nibble por tabela (0xFF marca caractere inválido)
+            nibbles = _hex_lookup(np)[chars]
+            valid = (nibbles != 0xFF).all(axis=1)
+            rows, chars, nibbles = rows[valid], chars[valid], nibbles[valid]
+            data = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+
+        columns = {'row_index': rows}
+        for name, start, end in [(f['name'], f['start_idx'], f['end_idx']) for f in self.schema]:
+            kind = _field_kind(name)
+            width = (end - start) // 2
+            compiled = (start % 2 == 0 and (end - start) % 2 == 0
+                        and self._numeric_converter(name, width) is not None)
+            if not compiled:
+                text_column = np.ascontiguousarray(chars[:, start:end]).view(f'S{end - start}').ravel()
+                convert = next(c for n, _, c in self._legacy_plan if n == name)
+                if convert is not None:
+                    text_column = np.array([convert(v.decode()) for v in text_column.tolist()], dtype=object)
+                columns[name] = text_column
+                continue
+
+            field_bytes = np.ascontiguousarray(data[:, start // 2:start // 2 + width])
+            unsigned = field_bytes.view(f'>u{width}').ravel().astype(f'u{width}')
+            if kind == 'temp':
+                columns[name] = field_bytes.view('>i2').ravel().astype(np.float64) / 100
+            elif kind == 'rssi':
+                columns[name] = unsigned.view(np.int8)
+            elif kind == 'epochtime':
+                columns[name] = unsigned.astype('datetime64[s]')
+            elif kind == 'vccbat':
+                columns[name] = unsigned / 1000
+            elif kind == 'tempa':
+                columns[name] = unsigned / 100
+            elif kind == 'status':
+                codes = unsigned.astype(np.int32)
+                codes = np.where(codes >= 0x80, codes - 0x100, codes)
+                columns[name] = codes.astype(np.int16) if width <= 2 else codes
+                if width == 1:
+                    columns[f'{name}_label'] = np.array(self._status_table, dtype=object)[unsigned]
+                else:
+                    uniques, inverse = np.unique(unsigned, return_inverse=True)
+                    labels = np.array([self._cached_status_label(int(v)) for v in uniques], dtype=object)
+                    columns[f'{name}_label'] = labels[inverse.ravel()]
+            else:
+                columns[name] = unsigned
+        return columns
+
+    def decode_legacy(self, hex_string: str) -> dict:
+        """Caminho campo a campo, usado para pacotes curtos ou malformados"""
+        values = {name: hex_string[field_slice] for name, field_slice, _ in self._legacy_plan}
+        converters = {name: convert for name, _, convert in self._legacy_plan}
+        return {k: (converters[k](v) if converters[k] is not None else v) for k, v in values.items()}
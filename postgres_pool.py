@@ -0,0 +1,143 @@
+"""
+Pool de conexões com o Postgres (Cloud SQL) com verificação de saúde e reconexão.
+
+- conexões abertas sob demanda (psycopg2.pool.ThreadedConnectionPool), com TCP keepalive
+- conexão parada há mais de postgres.health_check_interval_s é testada com SELECT 1 antes do uso
+- conexão que falhou é descartada do pool em vez de devolvida
+- `run_transaction` repete a transação em erros transitórios (queda de conexão, banco
+  reiniciando), com espera exponencial entre as tentativas
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import yaml
+from psycopg2.pool import ThreadedConnectionPool
+
+from logger_config import setup_logger
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('postgres') or {}
+POOL_MIN_CONNECTIONS = int(config.get('pool_min_connections', 1))
+POOL_MAX_CONNECTIONS = int(config.get('pool_max_connections', 4))
+HEALTH_CHECK_INTERVAL_S = float(config.get('health_check_interval_s', 30))
+MAX_RETRIES = int(config.get('max_retries', 10))
+RETRY_BACKOFF_S = float(config.get('retry_backoff_s', 0.5))
+RETRY_BACKOFF_MAX_S = float(config.get('retry_backoff_max_s', 30))
+
+# Detecta conexões mortas (NAT/Cloud SQL derrubando TCP ocioso) sem esperar o timeout do SO
+CONNECTION_OPTIONS = {
+    "connect_timeout": 10,
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 3,
+}
+
+# Erros em que a conexão (e não os dados) é o problema: vale reconectar e repetir
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class PostgresConnectionPool:
+    def __init__(self, db_config: dict, min_connections: int = POOL_MIN_CONNECTIONS,
+                 max_connections: int = POOL_MAX_CONNECTIONS,
+                 health_check_interval_s: float = HEALTH_CHECK_INTERVAL_S) -> None:
+        self.db_config = {**CONNECTION_OPTIONS, **db_config}
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.health_check_interval_s = health_check_interval_s
+        self.logger = setup_logger(__name__)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)  # getconn do psycopg2 não espera, falha
+        self._last_used = {}  # id(conn) -> monotonic do último uso bem-sucedido
+        self.reconnects = 0
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        with self._pool_lock:
+            if self._pool is None:
+                # minconn conexões são abertas aqui; se o banco estiver fora, o erro sobe e a próxima chamada tenta de novo
+                self._pool = ThreadedConnectionPool(self.min_connections, self.max_connections, **self.db_config)
+                self.logger.info(f"Pool PostgreSQL criado ({self.min_connections}-{self.max_connections} conexões)")
+            return self._pool
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval_s:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            self.logger.warning(f"Conexão PostgreSQL inválida, descartando: {e}")
+            return False
+
+    @contextmanager
+    def connection(self):
+        """Empresta uma conexão saudável; em erro transitório ela é descartada do pool"""
+        self._slots.acquire()
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            while not self._is_healthy(conn):
+                self._discard(pool, conn)
+                self.reconnects += 1
+                conn = pool.getconn()
+            try:
+                yield conn
+            except TRANSIENT_ERRORS:
+                self._discard(pool, conn)
+                raise
+            except Exception:
+                try:
+                    conn.rollback()
+                    pool.putconn(conn)
+                except Exception:
+                    self._discard(pool, conn)
+                raise
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    def _discard(self, pool, conn) -> None:
+        self._last_used.pop(id(conn), None)
+        try:
+            pool.putconn(conn, close=True)
+        except Exception:
+            pass
+
+    def run_transaction(self, work, max_retries: int = MAX_RETRIES, description: str = "transação"):
+        """
+        Executa work(conn) e faz commit. Em erro transitório reconecta e repete até
+        max_retries vezes (espera exponencial); outros erros sobem na hora.
+        """
+        delay = RETRY_BACKOFF_S
+        for attempt in range(max_retries + 1):
+            try:
+                with self.connection() as conn:
+                    result = work(conn)
+                    conn.commit()
+                    return result
+            except TRANSIENT_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                self.logger.warning(f"Falha transitória em {description} (tentativa {attempt + 1}/{max_retries}): {e}; "
+                                    f"nova tentativa em {delay:.1f} s")
+                time.sleep(delay)
+                delay = min(delay * 2, RETRY_BACKOFF_MAX_S)
+
+    def close(self) -> None:
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self.logger.info("Conexões PostgreSQL fechadas")
@@ -0,0 +1,372 @@
+"""
+Escrita em lote na tabela mqtt_messages.
+
+As linhas são montadas com a lista de colunas pré-computada e acumuladas em memória.
+Threads de escrita gravam o lote com `execute_values` (um único INSERT ... VALUES
+com várias linhas) e um commit por lote, quando o lote chega a postgres.batch_size
+linhas ou quando a linha mais antiga espera postgres.flush_interval_ms. As conexões
+vêm do PostgresConnectionPool (reconexão e repetição em erros transitórios).
+
+Formatos de armazenamento (postgres.storage):
+    text     colunas como na tabela original: campos hex, rótulos de status ("4 - Good")
+             e epochs formatados como texto
+    compact  campos hex como inteiros, status como o código (smallint), versão de
+             firmware em um único inteiro, epochs como timestamptz e original_payload
+             como bytea (metade do tamanho do hex). Ver COMPACT_LAYOUT
+"""
+
+import math
+import threading
+import time
+from datetime import datetime, timezone
+
+import yaml
+from psycopg2.extras import execute_values
+
+from logger_config import setup_logger
+from postgres_pool import TRANSIENT_ERRORS
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('postgres') or {}
+BATCH_SIZE = int(config.get('batch_size', 500))
+FLUSH_INTERVAL_MS = int(config.get('flush_interval_ms', 1000))
+MAX_PENDING_ROWS = int(config.get('max_pending_rows', 50000))
+WRITER_THREADS = int(config.get('writer_threads', 2))
+STORAGE = config.get('storage', 'text')
+
+STORAGE_MODES = ('text', 'compact')
+
+
+def safe_float(val):
+    try:
+        if val is None or (isinstance(val, float) and math.isnan(val)):
+            return None
+        return float(val)
+    except Exception:
+        return None
+
+
+def safe_int(val):
+    try:
+        if val is None or (isinstance(val, float) and math.isnan(val)):
+            return None
+        return int(val)
+    except Exception:
+        return None
+
+
+# Colunas de mqtt_messages na ordem do INSERT (topic vem do argumento, as demais do message_dict)
+MESSAGE_COLUMNS = (
+    "topic", "start_flag", "package_type", "beacon_serial", "epochtime_b", "epochtime_btx", "epochtime_g",
+    "crc", "package_id", "tempa",
+    "r1", "r2", "r3", "r4", "r5", "r6", "r7", "r8", "r9", "r10", "r11",
+    "sensor_data_def_id", "fw_version_prefix", "fw_version_major", "fw_version_minor", "fw_version_patch",
+    "fw_version_build", "acc_mode_full", "ton_toff", "ln2_level_status", "ln2_angle_status",
+    "ln2_battery_status", "batt_percent", "ln2_foam_status", "ln2_general_status", "status_osc_cnt",
+    "ln2_acc_data_available", "ln2_tx_cause_status", "temp_pt100", "temp_ambient", "angle_to_horizontal",
+    "vbat_mv", "factory_serial", "ln2vibration", "ln2vibrationstatus", "rssi", "original_payload",
+)
+COLUMN_CONVERTERS = {
+    "package_id": safe_int,
+    "tempa": safe_float,
+    "temp_pt100": safe_float,
+    "temp_ambient": safe_float,
+    "angle_to_horizontal": safe_float,
+    "vbat_mv": safe_float,
+    "rssi": safe_int,
+}
+_FIELDS = tuple((column, COLUMN_CONVERTERS.get(column)) for column in MESSAGE_COLUMNS[1:])
+INSERT_SQL = f"INSERT INTO mqtt_messages ({', '.join(MESSAGE_COLUMNS)}) VALUES %s"
+
+# Tipos das colunas no formato text (os mesmos da tabela criada manualmente em commands.txt)
+TEXT_COLUMN_TYPES = {
+    "topic": "TEXT",
+    "package_id": "INTEGER",
+    "tempa": "FLOAT",
+    "rssi": "INTEGER",
+    "original_payload": "TEXT",
+}
+TEXT_LAYOUT = tuple((column, TEXT_COLUMN_TYPES.get(column, "VARCHAR(40)"), 'text') for column in MESSAGE_COLUMNS)
+
+FW_VERSION_FIELDS = ("fw_version_prefix", "fw_version_major", "fw_version_minor", "fw_version_patch", "fw_version_build")
+
+# Formato compact: (coluna, tipo SQL, tipo de conversão). O tipo de conversão define o conversor
+# do valor decodificado (COMPACT_CONVERTERS) e o SQL da migração a partir do formato text
+# (schema_manager.LEGACY_CONVERSIONS)
+COMPACT_LAYOUT = (
+    ("topic", "TEXT", 'text'),
+    ("start_flag", "SMALLINT", 'hex'),
+    ("package_type", "SMALLINT", 'hex'),
+    ("beacon_serial", "TEXT", 'text'),
+    ("epochtime_b", "TIMESTAMPTZ", 'epoch'),
+    ("epochtime_btx", "TIMESTAMPTZ", 'epoch'),
+    ("epochtime_g", "TIMESTAMPTZ", 'epoch'),
+    ("crc", "SMALLINT", 'hex'),
+    ("package_id", "INTEGER", 'int'),
+    ("tempa", "REAL", 'real'),
+    *[(f"r{i}", "INTEGER", 'hex') for i in range(1, 12)],
+    ("sensor_data_def_id", "SMALLINT", 'hex'),
+    ("fw_version", "BIGINT", 'fw_version'),
+    ("acc_mode_full", "INTEGER", 'hex'),
+    ("ton_toff", "INTEGER", 'hex'),
+    ("ln2_level_status", "SMALLINT", 'status'),
+    ("ln2_angle_status", "SMALLINT", 'status'),
+    ("ln2_battery_status", "SMALLINT", 'status'),
+    ("batt_percent", "SMALLINT", 'hex'),
+    ("ln2_foam_status", "SMALLINT", 'status'),
+    ("ln2_general_status", "SMALLINT", 'status'),
+    ("status_osc_cnt", "INTEGER", 'status'),  # Campo de 2 bytes lido como status
+    ("ln2_acc_data_available", "SMALLINT", 'hex'),
+    ("ln2_tx_cause_status", "SMALLINT", 'status'),
+    ("temp_pt100", "REAL", 'real'),
+    ("temp_ambient", "REAL", 'real'),
+    ("angle_to_horizontal", "INTEGER", 'int'),
+    ("vbat_mv", "INTEGER", 'int'),
+    ("factory_serial", "BIGINT", 'hex'),
+    ("ln2vibration", "SMALLINT", 'hex'),
+    ("ln2vibrationstatus", "SMALLINT", 'status'),
+    ("rssi", "SMALLINT", 'int'),
+    ("original_payload", "BYTEA", 'payload'),
+)
+STORAGE_LAYOUTS = {'text': TEXT_LAYOUT, 'compact': COMPACT_LAYOUT}
+
+
+def hex_int(val):
+    """Campo hex bruto ("0A3F") -> int"""
+    try:
+        return int(val, 16)
+    except Exception:
+        return None
+
+
+def status_code(val):
+    """Rótulo de status ("4 - Good", "-1 - Invalid data") -> código"""
+    if isinstance(val, int):
+        return val
+    try:
+        return int(val.split(' - ', 1)[0])
+    except Exception:
+        return None
+
+
+def epoch_timestamp(val):
+    """Epoch formatado pelo decoder ("2025-06-09 09-45-00.000", UTC) -> datetime"""
+    try:
+        return datetime(int(val[0:4]), int(val[5:7]), int(val[8:10]),
+                        int(val[11:13]), int(val[14:16]), int(val[17:19]), tzinfo=timezone.utc)
+    except Exception:
+        return None
+
+
+def payload_bytes(val):
+    try:
+        return bytes.fromhex(val)
+    except Exception:
+        return None
+
+
+def pack_fw_version(message_dict):
+    """prefixo, major, minor, patch e build (1 byte cada) em um inteiro 0xPPMMmmppbb"""
+    parts = [message_dict.get(field) for field in FW_VERSION_FIELDS]
+    if not all(isinstance(part, str) and len(part) == 2 for part in parts):
+        return None
+    return hex_int(''.join(parts))
+
+
+def unpack_fw_version(value) -> tuple:
+    """Inverso de pack_fw_version: (prefixo, major, minor, patch, build)"""
+    return tuple((value >> shift) & 0xFF for shift in (32, 24, 16, 8, 0))
+
+
+COMPACT_CONVERTERS = {
+    'hex': hex_int,
+    'status': status_code,
+    'epoch': epoch_timestamp,
+    'real': safe_float,
+    'int': safe_int,
+    'payload': payload_bytes,
+}
+COMPACT_COLUMNS = tuple(column for column, _, _ in COMPACT_LAYOUT)
+
+
+def _compact_getter(column, kind):
+    if kind == 'fw_version':
+        return pack_fw_version
+    convert = COMPACT_CONVERTERS.get(kind)
+    if convert is None:
+        return lambda message_dict: message_dict.get(column)
+    return lambda message_dict: convert(message_dict.get(column))
+
+
+_COMPACT_GETTERS = tuple(_compact_getter(column, kind) for column, _, kind in COMPACT_LAYOUT[1:])
+COMPACT_INSERT_SQL = f"INSERT INTO mqtt_messages ({', '.join(COMPACT_COLUMNS)}) VALUES %s"
+
+
+def build_row(topic, message_dict) -> tuple:
+    """Linha do INSERT para um pacote já normalizado (ver MessageProcessor._normalize_message_keys)"""
+    get = message_dict.get
+    return (topic, *[convert(get(column)) if convert else get(column) for column, convert in _FIELDS])
+
+
+def build_compact_row(topic, message_dict) -> tuple:
+    """Linha do INSERT no formato compact"""
+    return (topic, *[get(message_dict) for get in _COMPACT_GETTERS])
+
+
+class BatchedPostgresWriter:
+    """
+    Acumula linhas e grava em lotes em threads próprias (postgres.writer_threads).
+
+    Cada thread pega um lote e o grava em uma transação com uma conexão do pool, então o
+    loop de processamento nunca espera o Cloud SQL. Quedas de conexão são repetidas pelo
+    pool; se um lote falhar por causa dos dados, as linhas são regravadas uma a uma para
+    perder só as inválidas. `add` só bloqueia quando há mais de max_pending_rows linhas
+    esperando (banco lento ou fora do ar), repassando a pressão para a fila de ingestão.
+    Com mais de uma thread os lotes podem ser gravados fora de ordem entre si.
+
+    `on_batch_done(seqs, written)`, se informado, é chamado ao fim de cada lote com os seq
+    passados em `add` (lista vazia sem spool), quando o destino de cada linha é conhecido: written=True se a linha foi gravada (ou
+    descartada por erro de dados, que não adianta repetir) e False se o banco continuou
+    fora do ar depois das tentativas (ver spool.py).
+
+    `insert_sql` e `row_builder` permitem usar o writer para outra tabela (ex: mqtt_rollups).
+    """
+
+    def __init__(self, pool, batch_size: int = BATCH_SIZE, flush_interval_ms: int = FLUSH_INTERVAL_MS,
+                 max_pending_rows: int = MAX_PENDING_ROWS, writer_threads: int = WRITER_THREADS,
+                 storage: str = STORAGE, on_batch_done=None, insert_sql: str = None, row_builder=None) -> None:
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"storage inválido: {storage} (use {', '.join(STORAGE_MODES)})")
+        self.pool = pool
+        self.storage = storage
+        self._build_row = row_builder or (build_compact_row if storage == 'compact' else build_row)
+        self._insert_sql = insert_sql or (COMPACT_INSERT_SQL if storage == 'compact' else INSERT_SQL)
+        self.on_batch_done = on_batch_done
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending_rows = max(self.batch_size, max_pending_rows)
+        self.logger = setup_logger(__name__)
+
+        self._rows = []  # (linha, seq do spool ou None)
+        self._oldest_row_at = None
+        self._in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.batches = 0
+
+        self._threads = [threading.Thread(target=self._run, name=f'postgres-writer-{i}', daemon=True)
+                         for i in range(max(1, writer_threads))]
+        for thread in self._threads:
+            thread.start()
+
+    def add(self, topic, message_dict, seq=None) -> None:
+        row = (self._build_row(topic, message_dict), seq)
+        with self._cond:
+            while len(self._rows) >= self.max_pending_rows and not self._closed:
+                self._cond.wait()
+            if not self._rows:
+                self._oldest_row_at = time.monotonic()
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify_all()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._rows) + self._in_flight
+
+    def flush(self) -> None:
+        """Grava imediatamente todas as linhas pendentes e espera os lotes em andamento"""
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                break
+            self._write_and_release(batch)
+        with self._cond:
+            while self._in_flight:
+                self._cond.wait()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self.flush()
+
+    def _take_batch(self) -> list:
+        with self._cond:
+            batch = self._rows[:self.batch_size]
+            del self._rows[:self.batch_size]
+            self._oldest_row_at = time.monotonic() if self._rows else None
+            self._in_flight += len(batch)
+            self._cond.notify_all()  # Libera quem esperava em add
+            return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._rows) >= self.batch_size:
+                        break
+                    if self._rows:
+                        remaining = self._oldest_row_at + self.flush_interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return  # O restante é gravado por close()
+            batch = self._take_batch()
+            if batch:
+                self._write_and_release(batch)
+
+    def _write_and_release(self, batch: list) -> None:
+        try:
+            self._write(batch)
+        finally:
+            with self._cond:
+                self._in_flight -= len(batch)
+                self._cond.notify_all()
+
+    def _write(self, batch: list) -> None:
+        """Um INSERT com todas as linhas do lote e um commit; em erro de dados, linha a linha"""
+        rows = [row for row, _ in batch]
+
+        def insert(conn):
+            with conn.cursor() as cursor:
+                execute_values(cursor, self._insert_sql, rows, page_size=len(rows))
+
+        try:
+            self.pool.run_transaction(insert, description=f"lote de {len(batch)} mensagens")
+            with self._cond:
+                self.rows_written += len(batch)
+                self.batches += 1
+            print(f"Lote de {len(batch)} mensagens publicado no SQL em {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            self._batch_done(batch, True)
+        except TRANSIENT_ERRORS as e:
+            with self._cond:
+                self.rows_failed += len(batch)
+            if any(seq is not None for _, seq in batch):
+                self.logger.error(f"Banco indisponível após várias tentativas, {len(batch)} mensagens ficam no spool: {e}")
+            else:
+                self.logger.error(f"Banco indisponível após várias tentativas, {len(batch)} mensagens perdidas: {e}")
+            self._batch_done(batch, False)
+        except Exception as e:
+            if len(batch) == 1:
+                with self._cond:
+                    self.rows_failed += 1
+                self.logger.error(f"Erro ao inserir no banco: {e}")
+                self._batch_done(batch, True)
+                return
+            self.logger.error(f"Erro ao inserir lote de {len(batch)} mensagens no banco, gravando uma a uma: {e}")
+            for entry in batch:
+                self._write([entry])
+
+    def _batch_done(self, batch: list, written: bool) -> None:
+        if self.on_batch_done:
+            self.on_batch_done([seq for _, seq in batch if seq is not None], written)
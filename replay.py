@@ -0,0 +1,258 @@
+"""
+Replay/backfill de pacotes armazenados através do MessageProcessor, sem broker.
+
+Fontes:
+    postgres  coluna mqtt_messages.original_payload (cursor server-side)
+    json      dumps do diretório output/ (listas de mensagens com original_payload)
+    jsonl     arquivo de captura, uma linha por pacote: {"topic", "payload", "timestamp"}
+
+Sinks:
+    dry-run   só decodifica e processa, nada é gravado
+    local     grava em um arquivo JSONL o que seria enviado aos bancos
+    full      Postgres, Firestore e Realtime Database reais
+
+Exemplos:
+    python replay.py jsonl captura.jsonl
+    python replay.py json "output/*.json" --speed 10 --sink local
+    python replay.py postgres --since-id 100000 --limit 50000 --sink full
+"""
+
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from queue import Queue
+from typing import Iterator, Optional, Tuple
+
+import psycopg2
+
+from logger_config import setup_logger
+from ingest_queue import IngestRecord
+from message_processor import DB_CONFIG, MessageProcessor
+from metrics import LatencyRecorder
+
+DEFAULT_TOPIC = 'REPLAY/Pub'
+EPOCH_STRING_FORMAT = "%Y-%m-%d %H-%M-%S.%f"  # Formato gerado em _parse_hex_string
+
+logger = setup_logger('replay')
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    """Aceita epoch (número), ISO 8601 ou o formato de epochtime_* do processor"""
+    if value is None or value == '':
+        return None
+    try:
+        if isinstance(value, datetime):  # epochtime_g no formato compact (timestamptz)
+            return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value, tz=timezone.utc)
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            parsed = datetime.strptime(value, EPOCH_STRING_FORMAT)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def iter_postgres(since_id: int = None, limit: int = None, beacon: str = None,
+                  batch_size: int = 5000) -> Iterator[Tuple[str, str, Optional[datetime]]]:
+    """Lê mqtt_messages em ordem de id usando um cursor server-side (sem carregar tudo em memória)"""
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn.cursor(name='replay_cursor') as cursor:
+            cursor.itersize = batch_size
+            query = "SELECT topic, original_payload, epochtime_g FROM mqtt_messages WHERE original_payload IS NOT NULL"
+            params = []
+            if since_id is not None:
+                query += " AND id >= %s"
+                params.append(since_id)
+            if beacon:
+                query += " AND beacon_serial = %s"
+                params.append(beacon)
+            query += " ORDER BY id"
+            if limit:
+                query += " LIMIT %s"
+                params.append(limit)
+            cursor.execute(query, params)
+            for topic, payload, epochtime_g in cursor:
+                if isinstance(payload, memoryview):  # original_payload no formato compact (bytea)
+                    payload = payload.hex().upper()
+                yield topic or DEFAULT_TOPIC, payload, _parse_timestamp(epochtime_g)
+    finally:
+        conn.close()
+
+
+def iter_json_dumps(pattern: str, topic: str = DEFAULT_TOPIC) -> Iterator[Tuple[str, str, Optional[datetime]]]:
+    """Lê os dumps JSON do output/ (cada arquivo é uma lista de mensagens decodificadas)"""
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r') as f:
+            messages = json.load(f)
+        for message in messages:
+            payload = message.get('original_payload')
+            if payload:
+                yield message.get('topic', topic), payload, _parse_timestamp(message.get('epochtime_g'))
+
+
+def iter_jsonl(path: str, topic: str = DEFAULT_TOPIC) -> Iterator[Tuple[str, str, Optional[datetime]]]:
+    """Lê um arquivo de captura JSONL ({"topic", "payload" ou "original_payload", "timestamp"})"""
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Linha {line_number} inválida em {path}")
+                continue
+            payload = record.get('payload') or record.get('original_payload')
+            if payload:
+                yield record.get('topic', topic), payload, _parse_timestamp(record.get('timestamp'))
+
+
+class Pacer:
+    """Controla o ritmo do replay: speed <= 0 = o mais rápido possível, N = N vezes o tempo real"""
+
+    def __init__(self, speed: float) -> None:
+        self.speed = speed
+        self._first_timestamp = None
+        self._start = None
+
+    def wait(self, timestamp: Optional[datetime]) -> None:
+        if self.speed <= 0 or timestamp is None:
+            return
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+            self._start = time.monotonic()
+            return
+        target = (timestamp - self._first_timestamp).total_seconds() / self.speed
+        delay = target - (time.monotonic() - self._start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ReplayProcessor(MessageProcessor):
+    """MessageProcessor instrumentado por estágio e com seleção de sink"""
+
+    def __init__(self, sink: str, latencies: LatencyRecorder, local_output: str = None) -> None:
+        self.sink = sink
+        self.latencies = latencies
+        self.sink_writes = 0
+        self.local_file = None
+        super().__init__(Queue(), connect=(sink == 'full'))
+        if sink == 'local':
+            self.local_file = open(local_output, 'w')
+
+    def _load_message(self, message, timestamp):
+        with self.latencies.measure('decode'):
+            return super()._load_message(message, timestamp)
+
+    def add_message(self, message_dict, hex_payload, topic=None, timestamp=None):
+        with self.latencies.measure('add_message'):
+            return super().add_message(message_dict, hex_payload, topic=topic, timestamp=timestamp)
+
+    def flush_beacon_data(self, now=None):
+        with self.latencies.measure('flush'):
+            return super().flush_beacon_data(now)
+
+    def save_message_to_db(self, topic, message_dict):
+        self.sink_writes += 1
+        with self.latencies.measure('sinks'):
+            if self.sink == 'full':
+                super().save_message_to_db(topic, message_dict)
+            elif self.sink == 'local':
+                self.local_file.write(json.dumps({'topic': topic, 'message': message_dict}) + '\n')
+
+    def cleanup(self):
+        if self.local_file:
+            self.local_file.close()
+            self.local_file = None
+        super().cleanup()
+
+
+def replay(source, processor: ReplayProcessor, pacer: Pacer, max_messages: int = None) -> dict:
+    processed = errors = 0
+    start = time.perf_counter()
+    for topic, payload, timestamp in source:
+        pacer.wait(timestamp)
+        message = IngestRecord(time.monotonic_ns(), topic, payload.encode() if isinstance(payload, str) else payload)
+        try:
+            with processor.latencies.measure('total'):
+                processor.process_message(message, timestamp or datetime.now(timezone.utc))
+            processed += 1
+        except Exception as e:
+            errors += 1
+            logger.debug(f"Erro ao processar pacote: {e}")
+        if max_messages and processed + errors >= max_messages:
+            break
+
+    # Envia as amostras "normais" que ficariam esperando o próximo ciclo de 5 minutos
+    processor.flush_beacon_data()
+    elapsed = time.perf_counter() - start
+    return {
+        'processed': processed,
+        'errors': errors,
+        'sink_writes': processor.sink_writes,
+        'elapsed_s': elapsed,
+        'messages_per_s': processed / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay de pacotes armazenados pelo MessageProcessor, sem broker")
+    parser.add_argument('source', choices=['postgres', 'json', 'jsonl'], help="Origem dos pacotes")
+    parser.add_argument('path', nargs='?', help="Arquivo JSONL ou padrão glob dos dumps JSON (ex: 'output/*.json')")
+    parser.add_argument('--sink', choices=['dry-run', 'local', 'full'], default='dry-run')
+    parser.add_argument('--speed', type=float, default=0,
+                        help="0 = o mais rápido possível; N = N vezes o tempo real (usa epochtime_g/timestamp)")
+    parser.add_argument('--local-output', default=None, help="Arquivo JSONL do sink local")
+    parser.add_argument('--topic', default=DEFAULT_TOPIC, help="Tópico usado quando a origem não informa")
+    parser.add_argument('--since-id', type=int, default=None, help="[postgres] id inicial")
+    parser.add_argument('--beacon', default=None, help="[postgres] filtrar por beacon_serial")
+    parser.add_argument('--limit', type=int, default=None, help="Número máximo de pacotes")
+    parser.add_argument('--verbose', action='store_true', help="Mantém os prints e logs INFO do processor")
+    args = parser.parse_args(argv)
+
+    if args.source == 'postgres':
+        source = iter_postgres(since_id=args.since_id, limit=args.limit, beacon=args.beacon)
+    elif not args.path:
+        parser.error(f"a origem '{args.source}' exige o argumento path")
+    elif args.source == 'json':
+        source = iter_json_dumps(args.path, topic=args.topic)
+    else:
+        source = iter_jsonl(args.path, topic=args.topic)
+
+    local_output = args.local_output or os.path.join(
+        'output', f"replay_{datetime.now().strftime('%Y-%m-%d %H-%M-%S')}.jsonl")
+    latencies = LatencyRecorder()
+    processor = ReplayProcessor(args.sink, latencies, local_output=local_output)
+    if not args.verbose:
+        # setup_logger fixa INFO ao criar o logger, então o nível é ajustado depois da construção
+        logging.getLogger('message_processor').setLevel(logging.WARNING)
+        logging.getLogger('notification_handler').setLevel(logging.WARNING)
+    try:
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                devnull = stack.enter_context(open(os.devnull, 'w'))
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+            result = replay(source, processor, Pacer(args.speed), max_messages=args.limit)
+    finally:
+        processor.cleanup()
+
+    print(f"Pacotes processados: {result['processed']} (erros: {result['errors']})")
+    print(f"Gravações nos sinks ({args.sink}): {result['sink_writes']}")
+    if args.sink == 'local':
+        print(f"Arquivo local: {local_output}")
+    print(f"Tempo total: {result['elapsed_s']:.2f} s - {result['messages_per_s']:.1f} pacotes/s")
+    print(latencies.format_summary())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
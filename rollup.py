@@ -0,0 +1,165 @@
+"""
+Agregação incremental (rollup) dos pacotes de cada beacon por janela.
+
+Em vez de guardar só um pacote por beacon a cada ciclo de envio, o MessageProcessor passa
+todos os pacotes (normais e alertas) pelo RollupAggregator, que mantém por beacon e por
+campo apenas contagem, mínimo, máximo, soma e último valor (estado constante, sem guardar
+os pacotes). No fim da janela é emitida uma linha por beacon com min/max/média/último:
+na tabela mqtt_rollups (Postgres) e no documento da janela no Firestore. Assim picos
+curtos entre dois envios não se perdem.
+"""
+
+from datetime import datetime
+
+import yaml
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('rollup') or {}
+ROLLUP_ENABLED = bool(config.get('enabled', True))
+
+# Campos agregados (cada um vira quatro colunas em mqtt_rollups)
+ROLLUP_FIELDS = ('temp_pt100', 'temp_ambient', 'vbat_mv', 'angle_to_horizontal', 'rssi')
+
+ROLLUP_TABLE = 'mqtt_rollups'
+ROLLUP_STATS = ('min', 'max', 'mean', 'last')
+
+# Nome do campo no Firestore e fator de escala (vbat em V, como em _process_vbat_mv)
+FIRESTORE_FIELDS = {
+    'temp_pt100': ('tempPT100', 1),
+    'temp_ambient': ('tempAmbient', 1),
+    'vbat_mv': ('vBat', 1 / 1000),
+    'angle_to_horizontal': ('angle', 1),
+    'rssi': ('rssi', 1),
+}
+
+
+class RunningStats:
+    """Contagem, mínimo, máximo, soma e último valor de um campo"""
+
+    __slots__ = ('count', 'min', 'max', 'total', 'last')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.total = 0.0
+        self.last = None
+
+    def add(self, value) -> None:
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return  # Campo ausente ou corrompido (ex: fallback em hex do decoder)
+        if value != value:  # NaN
+            return
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if self.count == 0 or value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+        self.last = value
+
+    def as_dict(self) -> dict:
+        return {
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'last': self.last,
+            'count': self.count,
+        }
+
+
+class _BeaconWindow:
+    __slots__ = ('packets', 'topic', 'stats')
+
+    def __init__(self, fields) -> None:
+        self.packets = 0
+        self.topic = None
+        self.stats = {field: RunningStats() for field in fields}
+
+
+class RollupAggregator:
+    """Estado de agregação por beacon da janela atual"""
+
+    def __init__(self, fields=ROLLUP_FIELDS) -> None:
+        self.fields = tuple(fields)
+        self._windows = {}  # beacon_serial -> _BeaconWindow
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def add(self, beacon_serial, message_dict: dict, topic: str = None) -> None:
+        window = self._windows.get(beacon_serial)
+        if window is None:
+            window = self._windows[beacon_serial] = _BeaconWindow(self.fields)
+        window.packets += 1
+        if topic is not None:
+            window.topic = topic
+        get = message_dict.get
+        for field, stats in window.stats.items():
+            stats.add(get(field))
+
+    def drain(self, window_start: datetime, window_end: datetime) -> dict:
+        """Retorna {beacon_serial: rollup} da janela e começa uma nova (rollup serializável em JSON)"""
+        windows, self._windows = self._windows, {}
+        start, end = window_start.isoformat(), window_end.isoformat()
+        return {
+            beacon_serial: {
+                'beacon_serial': beacon_serial,
+                'topic': window.topic,
+                'window_start': start,
+                'window_end': end,
+                'packets': window.packets,
+                'fields': {field: stats.as_dict() for field, stats in window.stats.items()},
+            }
+            for beacon_serial, window in windows.items()
+        }
+
+
+def firestore_rollup(rollup: dict) -> dict:
+    """Mapa gravado no documento da janela no Firestore (nomes e unidades do Firestore)"""
+    data = {'packets': rollup['packets'], 'windowStart': datetime.fromisoformat(rollup['window_start'])}
+    for field, stats in rollup['fields'].items():
+        if not stats['count']:
+            continue
+        name, scale = FIRESTORE_FIELDS.get(field, (field, 1))
+        data[name] = {stat: stats[stat] * scale for stat in ROLLUP_STATS}
+    return data
+
+
+# Colunas de mqtt_rollups na ordem do INSERT
+ROLLUP_COLUMNS = ('beacon_serial', 'topic', 'window_start', 'window_end', 'packets') + tuple(
+    f"{field}_{stat}" for field in ROLLUP_FIELDS for stat in ROLLUP_STATS)
+
+ROLLUP_INSERT_SQL = f"INSERT INTO {ROLLUP_TABLE} ({', '.join(ROLLUP_COLUMNS)}) VALUES %s"
+
+
+def create_rollup_table_sql() -> str:
+    stat_columns = ''.join(f",\n    {field}_{stat} DOUBLE PRECISION" for field in ROLLUP_FIELDS for stat in ROLLUP_STATS)
+    return f"""
+CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+    id BIGSERIAL PRIMARY KEY,
+    beacon_serial VARCHAR(40) NOT NULL,
+    topic TEXT,
+    window_start TIMESTAMPTZ NOT NULL,
+    window_end TIMESTAMPTZ NOT NULL,
+    packets INTEGER NOT NULL{stat_columns}
+);
+CREATE INDEX IF NOT EXISTS {ROLLUP_TABLE}_beacon_window_idx ON {ROLLUP_TABLE} (beacon_serial, window_start);
+"""
+
+
+def build_rollup_row(topic, rollup: dict) -> tuple:
+    """Linha do INSERT em mqtt_rollups (mesma assinatura de postgres_writer.build_row)"""
+    fields = rollup['fields']
+    empty = {}
+    return (
+        rollup['beacon_serial'],
+        topic or rollup.get('topic'),
+        datetime.fromisoformat(rollup['window_start']),
+        datetime.fromisoformat(rollup['window_end']),
+        rollup['packets'],
+        *[fields.get(field, empty).get(stat) for field in ROLLUP_FIELDS for stat in ROLLUP_STATS],
+    )
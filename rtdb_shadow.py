@@ -0,0 +1,130 @@
+"""
+Sombra local (write-through) dos nós REALTIME e STATUS de cada equipamento no Realtime Database.
+
+Antes, cada mensagem lia REALTIME e STATUS do equipamento para só escrever o que mudou,
+e o NotificationHandler lia STATUS de novo para o lastTX: três leituras por mensagem.
+Com a sombra, a diferença é calculada contra a cópia local do que foi escrito por último,
+e todas as mudanças da mensagem vão em um único update() multi-path
+({'REALTIME/tempPT100': ..., 'STATUS/lastTX': ...}).
+
+A sombra é carregada uma vez quando o processor conecta (warm: só os nós REALTIME e STATUS
+de cada equipamento, não o equipamento inteiro, com NOTIFICATIONS etc., em paralelo);
+um equipamento que não estava lá é lido no primeiro uso. Na atualização do cache de MAC
+saem da sombra só os equipamentos cujo MAC mudou. Se um update falhar, o equipamento sai
+da sombra e é relido na próxima mensagem.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from logger_config import setup_logger
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('realtime_db') or {}
+RTDB_SHADOW_ENABLED = bool(config.get('shadow', True))
+
+SHADOW_SECTIONS = ('REALTIME', 'STATUS')
+
+
+class RealtimeShadow:
+    """Último estado escrito de REALTIME/STATUS por equipment_id"""
+
+    def __init__(self, realtime_db) -> None:
+        self.realtime_db = realtime_db
+        self.logger = setup_logger(__name__)
+        self._equipment = {}  # equipment_id -> {'REALTIME': {...}, 'STATUS': {...}}
+        self._lock = threading.Lock()
+
+        self.reads = 0
+        self.writes = 0
+        self.skipped_writes = 0
+
+    def __len__(self) -> int:
+        return len(self._equipment)
+
+    def load(self, all_equipment: dict) -> None:
+        """Substitui a sombra por uma árvore já lida do Realtime Database ({equipment_id: dados})"""
+        loaded = {
+            equipment_id: self._sections(equipment_data)
+            for equipment_id, equipment_data in (all_equipment or {}).items()
+            if equipment_id.startswith('LN2-') and isinstance(equipment_data, dict)
+        }
+        with self._lock:
+            self._equipment = loaded
+        self.logger.info(f"Sombra do Realtime Database carregada: {len(loaded)} equipamentos")
+
+    def warm(self, equipment_ids, threads: int = 8) -> None:
+        """Carrega a sombra lendo REALTIME/STATUS dos equipamentos informados, em paralelo"""
+        equipment_ids = list(equipment_ids)
+        if not equipment_ids:
+            return
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            sections = executor.map(self._read_sections, equipment_ids)
+            self.load(dict(zip(equipment_ids, sections)))
+
+    def clear(self) -> None:
+        """Esquece todos os equipamentos; cada um é relido no próximo uso"""
+        with self._lock:
+            self._equipment = {}
+
+    def get(self, equipment_id: str, section: str) -> dict:
+        """Cópia de REALTIME ou STATUS do equipamento (lê o banco só no primeiro uso)"""
+        return dict(self._get_equipment(equipment_id)[section])
+
+    def write(self, equipment_id: str, sections: dict) -> dict:
+        """
+        Escreve só os campos que mudaram em relação à sombra, em um único update multi-path.
+        Retorna o dict de caminhos escritos (vazio se nada mudou).
+        """
+        current = self._get_equipment(equipment_id)
+        with self._lock:
+            updates = {
+                f"{section}/{key}": value
+                for section, data in sections.items()
+                for key, value in data.items()
+                if current[section].get(key) != value
+            }
+        if not updates:
+            self.skipped_writes += 1
+            return updates
+
+        try:
+            self.realtime_db.child(equipment_id).update(updates)
+        except Exception:
+            # Estado remoto incerto: relê o equipamento na próxima mensagem
+            self.invalidate(equipment_id)
+            raise
+        self.writes += 1
+        with self._lock:
+            for path, value in updates.items():
+                section, key = path.split('/', 1)
+                current[section][key] = value
+        return updates
+
+    def invalidate(self, equipment_id: str) -> None:
+        with self._lock:
+            self._equipment.pop(equipment_id, None)
+
+    def _get_equipment(self, equipment_id: str) -> dict:
+        equipment = self._equipment.get(equipment_id)
+        if equipment is not None:
+            return equipment
+        sections = self._sections(self._read_sections(equipment_id))
+        with self._lock:
+            return self._equipment.setdefault(equipment_id, sections)
+
+    def _read_sections(self, equipment_id: str) -> dict:
+        equipment_ref = self.realtime_db.child(equipment_id)
+        sections = {}
+        for section in SHADOW_SECTIONS:
+            self.reads += 1
+            sections[section] = equipment_ref.child(section).get()
+        return sections
+
+    @staticmethod
+    def _sections(equipment_data) -> dict:
+        equipment_data = equipment_data if isinstance(equipment_data, dict) else {}
+        return {section: dict(equipment_data.get(section) or {}) for section in SHADOW_SECTIONS}
@@ -0,0 +1,459 @@
+"""
+Esquema particionado da tabela mqtt_messages.
+
+A tabela é particionada por faixa de `received_at` (instante da gravação, UTC), com uma
+partição por dia ou por mês (schema.partition_interval) e uma partição default para
+o que cair fora das faixas criadas. O índice (beacon_serial, epochtime_b) é criado na
+tabela mãe e replicado em cada partição, então consultas e exclusões por beacon e
+período leem só as partições envolvidas e o índice de cada uma fica pequeno.
+
+`ensure()` é idempotente: cria a tabela se não existir, cria as partições do período
+atual e das próximas (schema.premake_partitions) e aplica a retenção
+(schema.retention_days), desanexando ou apagando as partições antigas. Roda no início
+do main.py e depois periodicamente em uma thread (schema.maintenance_interval_s).
+Também cria a tabela de agregados mqtt_rollups (ver rollup.py), que não é particionada.
+
+As colunas seguem postgres.storage (text ou compact, ver postgres_writer.py). Uma
+mqtt_messages antiga (não particionada, ou em text com storage compact) não é alterada
+automaticamente: use `python schema_manager.py migrate`, que a renomeia para
+mqtt_messages_legacy, cria a tabela nova e copia as linhas em lotes convertendo as
+colunas (pode ser interrompido e retomado).
+
+Exemplos:
+    python schema_manager.py ensure
+    python schema_manager.py status
+    python schema_manager.py retention --dry-run
+    python schema_manager.py migrate --batch-size 50000
+"""
+
+import argparse
+import re
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+import yaml
+
+from logger_config import setup_logger
+from message_processor import DB_CONFIG
+from postgres_pool import PostgresConnectionPool
+from postgres_writer import FW_VERSION_FIELDS, STORAGE, STORAGE_LAYOUTS, STORAGE_MODES
+from rollup import create_rollup_table_sql
+from sinks import SINK_BACKEND
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('schema') or {}
+PARTITION_INTERVAL = config.get('partition_interval', 'monthly')
+PREMAKE_PARTITIONS = int(config.get('premake_partitions', 2))
+RETENTION_DAYS = int(config.get('retention_days', 0))
+RETENTION_ACTION = config.get('retention_action', 'detach')
+MAINTENANCE_INTERVAL_S = float(config.get('maintenance_interval_s', 3600))
+MANAGE_ON_STARTUP = bool(config.get('manage_on_startup', True))
+MIGRATION_BATCH_SIZE = int(config.get('migration_batch_size', 50000))
+
+PARTITION_INTERVALS = ('daily', 'monthly')
+RETENTION_ACTIONS = ('detach', 'drop')
+
+TABLE = 'mqtt_messages'
+DEFAULT_PARTITION = f'{TABLE}_default'
+LEGACY_TABLE = f'{TABLE}_legacy'
+ID_SEQUENCE = f'{TABLE}_id_seq'
+BEACON_INDEX = f'{TABLE}_beacon_epoch_idx'
+_PARTITION_NAME = re.compile(rf'^{TABLE}_p(\d{{6}}|\d{{8}})$')
+
+# Serializa ensure/migrate entre instâncias do cluster (chave arbitrária do pg_advisory_xact_lock)
+ADVISORY_LOCK_KEY = 0x4C4E3201
+
+
+
+def create_table_sql(storage: str = STORAGE) -> str:
+    columns = ',\n    '.join(f'{column} {sql_type}' for column, sql_type, _ in STORAGE_LAYOUTS[storage])
+    return f"""
+CREATE TABLE {TABLE} (
+    id BIGINT NOT NULL DEFAULT nextval('{ID_SEQUENCE}'),
+    received_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    {columns},
+    PRIMARY KEY (id, received_at)
+) PARTITION BY RANGE (received_at)
+"""
+
+
+def _legacy_epoch_sql(column: str) -> str:
+    # Epoch formatado pelo decoder ("2025-06-09 09-45-00.000", UTC; a migração roda com TIME ZONE 'UTC')
+    return (f"CASE WHEN {column} ~ '^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}} [0-9]{{2}}-[0-9]{{2}}-[0-9]{{2}}' "
+            f"THEN to_timestamp(left({column}, 19), 'YYYY-MM-DD HH24-MI-SS') END")
+
+
+def _legacy_hex_sql(expression: str, digits: str = '1,15') -> str:
+    return (f"CASE WHEN {expression} ~ '^[0-9A-Fa-f]{{{digits}}}$' "
+            f"THEN ('x' || lpad({expression}, 16, '0'))::bit(64)::bigint END")
+
+
+# Conversão de uma coluna do formato text para o compact, por tipo de conversão do COMPACT_LAYOUT.
+# Valores fora do formato esperado (pacotes corrompidos) viram NULL
+LEGACY_CONVERSIONS = {
+    'text': lambda column: column,
+    'hex': _legacy_hex_sql,
+    'status': lambda column: f"CASE WHEN {column} ~ '^-?[0-9]+ - ' THEN split_part({column}, ' - ', 1)::integer END",
+    'epoch': _legacy_epoch_sql,
+    'real': lambda column: (rf"CASE WHEN {column}::text ~ '^-?[0-9]+(\.[0-9]+)?([eE][-+]?[0-9]+)?$' "
+                            rf"THEN {column}::text::real END"),
+    'int': lambda column: (rf"CASE WHEN {column}::text ~ '^-?[0-9]+(\.[0-9]+)?$' "
+                           rf"THEN round({column}::text::numeric) END"),
+    'fw_version': lambda column: _legacy_hex_sql(f"concat({', '.join(FW_VERSION_FIELDS)})", digits='10'),
+    'payload': lambda column: f"CASE WHEN {column} ~ '^([0-9A-Fa-f]{{2}})+$' THEN decode({column}, 'hex') END",
+}
+
+# received_at das linhas de uma tabela sem essa coluna: epochtime_g do gateway.
+# Sem epochtime_g no formato esperado a linha vai para a partição default
+LEGACY_RECEIVED_AT_SQL = f"coalesce({_legacy_epoch_sql('epochtime_g')}, '-infinity')"
+LEGACY_MIN_RECEIVED_AT = datetime(2020, 1, 1, tzinfo=timezone.utc)  # Relógio de gateway antes disso é lixo
+
+
+def period_start(moment: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    """Início (UTC) da partição que contém `moment`"""
+    moment = moment.astimezone(timezone.utc)
+    if interval == 'daily':
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_period(start: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    if interval == 'daily':
+        return start + timedelta(days=1)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def partition_name(start: datetime, interval: str = PARTITION_INTERVAL) -> str:
+    return f"{TABLE}_p{start.strftime('%Y%m%d' if interval == 'daily' else '%Y%m')}"
+
+
+def partition_range(name: str):
+    """(início, fim) de uma partição pelo nome, ou None se não for uma partição gerenciada aqui"""
+    match = _PARTITION_NAME.match(name)
+    if not match:
+        return None
+    digits = match.group(1)
+    interval = 'daily' if len(digits) == 8 else 'monthly'
+    start = datetime.strptime(digits, '%Y%m%d' if interval == 'daily' else '%Y%m').replace(tzinfo=timezone.utc)
+    return start, next_period(start, interval)
+
+
+class SchemaManager:
+    def __init__(self, pool, interval: str = PARTITION_INTERVAL, premake: int = PREMAKE_PARTITIONS,
+                 retention_days: int = RETENTION_DAYS, retention_action: str = RETENTION_ACTION,
+                 storage: str = STORAGE) -> None:
+        if storage not in STORAGE_MODES:
+            raise ValueError(f"storage inválido: {storage} (use {', '.join(STORAGE_MODES)})")
+        if interval not in PARTITION_INTERVALS:
+            raise ValueError(f"partition_interval inválido: {interval} (use {', '.join(PARTITION_INTERVALS)})")
+        if retention_action not in RETENTION_ACTIONS:
+            raise ValueError(f"retention_action inválida: {retention_action} (use {', '.join(RETENTION_ACTIONS)})")
+        self.pool = pool
+        self.interval = interval
+        self.premake = max(0, premake)
+        self.retention_days = retention_days
+        self.retention_action = retention_action
+        self.storage = storage
+        self.logger = setup_logger(__name__)
+        self._stop = threading.Event()
+        self._thread = None
+
+    # -- manutenção ------------------------------------------------------------------------
+
+    def ensure(self, now: datetime = None) -> dict:
+        """Cria tabela e partições que faltam e aplica a retenção; pode ser chamado a qualquer momento"""
+        now = now or datetime.now(timezone.utc)
+
+        def work(conn):
+            with conn.cursor() as cursor:
+                self._lock(cursor)
+                cursor.execute(create_rollup_table_sql())
+                relkind = self._relkind(cursor, TABLE)
+                if relkind is None:
+                    self._create_schema(cursor)
+                elif self._needs_migration(cursor, relkind):
+                    self.logger.warning(f"{TABLE} não é particionada ou não está no formato {self.storage}; "
+                                        f"rode 'python schema_manager.py migrate'")
+                    return {'created': [], 'retired': [], 'legacy': True}
+                created = []
+                start = period_start(now, self.interval)
+                for _ in range(self.premake + 1):
+                    end = next_period(start, self.interval)
+                    if self._create_partition(cursor, start, end):
+                        created.append(partition_name(start, self.interval))
+                    start = end
+                retired = self._apply_retention(cursor, now)
+                return {'created': created, 'retired': retired, 'legacy': False}
+
+        result = self.pool.run_transaction(work, description="manutenção do esquema")
+        if result['created'] or result['retired']:
+            self.logger.info(f"Partições criadas: {result['created'] or '-'}; retiradas: {result['retired'] or '-'}")
+        return result
+
+    def start(self, interval_s: float = MAINTENANCE_INTERVAL_S) -> None:
+        """Roda ensure() agora e a cada interval_s em uma thread (sem bloquear a inicialização)"""
+        self._thread = threading.Thread(target=self._run, args=(interval_s,), name='schema-maintenance', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self, interval_s: float) -> None:
+        while not self._stop.is_set():
+            try:
+                self.ensure()
+            except Exception as e:
+                self.logger.error(f"Erro na manutenção das partições de {TABLE}: {e}")
+            self._stop.wait(interval_s)
+
+    def apply_retention(self, now: datetime = None, dry_run: bool = False) -> list:
+        """Retira as partições que passaram de retention_days; com dry_run só as lista"""
+        now = now or datetime.now(timezone.utc)
+
+        def work(conn):
+            with conn.cursor() as cursor:
+                if dry_run:
+                    return self._expired_partitions(cursor, now)
+                self._lock(cursor)
+                return self._apply_retention(cursor, now)
+
+        return self.pool.run_transaction(work, description="retenção de partições")
+
+    def status(self) -> list:
+        """(partição, início, fim, linhas estimadas, bytes) de cada partição, em ordem"""
+        def work(conn):
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT c.relname, c.reltuples::bigint, pg_total_relation_size(c.oid) "
+                    "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = %s::regclass ORDER BY c.relname", (TABLE,))
+                rows = []
+                for name, tuples, size in cursor.fetchall():
+                    bounds = partition_range(name) or (None, None)
+                    rows.append((name, *bounds, max(tuples, 0), size))
+                return rows
+
+        return self.pool.run_transaction(work, description="status do esquema")
+
+    # -- migração da tabela antiga ---------------------------------------------------------
+
+    def migrate_legacy(self, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+        """
+        Troca uma mqtt_messages não particionada (ou em outro formato) pela particionada no
+        formato postgres.storage e copia as linhas em lotes por id, convertendo as colunas.
+        Cada lote é uma transação; rodar de novo continua de onde parou.
+        """
+        def swap(conn):
+            with conn.cursor() as cursor:
+                self._lock(cursor)
+                relkind = self._relkind(cursor, TABLE)
+                if relkind is None or not self._needs_migration(cursor, relkind):
+                    return False
+                if self._relkind(cursor, LEGACY_TABLE) is not None:
+                    raise RuntimeError(f"{LEGACY_TABLE} já existe; termine a migração anterior e apague-a antes")
+                if self._storage(cursor, TABLE) == 'compact' and self.storage == 'text':
+                    raise RuntimeError(f"{TABLE} já está em compact; a conversão para text não é suportada")
+                # Partições, sequência e índice antigos mudam de nome para liberar os nomes da tabela nova
+                for name in self._partitions(cursor, TABLE):
+                    cursor.execute(f"ALTER TABLE {name} RENAME TO {LEGACY_TABLE}{name[len(TABLE):]}")
+                cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {LEGACY_TABLE}")
+                cursor.execute(f"ALTER SEQUENCE IF EXISTS {ID_SEQUENCE} RENAME TO {LEGACY_TABLE}_id_seq")
+                cursor.execute(f"ALTER INDEX IF EXISTS {BEACON_INDEX} RENAME TO {LEGACY_TABLE}_beacon_epoch_idx")
+                self._create_schema(cursor)
+                # Os ids novos continuam depois dos antigos
+                cursor.execute(f"SELECT max(id) FROM {LEGACY_TABLE}")
+                legacy_max = cursor.fetchone()[0]
+                if legacy_max:
+                    cursor.execute("SELECT setval(%s, %s)", (ID_SEQUENCE, legacy_max))
+                return True
+
+        if self.pool.run_transaction(swap, description="troca da tabela antiga"):
+            self.logger.info(f"{TABLE} renomeada para {LEGACY_TABLE} e recriada particionada ({self.storage})")
+
+        def prepare(conn):
+            with conn.cursor() as cursor:
+                if self._relkind(cursor, LEGACY_TABLE) is None:
+                    return None
+                cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+                received_at = self._legacy_received_at(cursor)
+                cursor.execute(
+                    f"SELECT min(r), max(r) FROM (SELECT {received_at} AS r FROM {LEGACY_TABLE}) t "
+                    f"WHERE r >= %s AND r < now() + interval '1 day'", (LEGACY_MIN_RECEIVED_AT,))
+                first, last = cursor.fetchone()
+                if first is not None:
+                    self._lock(cursor)
+                    start = period_start(first, self.interval)
+                    while start <= last:
+                        end = next_period(start, self.interval)
+                        self._create_partition(cursor, start, end)
+                        start = end
+                cursor.execute(f"SELECT max(id) FROM {LEGACY_TABLE}")
+                legacy_max = cursor.fetchone()[0] or 0
+                cursor.execute(f"SELECT coalesce(max(id), 0) FROM {TABLE} WHERE id <= %s", (legacy_max,))
+                done = cursor.fetchone()[0]
+                return done, legacy_max, received_at, self._storage(cursor, LEGACY_TABLE)
+
+        progress = self.pool.run_transaction(prepare, description="preparação da migração")
+        if progress is None:
+            self.logger.info(f"Nenhuma {LEGACY_TABLE} para migrar")
+            return 0
+        done, legacy_max, received_at, legacy_storage = progress
+        layout = STORAGE_LAYOUTS[self.storage]
+        columns = ', '.join(column for column, _, _ in layout)
+        if legacy_storage == self.storage:
+            expressions = columns
+        else:
+            expressions = ', '.join(LEGACY_CONVERSIONS[kind](column) for column, _, kind in layout)
+        copied = 0
+
+        def copy_batch(conn, lower, upper):
+            with conn.cursor() as cursor:
+                cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+                cursor.execute(
+                    f"INSERT INTO {TABLE} (id, received_at, {columns}) "
+                    f"SELECT id, {received_at}, {expressions} FROM {LEGACY_TABLE} WHERE id > %s AND id <= %s",
+                    (lower, upper))
+                return cursor.rowcount
+
+        while done < legacy_max:
+            upper = min(done + batch_size, legacy_max)
+            copied += self.pool.run_transaction(lambda conn: copy_batch(conn, done, upper),
+                                                description=f"cópia dos ids {done + 1}-{upper}")
+            done = upper
+            self.logger.info(f"Migração: {copied} linhas copiadas (id {done}/{legacy_max})")
+
+        self.logger.info(f"Migração concluída; confira os dados e apague {LEGACY_TABLE} (DROP TABLE {LEGACY_TABLE})")
+        return copied
+
+    # -- internos (chamados dentro de uma transação) ---------------------------------------
+
+    def _lock(self, cursor) -> None:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ADVISORY_LOCK_KEY,))
+
+    def _relkind(self, cursor, name: str):
+        """'p' particionada, 'r' tabela comum, None se não existe"""
+        cursor.execute("SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass(%s)", (name,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _storage(self, cursor, table: str) -> str:
+        """Formato de uma tabela existente, pelo tipo de original_payload"""
+        cursor.execute("SELECT data_type FROM information_schema.columns "
+                       "WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'original_payload'",
+                       (table,))
+        row = cursor.fetchone()
+        return 'compact' if row and row[0] == 'bytea' else 'text'
+
+    def _needs_migration(self, cursor, relkind: str) -> bool:
+        return relkind == 'r' or self._storage(cursor, TABLE) != self.storage
+
+    def _legacy_received_at(self, cursor) -> str:
+        """received_at da tabela antiga, se ela já tiver a coluna; senão derivado do epochtime_g"""
+        cursor.execute("SELECT 1 FROM information_schema.columns "
+                       "WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'received_at'",
+                       (LEGACY_TABLE,))
+        return 'received_at' if cursor.fetchone() else LEGACY_RECEIVED_AT_SQL
+
+    def _partitions(self, cursor, table: str) -> list:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass ORDER BY c.relname", (table,))
+        return [name for (name,) in cursor.fetchall()]
+
+    def _create_schema(self, cursor) -> None:
+        cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {ID_SEQUENCE} AS BIGINT")
+        cursor.execute(create_table_sql(self.storage))
+        cursor.execute(f"ALTER SEQUENCE {ID_SEQUENCE} OWNED BY {TABLE}.id")
+        cursor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {BEACON_INDEX} ON {TABLE} (beacon_serial, epochtime_b)")
+        self.logger.info(f"Tabela {TABLE} criada (particionada por received_at, {self.interval}, {self.storage})")
+
+    def _create_partition(self, cursor, start: datetime, end: datetime) -> bool:
+        name = partition_name(start, self.interval)
+        if self._relkind(cursor, name) is not None:
+            return False
+        bounds = (start.isoformat(), end.isoformat())
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE received_at >= %s AND received_at < %s)",
+                       bounds)
+        if cursor.fetchone()[0]:
+            # O Postgres recusa a partição nova se a default tem linhas da faixa: elas são movidas antes de anexar
+            cursor.execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+            cursor.execute(
+                f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE received_at >= %s AND received_at < %s "
+                f"RETURNING *) INSERT INTO {name} SELECT * FROM moved", bounds)
+            self.logger.info(f"{cursor.rowcount} linhas movidas da partição default para {name}")
+            cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", bounds)
+        else:
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)", bounds)
+        return True
+
+    def _expired_partitions(self, cursor, now: datetime) -> list:
+        if self.retention_days <= 0:
+            return []
+        cutoff = now - timedelta(days=self.retention_days)
+        expired = []
+        for name in self._partitions(cursor, TABLE):
+            bounds = partition_range(name)
+            if bounds and bounds[1] <= cutoff:
+                expired.append(name)
+        return expired
+
+    def _apply_retention(self, cursor, now: datetime) -> list:
+        expired = self._expired_partitions(cursor, now)
+        for name in expired:
+            if self.retention_action == 'drop':
+                cursor.execute(f"DROP TABLE {name}")
+            else:
+                # A tabela desanexada continua no banco para arquivamento (pg_dump) e remoção manual
+                cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+        return expired
+
+
+def start_schema_maintenance():
+    """Chamado no início do main.py: ensure() agora e depois periodicamente, com um pool próprio de 1 conexão"""
+    if not MANAGE_ON_STARTUP or SINK_BACKEND == 'local':
+        return None  # O SqlitePool do backend local cria as próprias tabelas
+    manager = SchemaManager(PostgresConnectionPool(DB_CONFIG, min_connections=0, max_connections=1))
+    manager.start()
+    return manager
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=f"Gerencia as partições da tabela {TABLE}")
+    parser.add_argument('command', nargs='?', default='ensure', choices=['ensure', 'status', 'retention', 'migrate'],
+                        help="ensure: cria tabela/partições e aplica a retenção; status: lista as partições; "
+                             "retention: só a retenção (retention_days); migrate: converte a tabela antiga não particionada")
+    parser.add_argument('--dry-run', action='store_true', help="[retention] só lista as partições que seriam retiradas")
+    parser.add_argument('--batch-size', type=int, default=MIGRATION_BATCH_SIZE, help="[migrate] ids por transação")
+    args = parser.parse_args(argv)
+
+    pool = PostgresConnectionPool(DB_CONFIG, min_connections=0, max_connections=1)
+    manager = SchemaManager(pool)
+    try:
+        if args.command == 'status':
+            for name, start, end, rows, size in manager.status():
+                period = f"{start:%Y-%m-%d} a {end:%Y-%m-%d}" if start else "-"
+                print(f"{name:<32} {period:<26} ~{rows:>12} linhas {size / 1e6:>10.1f} MB")
+        elif args.command == 'retention':
+            expired = manager.apply_retention(dry_run=args.dry_run)
+            action = f"{manager.retention_action}, simulação" if args.dry_run else manager.retention_action
+            print(f"Partições retiradas ({action}): {', '.join(expired) or 'nenhuma'}")
+        elif args.command == 'migrate':
+            copied = manager.migrate_legacy(batch_size=args.batch_size)
+            manager.ensure()
+            print(f"Linhas copiadas: {copied}")
+        else:
+            result = manager.ensure()
+            print(f"Partições criadas: {', '.join(result['created']) or 'nenhuma'}")
+            print(f"Partições retiradas ({manager.retention_action}): {', '.join(result['retired']) or 'nenhuma'}")
+    finally:
+        pool.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,320 @@
+"""
+Despacho assíncrono das escritas de cada pacote para os sinks (Postgres, Firestore, Realtime DB).
+
+Antes, save_message_to_db chamava os três sinks em sequência na thread do processor: um
+Firestore lento atrasava o Postgres e o Realtime DB, e a latência de cada pacote era a soma
+dos três. Com o SinkDispatcher cada sink tem as próprias filas limitadas, threads, política
+de repetição e circuit breaker, então a latência passa a ser a do sink mais lento e um
+backend degradado não segura os outros.
+
+Dentro de um sink as filas são particionadas por beacon_serial (uma por thread), então as
+escritas de um mesmo beacon continuam em ordem.
+
+Com a fila de um sink cheia, when_full: block (padrão) faz o processor esperar o sink
+(backpressure, como antes do dispatcher). Com when_full: drop, ou com o circuit breaker
+aberto, a escrita não é tentada e o resultado é False: com o spool ligado o registro fica
+pendente para esse sink e o SpoolReplayer o regrava depois (ver spool.py); sem spool ele é
+perdido, como em uma falha de escrita. drop só faz sentido com spool.enabled. As escritas
+recusadas vão para o log em warning (no máximo uma linha por sink a cada
+REJECT_LOG_INTERVAL_S, com a contagem).
+
+Circuit breaker: depois de failure_threshold falhas seguidas o sink abre por
+reset_timeout_s; então uma escrita de teste (half-open) decide se ele fecha de novo.
+Nos sinks com writer em lote (Postgres, Firestore com firestore.batched) a escrita só
+entrega o registro ao writer (QUEUED), o que não diz nada sobre o backend: o breaker conta
+só o resultado de cada lote (on_batch_done -> record), e a escrita de teste também é
+decidida pelo próximo lote gravado ou perdido.
+
+`stats()` traz por sink: estado do breaker, pendentes, lag (espera na fila) e latência
+das chamadas. Também em GET /sinks na API de estado e no log a cada stats_log_interval_s.
+"""
+
+import queue
+import threading
+import time
+from zlib import crc32
+
+import yaml
+
+from logger_config import setup_logger
+from metrics import LatencyRecorder
+from spool import QUEUED
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('sink_dispatcher') or {}
+SINK_DISPATCHER_ENABLED = bool(config.get('enabled', True))
+WHEN_FULL = config.get('when_full', 'block')
+FAILURE_THRESHOLD = int(config.get('failure_threshold', 5))
+RESET_TIMEOUT_S = float(config.get('reset_timeout_s', 30))
+STATS_LOG_INTERVAL_S = float(config.get('stats_log_interval_s', 300))
+SINK_OPTIONS = config.get('sinks') or {}
+
+REJECT_LOG_INTERVAL_S = 60
+
+DEFAULT_SINK_OPTIONS = {'threads': 4, 'queue_size': 10000, 'max_retries': 2, 'retry_backoff_s': 0.5}
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class CircuitBreaker:
+    """Abre depois de failure_threshold falhas seguidas; uma escrita de teste após reset_timeout_s"""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout_s: float = RESET_TIMEOUT_S) -> None:
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout_s = reset_timeout_s
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._probing = False
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now - self.opened_at >= self.reset_timeout_s:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self._probing and now - self._probe_started >= self.reset_timeout_s:
+                self._probing = False  # Teste sem resultado (ex: lote que nunca terminou): outro teste
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True  # Uma escrita de teste por vez
+                self._probe_started = now
+                return True
+            return False
+
+    def record(self, success: bool) -> str:
+        """Registra o resultado de uma escrita; retorna o estado anterior se ele mudou, senão None"""
+        with self._lock:
+            previous = self.state
+            if success:
+                self.failures = 0
+                self.state = CLOSED
+            else:
+                self.failures += 1
+                if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                    if self.state != OPEN:
+                        self.trips += 1
+                    self.state = OPEN
+                    self.opened_at = time.monotonic()
+            self._probing = False
+            return previous if previous != self.state else None
+
+
+class _SinkWorker:
+    """Filas, threads, repetição e breaker de um sink"""
+
+    def __init__(self, name: str, write, settle, options: dict, when_full: str,
+                 breaker: CircuitBreaker) -> None:
+        self.name = name
+        self.write = write
+        self.settle = settle
+        self.threads = max(1, int(options['threads']))
+        self.max_retries = int(options['max_retries'])
+        self.retry_backoff_s = float(options['retry_backoff_s'])
+        self.block = when_full == 'block'
+        self.breaker = breaker
+        self.logger = setup_logger(__name__)
+        queue_size = max(1, int(options['queue_size']) // self.threads)
+        self.queues = [queue.Queue(queue_size) for _ in range(self.threads)]
+
+        self.dispatched = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0  # Fila cheia ou breaker aberto (ficam no spool)
+        self.retries = 0
+        self._rejected_unlogged = 0
+        self._reject_logged_at = float('-inf')
+        self._counter_lock = threading.Lock()
+        self._latencies = LatencyRecorder()  # chamada e espera na fila, desde o último log de stats
+
+        self._workers = [threading.Thread(target=self._run, args=(q,), name=f'sink-{name}-{i}', daemon=True)
+                         for i, q in enumerate(self.queues)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, topic, message_dict: dict, seq) -> None:
+        beacon_serial = message_dict.get('beacon_serial') or ''
+        target = self.queues[crc32(str(beacon_serial).encode()) % self.threads]
+        item = (topic, message_dict, seq, time.monotonic())
+        with self._counter_lock:
+            self.dispatched += 1
+        try:
+            target.put(item, block=self.block)
+        except queue.Full:
+            self._reject(item, "fila cheia")
+
+    def pending(self) -> int:
+        return sum(q.unfinished_tasks for q in self.queues)
+
+    def join(self) -> None:
+        for q in self.queues:
+            q.join()
+
+    def stop(self) -> None:
+        for q in self.queues:
+            q.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def record(self, success: bool) -> None:
+        transition = self.breaker.record(success)
+        if transition is None:
+            return
+        if self.breaker.state == OPEN:
+            self.logger.error(f"Sink {self.name}: circuit breaker aberto após {self.breaker.failures} falhas; "
+                              f"novas escritas vão para o spool por {self.breaker.reset_timeout_s:.0f} s")
+        elif self.breaker.state == CLOSED:
+            self.logger.info(f"Sink {self.name}: circuit breaker fechado, escritas normalizadas")
+
+    def stats(self) -> dict:
+        with self._counter_lock:
+            latencies = self._latencies.summary()
+            return {
+                'state': self.breaker.state,
+                'pending': self.pending(),
+                'dispatched': self.dispatched,
+                'written': self.written,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'retries': self.retries,
+                'breaker_trips': self.breaker.trips,
+                'lag': latencies.get('queue_wait', {}),
+                'latency': latencies.get('call', {}),
+            }
+
+    def reset_latencies(self) -> None:
+        with self._counter_lock:
+            self._latencies = LatencyRecorder()
+
+    def _reject(self, item, reason: str) -> None:
+        topic, message_dict, seq, _ = item
+        with self._counter_lock:
+            self.rejected += 1
+            self._rejected_unlogged += 1
+            now = time.monotonic()
+            count = 0
+            if now - self._reject_logged_at >= REJECT_LOG_INTERVAL_S:
+                count, self._rejected_unlogged, self._reject_logged_at = self._rejected_unlogged, 0, now
+        if count:
+            fate = "ficam no spool para o replay" if seq is not None else "perdidas (spool desligado)"
+            self.logger.warning(f"Sink {self.name}: {count} escritas não tentadas ({reason}, "
+                                f"última de {message_dict.get('beacon_serial')}); {fate}")
+        self.settle(self.name, seq, False, message_dict)
+
+    def _run(self, items: queue.Queue) -> None:
+        while True:
+            item = items.get()
+            try:
+                if item is None:
+                    return
+                if not self.breaker.allow():
+                    self._reject(item, "circuit breaker aberto")
+                    continue
+                self._process(item)
+            except Exception as e:
+                self.logger.error(f"Erro no despacho para {self.name}: {e}")
+            finally:
+                items.task_done()
+
+    def _process(self, item) -> None:
+        topic, message_dict, seq, enqueued_at = item
+        with self._counter_lock:
+            self._latencies.record('queue_wait', time.monotonic() - enqueued_at)
+        delay = self.retry_backoff_s
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                result = self.write(topic, message_dict, seq)
+            except Exception as e:
+                self.logger.error(f"Erro na escrita em {self.name}: {e}")
+                result = False
+            with self._counter_lock:
+                self._latencies.record('call', time.perf_counter() - start)
+            if result is not False or attempt == self.max_retries or self.breaker.state == OPEN:
+                break
+            with self._counter_lock:
+                self.retries += 1
+            time.sleep(delay)
+            delay *= 2
+
+        if result != QUEUED:
+            # QUEUED: o resultado chega depois, pelo lote do writer (SinkDispatcher.record)
+            self.record(result is not False)
+        with self._counter_lock:
+            if result is False:
+                self.failed += 1
+            else:
+                self.written += 1
+        self.settle(self.name, seq, result, message_dict)
+
+
+class SinkDispatcher:
+    """
+    Fan-out de cada pacote para os sinks, cada um com as próprias filas e threads.
+
+    `sinks` é {nome: write(topic, message_dict, seq)}; write retorna False em falha (como os
+    métodos do MessageProcessor). `settle(sink, seq, resultado, message_dict)` é chamado ao
+    fim de cada escrita, também das recusadas (resultado False).
+    """
+
+    def __init__(self, sinks: dict, settle, sink_options: dict = SINK_OPTIONS, when_full: str = WHEN_FULL,
+                 failure_threshold: int = FAILURE_THRESHOLD, reset_timeout_s: float = RESET_TIMEOUT_S) -> None:
+        self.logger = setup_logger(__name__)
+        self.sinks = {
+            name: _SinkWorker(name, write, settle, {**DEFAULT_SINK_OPTIONS, **(sink_options.get(name) or {})},
+                              when_full, CircuitBreaker(failure_threshold, reset_timeout_s))
+            for name, write in sinks.items()
+        }
+        self._stats_since = time.monotonic()
+        self._closed = False
+
+    def dispatch(self, topic, message_dict: dict, seq=None) -> None:
+        for worker in self.sinks.values():
+            worker.submit(topic, message_dict, seq)
+        self._maybe_log_stats()
+
+    def record(self, sink: str, success: bool) -> None:
+        """Resultado de uma gravação assíncrona (writers em lote) para o breaker do sink"""
+        worker = self.sinks.get(sink)
+        if worker is not None:
+            worker.record(success)
+
+    def drain(self) -> None:
+        """Espera todas as escritas já despachadas"""
+        for worker in self.sinks.values():
+            worker.join()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self.drain()
+        for worker in self.sinks.values():
+            worker.stop()
+        self._log_stats()
+
+    def pending(self) -> int:
+        return sum(worker.pending() for worker in self.sinks.values())
+
+    def stats(self) -> dict:
+        return {name: worker.stats() for name, worker in self.sinks.items()}
+
+    def _maybe_log_stats(self) -> None:
+        if time.monotonic() - self._stats_since >= STATS_LOG_INTERVAL_S:
+            self._log_stats()
+
+    def _log_stats(self) -> None:
+        self._stats_since = time.monotonic()
+        for name, stats in self.stats().items():
+            if not stats['dispatched']:
+                continue
+            self.logger.info(f"Sink {name}: {stats['state']}, pendentes {stats['pending']}, "
+                             f"gravados {stats['written']}, falhas {stats['failed']}, recusados {stats['rejected']}, "
+                             f"lag p99 {stats['lag'].get('p99_ms', 0):.0f} ms, "
+                             f"chamada p99 {stats['latency'].get('p99_ms', 0):.0f} ms")
+            self.sinks[name].reset_latencies()
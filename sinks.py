@@ -0,0 +1,504 @@
+"""
+Backends dos sinks, selecionados em sinks.backend.
+
+    production  Cloud SQL (PostgresConnectionPool) e Firebase (credenciais do .env)
+    local       tudo no processo, sem rede:
+                - Postgres -> SqlitePool, um arquivo SQLite (sinks.sqlite_path) com mqtt_messages
+                  no formato postgres.storage e mqtt_rollups; os BatchedPostgresWriter gravam
+                  nele com o mesmo execute_values
+                - Realtime DB -> MemoryRealtimeDatabase, árvore em memória com
+                  child/get/update/set/listen, get(shallow=True) e order_by_child().equal_to().
+                  Começa com sinks.realtime_db_seed: uma árvore em JSON ou o próprio
+                  mac_equipment_cache.json (STATUS/mac de cada equipamento)
+                - Firestore -> MemoryFirestore: collection/document, set(merge=True), batch(),
+                  get_all() e stream()
+
+Com o backend local o pipeline completo (main.py, replay.py --sink full) roda offline, para
+teste de carga e profiling sem pagar escritas na nuvem. O estado que o processor grava em
+disco (cache de MAC e spool) fica em sinks.local_state_dir (`state_path`), então uma
+execução offline não altera o mac_equipment_cache.json nem o spool de produção; a semente
+é só lida. Os backends em memória são únicos
+por processo (compartilhados pelos workers em modo thread, como o banco real) e aceitam uma
+latência simulada por chamada; o benchmark usa as mesmas classes.
+"""
+
+import copy
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+
+import yaml
+
+from firestore_writer import merge_into
+from logger_config import setup_logger
+from postgres_writer import STORAGE, STORAGE_LAYOUTS
+from rollup import create_rollup_table_sql
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('sinks') or {}
+SINK_BACKEND = config.get('backend', 'production')
+SQLITE_PATH = config.get('sqlite_path', 'output/ln2_local.sqlite3')
+REALTIME_DB_SEED = config.get('realtime_db_seed', 'mac_equipment_cache.json')
+LOCAL_STATE_DIR = config.get('local_state_dir', 'output/local')
+
+SINK_BACKENDS = ('production', 'local')
+
+logger = setup_logger(__name__)
+
+
+def state_path(path: str) -> str:
+    """Arquivo ou diretório de estado do processor (cache de MAC, spool): com backend local, dentro de sinks.local_state_dir"""
+    if SINK_BACKEND != 'local':
+        return path
+    return os.path.join(LOCAL_STATE_DIR, os.path.basename(os.path.normpath(path)))
+
+
+# ---------------------------------------------------------------------------
+# Postgres -> SQLite
+# ---------------------------------------------------------------------------
+
+def sql_literal(value) -> str:
+    """Valor como literal SQL do SQLite (o que o psycopg2 faz no mogrify)"""
+    value = getattr(value, 'adapted', value)  # psycopg2.Binary
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value) if math.isfinite(value) else 'NULL'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"X'{bytes(value).hex()}'"
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class _SqliteCursor:
+    """Cursor com a interface usada pelo execute_values do psycopg2 (mogrify + execute)"""
+
+    def __init__(self, connection) -> None:
+        self.connection = connection
+        self._cursor = connection.raw.cursor()
+
+    def mogrify(self, sql, params=None) -> bytes:
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        if params:
+            sql = sql % tuple(sql_literal(p) for p in params)
+        return sql.encode()
+
+    def execute(self, sql, params=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        if params:
+            sql = self.mogrify(sql, params).decode()
+        self._cursor.execute(sql)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class _SqliteConnection:
+    encoding = 'UTF8'
+
+    def __init__(self, raw: sqlite3.Connection) -> None:
+        self.raw = raw
+        self.closed = 0
+
+    def cursor(self, *args, **kwargs):
+        return _SqliteCursor(self)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+
+class SqlitePool:
+    """
+    Substituto local do PostgresConnectionPool: uma conexão SQLite serializada por lock.
+    Cria mqtt_messages (formato postgres.storage) e mqtt_rollups se não existirem.
+    """
+
+    def __init__(self, path: str = SQLITE_PATH, storage: str = STORAGE) -> None:
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = _SqliteConnection(sqlite3.connect(path, check_same_thread=False))
+        self._lock = threading.Lock()
+        self.commits = 0
+        self.reconnects = 0
+        columns = ',\n    '.join(f'{column} {sql_type}' for column, sql_type, _ in STORAGE_LAYOUTS[storage])
+        self._conn.raw.executescript(f"""
+CREATE TABLE IF NOT EXISTS mqtt_messages (
+    id INTEGER PRIMARY KEY,
+    received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    {columns}
+);
+{create_rollup_table_sql().replace('BIGSERIAL', 'INTEGER')}
+""")
+        logger.info(f"Postgres local (SQLite) em {path}")
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            try:
+                yield self._conn
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def run_transaction(self, work, max_retries: int = 0, description: str = "transação"):
+        with self.connection() as conn:
+            result = work(conn)
+            conn.commit()
+            self.commits += 1
+            return result
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._conn.closed:
+                self._conn.raw.close()
+                self._conn.closed = 1
+
+
+# ---------------------------------------------------------------------------
+# Realtime Database em memória
+# ---------------------------------------------------------------------------
+
+class Event:
+    """Evento entregue aos callbacks de listen() (mesmos atributos do firebase_admin.db.Event)"""
+
+    def __init__(self, event_type: str, path: str, data) -> None:
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+class ListenerRegistration:
+    def __init__(self, tree, listener) -> None:
+        self._tree = tree
+        self._listener = listener
+
+    def close(self) -> None:
+        with self._tree.lock:
+            if self._listener in self._tree.listeners:
+                self._tree.listeners.remove(self._listener)
+
+
+class _RealtimeTree:
+    """Estado compartilhado pelas referências de uma MemoryRealtimeDatabase"""
+
+    def __init__(self, root: dict, latency: float) -> None:
+        self.root = root
+        self.latency = latency
+        self.counters = {'get': 0, 'query': 0, 'update': 0, 'set': 0}
+        self.listeners = []  # [(partes do caminho, callback)]
+        self.lock = threading.RLock()
+
+
+def _split(path: str) -> list:
+    return [key for key in path.split('/') if key]
+
+
+def _prune(root: dict, parts: list) -> None:
+    """Remove mapas que ficaram vazios no caminho (o Realtime Database não guarda nós vazios)"""
+    for depth in range(len(parts), 0, -1):
+        node = root
+        for key in parts[:depth - 1]:
+            node = node.get(key) if isinstance(node, dict) else None
+        if isinstance(node, dict) and node.get(parts[depth - 1]) == {}:
+            del node[parts[depth - 1]]
+
+
+class MemoryRealtimeDatabase:
+    """Substituto de db.reference() sobre um dict aninhado: child/get/update/set/listen e consultas por filho"""
+
+    def __init__(self, root: dict = None, path: str = '', latency: float = 0.0, _tree: _RealtimeTree = None) -> None:
+        self._tree = _tree or _RealtimeTree(root if root is not None else {}, latency)
+        self.path = '/'.join(_split(path))
+        self.key = _split(path)[-1] if self.path else None
+
+    @property
+    def counters(self) -> dict:
+        return self._tree.counters
+
+    @property
+    def latency(self) -> float:
+        return self._tree.latency
+
+    def child(self, path):
+        return MemoryRealtimeDatabase(path=f"{self.path}/{path}", _tree=self._tree)
+
+    def _call(self, kind):
+        if self._tree.latency:
+            time.sleep(self._tree.latency)
+        with self._tree.lock:
+            self._tree.counters[kind] += 1
+
+    def _node(self, parts=None):
+        node = self._tree.root
+        for key in _split(self.path) if parts is None else parts:
+            if not isinstance(node, dict) or key not in node:
+                return None
+            node = node[key]
+        return node
+
+    def get(self, shallow=False):
+        self._call('get')
+        with self._tree.lock:
+            node = self._node()
+            if shallow and isinstance(node, dict):
+                return {key: True if isinstance(value, dict) else value for key, value in node.items()}
+            return copy.deepcopy(node)
+
+    def order_by_child(self, path):
+        return _MemoryRealtimeQuery(self, path)
+
+    def set(self, value):
+        self._call('set')
+        with self._tree.lock:
+            self._write({'': value})
+            events = self._events('put', {'': value})
+        self._notify(events)
+
+    def update(self, values):
+        self._call('update')
+        with self._tree.lock:
+            self._write(values)
+            events = self._events('patch', values)
+        self._notify(events)
+
+    def listen(self, callback):
+        """Chama callback(Event) com o valor atual ('put' em '/') e depois a cada mudança sob o nó"""
+        listener = (_split(self.path), callback)
+        with self._tree.lock:
+            self._tree.listeners.append(listener)
+            data = copy.deepcopy(self._node())
+        callback(Event('put', '/', data))
+        return ListenerRegistration(self._tree, listener)
+
+    def _write(self, values: dict) -> None:
+        base = _split(self.path)
+        for key, value in values.items():
+            parts = base + _split(key)
+            if not parts:
+                self._tree.root.clear()
+                self._tree.root.update(copy.deepcopy(value) if isinstance(value, dict) else {})
+                continue
+            *parents, leaf = parts
+            target = self._tree.root
+            for parent in parents:
+                if not isinstance(target.get(parent), dict):
+                    target[parent] = {}
+                target = target[parent]
+            if value is None:
+                target.pop(leaf, None)  # None apaga o nó, como no Firebase
+                _prune(self._tree.root, parents)
+            else:
+                target[leaf] = copy.deepcopy(value)
+
+    def _events(self, event_type: str, values: dict) -> list:
+        """Eventos dos listeners afetados pela escrita, montados ainda sob o lock"""
+        base = _split(self.path)
+        written = [base + _split(key) for key in values]
+        events = []
+        for listen_parts, callback in self._tree.listeners:
+            depth = len(listen_parts)
+            if base[:depth] == listen_parts:
+                # Escrita no nó escutado ou abaixo dele: caminho relativo ao listener
+                relative = '/' + '/'.join(base[depth:])
+                if event_type == 'patch':
+                    data = copy.deepcopy(values)
+                else:
+                    data = copy.deepcopy(values[''])
+                events.append((callback, Event(event_type, relative, data)))
+            elif any(listen_parts[:len(parts)] == parts or parts[:depth] == listen_parts for parts in written):
+                # Escrita acima do nó escutado (ou um update multi-path que passa por ele): o novo valor inteiro
+                events.append((callback, Event('put', '/', copy.deepcopy(self._node(listen_parts)))))
+        return events
+
+    @staticmethod
+    def _notify(events: list) -> None:
+        for callback, event in events:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Erro em callback de listen(): {e}")
+
+
+class _MemoryRealtimeQuery:
+    def __init__(self, ref: MemoryRealtimeDatabase, path: str) -> None:
+        self.ref = ref
+        self.path = _split(path)
+        self.value = None
+
+    def equal_to(self, value):
+        self.value = value
+        return self
+
+    def get(self):
+        self.ref._call('query')
+        result = {}
+        with self.ref._tree.lock:
+            for key, child in (self.ref._node() or {}).items():
+                node = child
+                for part in self.path:
+                    node = node.get(part) if isinstance(node, dict) else None
+                if node == self.value:
+                    result[key] = copy.deepcopy(child)
+        return result
+
+
+def load_realtime_seed(path: str = REALTIME_DB_SEED) -> dict:
+    """Árvore inicial do Realtime DB local: JSON da árvore ou o arquivo do cache de MAC"""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Erro ao ler {path} para o Realtime DB local: {e}")
+        return {}
+    if isinstance(data, dict) and 'mac_mapping' in data:
+        return {equipment_id: {'STATUS': {'mac': mac}} for mac, equipment_id in data['mac_mapping'].items()}
+    return data if isinstance(data, dict) else {}
+
+
+# ---------------------------------------------------------------------------
+# Firestore em memória
+# ---------------------------------------------------------------------------
+
+class _Snapshot:
+    def __init__(self, ref, data) -> None:
+        self.reference = ref
+        self.id = ref.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class MemoryFirestore:
+    """
+    Substituto do cliente Firestore: collection/document encadeados, set(merge), batch(),
+    get_all() e stream(). Com store=False só conta escritas e round-trips (benchmark).
+    """
+
+    def __init__(self, latency: float = 0.0, store: bool = True) -> None:
+        self.latency = latency
+        self.store = store
+        self.writes = 0
+        self.commits = 0  # Round-trips: set() avulso ou commit de lote
+        self._documents = {}  # caminho -> dados
+        self._children = {}  # caminho da coleção -> ids dos documentos
+        self._lock = threading.Lock()
+
+    def collection(self, name):
+        return _MemoryFirestoreRef(self, name)
+
+    def batch(self):
+        return _MemoryWriteBatch(self)
+
+    def get_all(self, refs):
+        self._round_trip(0)
+        with self._lock:
+            return [_Snapshot(ref, copy.deepcopy(self._documents.get(ref.path))) for ref in refs]
+
+    def _round_trip(self, writes: int) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.writes += writes
+            self.commits += 1
+
+    def _apply(self, ref, data: dict, merge: bool) -> None:
+        if not self.store:
+            return
+        data = copy.deepcopy(data)
+        with self._lock:
+            current = self._documents.get(ref.path)
+            if merge and current is not None:
+                merge_into(current, data)
+            else:
+                self._documents[ref.path] = data
+                parent, _, doc_id = ref.path.rpartition('/')
+                self._children.setdefault(parent, set()).add(doc_id)
+
+
+class _MemoryWriteBatch:
+    def __init__(self, client: MemoryFirestore) -> None:
+        self.client = client
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref, data, merge))
+
+    def commit(self):
+        self.client._round_trip(len(self._writes))
+        for ref, data, merge in self._writes:
+            self.client._apply(ref, data, merge)
+
+
+class _MemoryFirestoreRef:
+    def __init__(self, client: MemoryFirestore, path: str) -> None:
+        self.client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return _MemoryFirestoreRef(self.client, f"{self.path}/{name}")
+
+    document = collection
+
+    def set(self, data, merge=False):
+        self.client._round_trip(1)
+        self.client._apply(self, data, merge)
+
+    def get(self):
+        return self.client.get_all([self])[0]
+
+    def stream(self):
+        self.client._round_trip(0)
+        with self.client._lock:
+            ids = sorted(self.client._children.get(self.path, ()))
+            return [_Snapshot(ref, copy.deepcopy(self.client._documents.get(ref.path)))
+                    for ref in (self.document(doc_id) for doc_id in ids)]
+
+
+_local_lock = threading.Lock()
+_local_backends = {}
+
+
+def local_firebase():
+    """(MemoryFirestore, MemoryRealtimeDatabase) do processo, criados no primeiro uso"""
+    with _local_lock:
+        if not _local_backends:
+            _local_backends['firestore'] = MemoryFirestore()
+            _local_backends['realtime_db'] = MemoryRealtimeDatabase(load_realtime_seed())
+            logger.info(f"Firestore e Realtime Database locais em memória "
+                        f"({len(_local_backends['realtime_db'].get(shallow=True) or {})} equipamentos iniciais)")
+        return _local_backends['firestore'], _local_backends['realtime_db']
@@ -0,0 +1,440 @@
+"""
+Spool local (write-ahead) dos registros enviados aos sinks.
+
+Com spool.enabled, cada registro que o MessageProcessor envia aos sinks (Postgres,
+Firestore, Realtime DB) é gravado antes em disco e só é considerado entregue a um sink
+quando esse sink confirma a escrita. Se o link com o GCP cair, os registros não
+confirmados ficam no spool e o SpoolReplayer os reenvia quando o sink volta, em ritmo
+controlado (spool.replay_rate_per_s).
+
+Formato em disco (spool.dir):
+    <primeiro seq>.seg  segmentos de tamanho fixo (spool.segment_size_mb), mapeados em
+                        memória (mmap), só com append. Cada registro tem o cabeçalho
+                        (tamanho, crc32, seq) seguido do JSON do registro; um tamanho 0
+                        marca o fim dos dados. Um registro com CRC inválido (escrita
+                        interrompida) encerra a leitura do segmento.
+    acks.json           estado de confirmação por sink: watermark (todos os seq até ele
+                        foram confirmados) e os seq confirmados acima dele
+    LOCK                impede dois processos de usarem o mesmo diretório
+
+O msync dos segmentos e a gravação do acks.json são feitos em lote a cada
+spool.fsync_interval_ms por uma thread própria; em uma queda do processo perde-se no
+máximo esse intervalo. Segmentos já confirmados por todos os sinks são apagados.
+"""
+
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+import yaml
+
+from logger_config import setup_logger
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('spool') or {}
+SPOOL_ENABLED = bool(config.get('enabled', False))
+SPOOL_DIR = config.get('dir', './spool')
+SEGMENT_SIZE_MB = float(config.get('segment_size_mb', 64))
+FSYNC_INTERVAL_MS = int(config.get('fsync_interval_ms', 200))
+SPOOL_SINKS = tuple(config.get('sinks') or ('postgres', 'firestore', 'realtime_db'))
+REPLAY_RATE_PER_S = float(config.get('replay_rate_per_s', 50))
+REPLAY_CHECK_INTERVAL_S = float(config.get('replay_check_interval_s', 30))
+
+# Sinks que guardam só o estado atual do beacon: no replay basta o registro mais recente
+LATEST_ONLY_SINKS = ('realtime_db',)
+
+# Retorno de um sink que entregou o registro a um writer em lote: a confirmação vem depois,
+# pelo callback on_batch_done do writer (BatchedPostgresWriter, BatchedFirestoreWriter)
+QUEUED = 'queued'
+
+_HEADER = struct.Struct('>IIQ')  # tamanho do JSON, crc32 do JSON, seq
+_SEGMENT_SUFFIX = '.seg'
+
+
+class _Segment:
+    """Arquivo de segmento pré-alocado e mapeado em memória"""
+
+    def __init__(self, path: str, first_seq: int, size: int = None) -> None:
+        # size informado cria o arquivo; sem size abre um segmento existente
+        self.path = path
+        self.first_seq = first_seq
+        self._file = open(path, 'r+b' if size is None else 'w+b')
+        if size is not None:
+            self._file.truncate(size)
+        self.size = os.fstat(self._file.fileno()).st_size
+        self.mm = mmap.mmap(self._file.fileno(), self.size)
+        self.position = 0
+        self.last_seq = first_seq - 1
+
+    def records(self, start: int = 0, limit: int = None):
+        """(seq, posição, bytes do JSON) a partir de `start` até o fim dos dados válidos"""
+        limit = self.size if limit is None else limit
+        position = start
+        while position + _HEADER.size <= limit:
+            length, crc, seq = _HEADER.unpack_from(self.mm, position)
+            end = position + _HEADER.size + length
+            if length == 0 or end > limit:
+                break
+            data = self.mm[position + _HEADER.size:end]
+            if zlib.crc32(data) != crc:
+                break
+            yield seq, position, data
+            position = end
+
+    def recover(self) -> None:
+        """Posiciona o fim do segmento após o último registro válido"""
+        for seq, position, data in self.records():
+            self.position = position + _HEADER.size + len(data)
+            self.last_seq = seq
+
+    def fits(self, length: int) -> bool:
+        return self.position + _HEADER.size + length <= self.size
+
+    def append(self, seq: int, data: bytes) -> None:
+        _HEADER.pack_into(self.mm, self.position, len(data), zlib.crc32(data), seq)
+        start = self.position + _HEADER.size
+        self.mm[start:start + len(data)] = data
+        self.position = start + len(data)
+        self.last_seq = seq
+
+    def flush(self) -> None:
+        self.mm.flush()
+
+    def close(self) -> None:
+        self.mm.close()
+        self._file.close()
+
+
+class _SinkState:
+    __slots__ = ('watermark', 'acked', 'inflight', 'latest')
+
+    def __init__(self, watermark: int, acked=()) -> None:
+        self.watermark = watermark    # Todos os seq <= watermark foram confirmados
+        self.acked = set(acked)       # Confirmados acima do watermark (confirmações fora de ordem)
+        self.inflight = set()         # Entregues ao sink e ainda sem resposta
+        self.latest = {}              # chave (beacon) -> maior seq confirmado, para LATEST_ONLY_SINKS
+
+    def is_pending(self, seq: int) -> bool:
+        return seq > self.watermark and seq not in self.acked and seq not in self.inflight
+
+
+class WriteAheadSpool:
+    def __init__(self, directory: str = SPOOL_DIR, sinks=SPOOL_SINKS, segment_size_mb: float = SEGMENT_SIZE_MB,
+                 fsync_interval_ms: int = FSYNC_INTERVAL_MS) -> None:
+        self.directory = directory
+        self.sinks = tuple(sinks)
+        self.segment_size = int(segment_size_mb * 1024 * 1024)
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.logger = setup_logger(__name__)
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._acks_dirty = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, 'LOCK'), 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise RuntimeError(f"Spool {directory} já está em uso por outro processo")
+
+        self._segments = []  # Segmentos fechados, em ordem (abertos sob demanda na leitura)
+        self._current = None
+        self.next_seq = 1
+        self._recover()
+
+        self._stop = threading.Event()
+        self._sync_thread = threading.Thread(target=self._sync_loop, name='spool-sync', daemon=True)
+        self._sync_thread.start()
+
+    # -- escrita ---------------------------------------------------------------------------
+
+    def append(self, topic, message_dict, timestamp: datetime = None) -> int:
+        """Grava um registro e o marca como em andamento em todos os sinks; retorna o seq"""
+        timestamp = timestamp or datetime.now(timezone.utc)
+        data = json.dumps({'topic': topic, 'message': message_dict, 'timestamp': timestamp.isoformat()},
+                          default=str, separators=(',', ':')).encode()
+        with self._lock:
+            seq = self.next_seq
+            if self._current is None or not self._current.fits(len(data)):
+                self._roll(seq, len(data))
+            self._current.append(seq, data)
+            self.next_seq = seq + 1
+            for state in self._states.values():
+                state.inflight.add(seq)
+            self._dirty = True
+        return seq
+
+    def ack(self, sink: str, seq: int, key=None) -> None:
+        """O sink gravou o registro (ou o descartou de vez, como em erro de dados)"""
+        with self._lock:
+            state = self._states.get(sink)
+            if state is None:
+                return
+            state.inflight.discard(seq)
+            if key is not None and seq > state.latest.get(key, 0):
+                state.latest[key] = seq
+            if seq <= state.watermark:
+                return
+            state.acked.add(seq)
+            while state.watermark + 1 in state.acked:
+                state.watermark += 1
+                state.acked.discard(state.watermark)
+            self._acks_dirty = True
+
+    def nack(self, sink: str, seq: int) -> None:
+        """A escrita falhou: o registro fica pendente para o replay"""
+        with self._lock:
+            state = self._states.get(sink)
+            if state is not None:
+                state.inflight.discard(seq)
+
+    def begin(self, sink: str, seq: int) -> None:
+        """Marca um registro pendente como reenviado (usado pelo replay)"""
+        with self._lock:
+            state = self._states.get(sink)
+            if state is not None:
+                state.inflight.add(seq)
+
+    # -- leitura para o replay -------------------------------------------------------------
+
+    def latest_acked(self, sink: str, key) -> int:
+        with self._lock:
+            state = self._states.get(sink)
+            return state.latest.get(key, 0) if state else 0
+
+    def pending(self, sink: str):
+        """
+        Registros ainda não confirmados pelo sink e que não estão em andamento, em ordem:
+        (seq, topic, message_dict, timestamp)
+        """
+        with self._lock:
+            state = self._states[sink]
+            watermark = state.watermark
+            segments = list(self._segments)
+            current_end = None
+            if self._current is not None:
+                segments.append((self._current.first_seq, self._current.path))
+                current_end = self._current.position
+        start = max(0, bisect.bisect_right([first for first, _ in segments], watermark + 1) - 1)
+        for index in range(start, len(segments)):
+            first_seq, path = segments[index]
+            limit = current_end if index == len(segments) - 1 else None
+            try:
+                # Mapeamento próprio: o segmento atual pode ser fechado pelo append durante a leitura
+                segment = _Segment(path, first_seq)
+            except FileNotFoundError:
+                continue  # Apagado depois de confirmado por todos os sinks
+            try:
+                for seq, _, data in segment.records(limit=limit):
+                    with self._lock:
+                        pending = state.is_pending(seq)
+                    if pending:
+                        record = json.loads(data)
+                        yield seq, record['topic'], record['message'], datetime.fromisoformat(record['timestamp'])
+            finally:
+                segment.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            last = self.next_seq - 1
+            return {
+                'last_seq': last,
+                'segments': len(self._segments) + (1 if self._current else 0),
+                'backlog': {sink: last - state.watermark - len(state.acked) for sink, state in self._states.items()},
+            }
+
+    # -- sync, limpeza e recuperação -------------------------------------------------------
+
+    def sync(self) -> None:
+        """msync do segmento atual, grava o acks.json e apaga segmentos já confirmados"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, False
+            acks_dirty, self._acks_dirty = self._acks_dirty, False
+            current = self._current
+            acks = {sink: {'watermark': state.watermark, 'acked': sorted(state.acked)}
+                    for sink, state in self._states.items()}
+            min_watermark = min((state.watermark for state in self._states.values()), default=self.next_seq - 1)
+        if dirty and current is not None:
+            current.flush()
+        if acks_dirty:
+            self._write_acks(acks)
+            self._remove_acknowledged_segments(min_watermark)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._sync_thread.join()
+        with self._lock:
+            self._dirty = self._acks_dirty = True
+        self.sync()
+        with self._lock:
+            if self._current is not None:
+                self._current.close()
+                self._current = None
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+
+    def _sync_loop(self) -> None:
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                self.logger.error(f"Erro ao sincronizar o spool: {e}")
+
+    def _roll(self, seq: int, length: int) -> None:
+        """Fecha o segmento atual (com msync) e abre um novo começando em seq (chamado com _lock)"""
+        if self._current is not None:
+            self._current.flush()
+            self._current.close()
+            self._segments.append((self._current.first_seq, self._current.path))
+        path = os.path.join(self.directory, f"{seq:020d}{_SEGMENT_SUFFIX}")
+        self._current = _Segment(path, seq, max(self.segment_size, _HEADER.size * 2 + length))
+
+    def _remove_acknowledged_segments(self, min_watermark: int) -> None:
+        with self._lock:
+            removable = []
+            boundaries = [first for first, _ in self._segments[1:]]
+            if self._current is not None:
+                boundaries.append(self._current.first_seq)
+            # Um segmento fechado termina antes do primeiro seq do seguinte
+            for (first_seq, path), next_first in zip(self._segments, boundaries):
+                if next_first - 1 > min_watermark:
+                    break
+                removable.append((first_seq, path))
+            del self._segments[:len(removable)]
+        for _, path in removable:
+            try:
+                os.remove(path)
+            except OSError as e:
+                self.logger.warning(f"Não foi possível apagar o segmento {path}: {e}")
+
+    def _write_acks(self, acks: dict) -> None:
+        path = os.path.join(self.directory, 'acks.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(acks, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _recover(self) -> None:
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(_SEGMENT_SUFFIX))
+        segments = [(int(name[:-len(_SEGMENT_SUFFIX)]), os.path.join(self.directory, name)) for name in names]
+        acks = {}
+        acks_path = os.path.join(self.directory, 'acks.json')
+        if os.path.exists(acks_path):
+            try:
+                with open(acks_path, 'r') as f:
+                    acks = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                self.logger.error(f"acks.json do spool ilegível, tudo será reenviado: {e}")
+
+        if segments:
+            first_seq, path = segments[-1]
+            self._current = _Segment(path, first_seq)
+            self._current.recover()
+            self._segments = segments[:-1]
+            self.next_seq = self._current.last_seq + 1
+        else:
+            self.next_seq = max([state.get('watermark', 0) for state in acks.values()], default=0) + 1
+
+        # Sem estado salvo (sink novo ou acks.json perdido), tudo o que está no spool fica pendente
+        oldest = (segments[0][0] - 1) if segments else self.next_seq - 1
+        self._states = {}
+        for sink in self.sinks:
+            saved = acks.get(sink) or {}
+            self._states[sink] = _SinkState(max(saved.get('watermark', oldest), oldest),
+                                            [seq for seq in saved.get('acked', []) if seq > oldest])
+        backlog = {sink: self.next_seq - 1 - state.watermark - len(state.acked) for sink, state in self._states.items()}
+        if any(backlog.values()):
+            self.logger.warning(f"Spool com registros pendentes de sessões anteriores: {backlog}")
+
+
+class SpoolReplayer:
+    """
+    Reenvia, em uma thread, os registros pendentes de cada sink quando o sink volta.
+
+    A cada spool.replay_check_interval_s percorre os pendentes de cada sink em ordem, no
+    máximo spool.replay_rate_per_s por segundo; na primeira falha desiste e tenta no próximo
+    ciclo. Para o Realtime DB (LATEST_ONLY_SINKS) só o registro mais recente de cada beacon
+    é reenviado, e só se nenhum registro mais novo já tiver sido gravado ao vivo.
+    """
+
+    def __init__(self, spool: WriteAheadSpool, writers: dict, rate_per_s: float = REPLAY_RATE_PER_S,
+                 check_interval_s: float = REPLAY_CHECK_INTERVAL_S) -> None:
+        # writers: sink -> função(seq, topic, message_dict, timestamp) que retorna False em falha
+        # ou QUEUED quando o writer em lote confirma depois
+        self.spool = spool
+        self.writers = writers
+        self.interval = 1 / rate_per_s if rate_per_s > 0 else 0
+        self.check_interval_s = check_interval_s
+        self.logger = setup_logger(__name__)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='spool-replayer', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.check_interval_s):
+            for sink, writer in self.writers.items():
+                if sink not in self.spool.sinks:
+                    continue
+                try:
+                    self.replay_sink(sink, writer)
+                except Exception as e:
+                    self.logger.error(f"Erro no replay do spool para {sink}: {e}")
+
+    def replay_sink(self, sink: str, writer) -> int:
+        records = self.spool.pending(sink)
+        if sink in LATEST_ONLY_SINKS:
+            records = self._latest_per_beacon(sink, records)
+        replayed = 0
+        for seq, topic, message_dict, timestamp in records:
+            if self._stop.is_set():
+                break
+            self.spool.begin(sink, seq)
+            result = writer(seq, topic, message_dict, timestamp)
+            if result is False:
+                self.spool.nack(sink, seq)
+                self.logger.warning(f"Replay do spool para {sink} interrompido no seq {seq}; nova tentativa em "
+                                    f"{self.check_interval_s:.0f} s")
+                break
+            if result != QUEUED:
+                self.spool.ack(sink, seq, key=message_dict.get('beacon_serial'))
+            replayed += 1
+            if self.interval:
+                time.sleep(self.interval)
+        if replayed:
+            self.logger.info(f"Replay do spool: {replayed} registros reenviados para {sink}")
+        return replayed
+
+    def _latest_per_beacon(self, sink: str, records) -> list:
+        newest = {}
+        for record in records:
+            beacon = record[2].get('beacon_serial')
+            previous = newest.get(beacon)
+            if previous is not None:
+                self.spool.ack(sink, previous[0])  # Substituído por um registro mais novo do mesmo beacon
+            newest[beacon] = record
+        selected = []
+        for beacon, record in newest.items():
+            if self.spool.latest_acked(sink, beacon) > record[0]:
+                self.spool.ack(sink, record[0])  # Já existe um estado mais novo gravado ao vivo
+            else:
+                selected.append(record)
+        return sorted(selected, key=lambda record: record[0])
@@ -0,0 +1,361 @@
+"""
+API local de leitura do estado mais recente de cada beacon, servida da memória.
+
+O MessageProcessor atualiza o BeaconStateIndex a cada pacote decodificado (não só nos
+envios de 5 minutos), então a API responde com o estado mais novo sem ler o Realtime
+Database. O servidor HTTP roda em uma thread do próprio processo, em host:port ou em um
+socket Unix (state_api.unix_socket).
+
+Rotas (GET):
+    /health                    número de beacons e versão do índice
+    /beacons                   snapshot da frota
+    /beacons/<beacon_serial>   estado de um beacon
+    /equipment/<equipment_id>  estado do beacon do equipamento (ex: LN2-00100)
+    /notifications             estado do sistema de notificações
+    /sinks                     saúde, pendentes e lag de cada sink (ver sink_dispatcher.py)
+
+Formatos: JSON (padrão) ou binário compacto com ?format=bin ou
+`Accept: application/octet-stream` (só /beacons e /beacons/<serial>, ver encode_binary).
+
+Exemplos:
+    curl http://127.0.0.1:8081/beacons/90395E0AE8A7
+    curl --unix-socket /tmp/ln2_state.sock 'http://localhost/beacons?format=bin' -o frota.bin
+"""
+
+import json
+import os
+import socketserver
+import struct
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import yaml
+
+from logger_config import setup_logger
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('state_api') or {}
+STATE_API_ENABLED = bool(config.get('enabled', False))
+STATE_API_HOST = config.get('host') or '127.0.0.1'
+STATE_API_PORT = int(config.get('port', 8081))
+STATE_API_UNIX_SOCKET = config.get('unix_socket') or None
+
+JSON_CONTENT_TYPE = 'application/json'
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+
+# Formato binário: cabeçalho (magic, versão, número de registros) + um registro fixo por beacon.
+# Temperaturas em centésimos de grau; valores ausentes usam o sentinela do tipo.
+BINARY_MAGIC = b'LN2S'
+BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct('>4sBI')
+_BINARY_RECORD = struct.Struct('>6sIhhHHbB5B')  # 25 bytes
+BINARY_STATUS_FIELDS = ('ln2_general_status', 'ln2_level_status', 'ln2_angle_status',
+                        'ln2_battery_status', 'ln2_foam_status')
+_MISSING_INT16 = -0x8000
+_MISSING_UINT16 = 0xFFFF
+_MISSING_INT8 = -0x80
+_MISSING_UINT8 = 0xFF
+
+
+def _status_code(value):
+    """'4 - Good' -> 4"""
+    try:
+        return int(str(value).split(' - ')[0])
+    except (ValueError, TypeError):
+        return None
+
+
+def _bounded(value, minimum, maximum, missing, scale=1):
+    try:
+        value = round(float(value) * scale)
+    except (TypeError, ValueError):
+        return missing
+    return value if minimum <= value <= maximum and value != missing else missing
+
+
+def _batt_percent(value):
+    try:
+        return int(value, 16) if isinstance(value, str) else int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def encode_binary(states: list) -> bytes:
+    """Codifica estados de beacons no formato binário compacto (ver decode_binary)"""
+    parts = [_BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(states))]
+    pack = _BINARY_RECORD.pack
+    for state in states:
+        data = state['data']
+        try:
+            serial = bytes.fromhex(state['beacon_serial'])[:6].rjust(6, b'\0')
+        except (TypeError, ValueError):
+            serial = bytes(6)
+        statuses = [_bounded(_status_code(data.get(field)), 0, 254, _MISSING_UINT8) for field in BINARY_STATUS_FIELDS]
+        parts.append(pack(
+            serial,
+            int(state['received_at_epoch']),
+            _bounded(data.get('temp_pt100'), -0x7FFF, 0x7FFF, _MISSING_INT16, scale=100),
+            _bounded(data.get('temp_ambient'), -0x7FFF, 0x7FFF, _MISSING_INT16, scale=100),
+            _bounded(data.get('vbat_mv'), 0, 0xFFFE, _MISSING_UINT16),
+            _bounded(data.get('angle_to_horizontal'), 0, 0xFFFE, _MISSING_UINT16),
+            _bounded(data.get('rssi'), -0x7F, 0x7F, _MISSING_INT8),
+            _bounded(_batt_percent(data.get('batt_percent')), 0, 254, _MISSING_UINT8),
+            *statuses,
+        ))
+    return b''.join(parts)
+
+
+def decode_binary(payload: bytes) -> list:
+    """Decodifica a resposta binária em uma lista de dicts (para scripts e ferramentas internas)"""
+    magic, version, count = _BINARY_HEADER.unpack_from(payload)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"Formato binário desconhecido: {magic!r} v{version}")
+    states = []
+    for index in range(count):
+        (serial, epoch, temp_pt100, temp_ambient, vbat_mv, angle, rssi, batt_percent,
+         *statuses) = _BINARY_RECORD.unpack_from(payload, _BINARY_HEADER.size + index * _BINARY_RECORD.size)
+        state = {
+            'beacon_serial': serial.hex().upper(),
+            'received_at': datetime.fromtimestamp(epoch, tz=timezone.utc),
+            'temp_pt100': None if temp_pt100 == _MISSING_INT16 else temp_pt100 / 100,
+            'temp_ambient': None if temp_ambient == _MISSING_INT16 else temp_ambient / 100,
+            'vbat_mv': None if vbat_mv == _MISSING_UINT16 else vbat_mv,
+            'angle_to_horizontal': None if angle == _MISSING_UINT16 else angle,
+            'rssi': None if rssi == _MISSING_INT8 else rssi,
+            'batt_percent': None if batt_percent == _MISSING_UINT8 else batt_percent,
+        }
+        for field, code in zip(BINARY_STATUS_FIELDS, statuses):
+            state[field] = None if code == _MISSING_UINT8 else code
+        states.append(state)
+    return states
+
+
+class BeaconStateIndex:
+    """
+    Último pacote decodificado de cada beacon, indexado por beacon_serial e equipment_id.
+
+    `update` é chamado no loop de processamento e só troca a referência do estado do
+    beacon; as leituras da API não bloqueiam o processamento.
+    """
+
+    def __init__(self) -> None:
+        self._states = {}  # beacon_serial -> estado
+        self._by_equipment = {}  # equipment_id -> beacon_serial
+        self._notification_handlers = []
+        self._sink_dispatchers = []
+        self._lock = threading.Lock()
+        self.version = 0  # Incrementado a cada atualização (cache dos snapshots)
+        self._snapshot_cache = {}  # formato -> (versão, bytes)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def update(self, beacon_serial, message_dict: dict, received_at: datetime, equipment_resolver=None) -> None:
+        if not beacon_serial:
+            return
+        previous = self._states.get(beacon_serial)
+        equipment_id = previous['equipment_id'] if previous else None
+        if equipment_id is None and equipment_resolver is not None:
+            equipment_id = equipment_resolver(beacon_serial)
+        state = {
+            'beacon_serial': beacon_serial,
+            'equipment_id': equipment_id,
+            'received_at': received_at.isoformat(),
+            'received_at_epoch': received_at.timestamp(),
+            'packets': previous['packets'] + 1 if previous else 1,
+            'data': {k: v for k, v in message_dict.items() if k not in ('original_payload', 'rollup')},
+        }
+        with self._lock:
+            self._states[beacon_serial] = state
+            if equipment_id is not None:
+                self._by_equipment[equipment_id] = beacon_serial
+            self.version += 1
+
+    def get(self, beacon_serial):
+        return self._states.get(beacon_serial)
+
+    def get_by_equipment(self, equipment_id):
+        beacon_serial = self._by_equipment.get(equipment_id)
+        return self._states.get(beacon_serial) if beacon_serial else None
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return list(self._states.values())
+
+    def encoded_snapshot(self, fmt: str) -> bytes:
+        """Snapshot da frota já codificado; reaproveitado enquanto nenhum beacon mudar"""
+        version = self.version
+        cached = self._snapshot_cache.get(fmt)
+        if cached and cached[0] == version:
+            return cached[1]
+        states = self.snapshot()
+        body = encode_binary(states) if fmt == 'bin' else _json_bytes({'beacons': states, 'count': len(states)})
+        self._snapshot_cache[fmt] = (version, body)
+        return body
+
+    def add_notification_handler(self, handler) -> None:
+        with self._lock:
+            self._notification_handlers.append(handler)
+
+    def remove_notification_handler(self, handler) -> None:
+        with self._lock:
+            if handler in self._notification_handlers:
+                self._notification_handlers.remove(handler)
+
+    def add_sink_dispatcher(self, dispatcher) -> None:
+        with self._lock:
+            self._sink_dispatchers.append(dispatcher)
+
+    def remove_sink_dispatcher(self, dispatcher) -> None:
+        with self._lock:
+            if dispatcher in self._sink_dispatchers:
+                self._sink_dispatchers.remove(dispatcher)
+
+    def sink_state(self) -> dict:
+        """Stats por sink de cada SinkDispatcher (um por MessageProcessor)"""
+        with self._lock:
+            dispatchers = list(self._sink_dispatchers)
+        return {'dispatchers': [dispatcher.stats() for dispatcher in dispatchers]}
+
+    def notification_state(self) -> dict:
+        """Resumo, status por equipamento e notificações ativas de todos os NotificationHandlers"""
+        with self._lock:
+            handlers = list(self._notification_handlers)
+        summaries, devices, active = [], {}, {}
+        for handler in handlers:
+            summaries.append(handler.get_status_summary())
+            for equipment_id, device in list(handler.device_cache.items()):
+                devices[equipment_id] = {
+                    'last_status_values': dict(device.last_status_values),
+                    'last_seen': device.last_seen.isoformat(),
+                    'pending_notifications': len(device.pending_notifications),
+                }
+            for equipment_id, notifications in list(handler.active_notifications_cache.items()):
+                active[equipment_id] = handler._serialize_notification_data(dict(notifications))
+        return {'handlers': summaries, 'devices': devices, 'active_notifications': active}
+
+
+def _json_bytes(value) -> bytes:
+    return json.dumps(value, default=str, separators=(',', ':')).encode()
+
+
+# Índice do processo: compartilhado pelos MessageProcessors em modo thread (beacons particionados)
+STATE_INDEX = BeaconStateIndex()
+
+
+class _StateRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'LN2StateAPI/1'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        binary = (query.get('format') == ['bin']) or BINARY_CONTENT_TYPE in (self.headers.get('Accept') or '')
+        parts = [part for part in url.path.split('/') if part]
+        index = self.server.state_index
+        try:
+            if parts == ['health']:
+                self._send_json({'status': 'ok', 'beacons': len(index), 'version': index.version})
+            elif parts == ['beacons']:
+                fmt = 'bin' if binary else 'json'
+                self._send(200, index.encoded_snapshot(fmt), BINARY_CONTENT_TYPE if binary else JSON_CONTENT_TYPE)
+            elif len(parts) == 2 and parts[0] in ('beacons', 'equipment'):
+                if parts[0] == 'beacons':
+                    state = index.get(parts[1].upper())
+                else:
+                    state = index.get_by_equipment(parts[1])
+                if state is None:
+                    self._send_json({'error': 'beacon não encontrado'}, 404)
+                elif binary:
+                    self._send(200, encode_binary([state]), BINARY_CONTENT_TYPE)
+                else:
+                    self._send_json(state)
+            elif parts == ['notifications']:
+                self._send_json(index.notification_state())
+            elif parts == ['sinks']:
+                self._send_json(index.sink_state())
+            else:
+                self._send_json({'error': 'rota não encontrada'}, 404)
+        except Exception as e:
+            self.server.logger.error(f"Erro na API de estado ({self.path}): {e}")
+            self._send_json({'error': str(e)}, 500)
+
+    def _send_json(self, value, status: int = 200) -> None:
+        self._send(status, _json_bytes(value), JSON_CONTENT_TYPE)
+
+    def _send(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # No socket Unix client_address é uma string vazia
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(f"{self.address_string()} {format % args}")
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class StateApiServer:
+    """Servidor HTTP da API de estado em uma thread própria"""
+
+    def __init__(self, index: BeaconStateIndex = STATE_INDEX, host: str = STATE_API_HOST,
+                 port: int = STATE_API_PORT, unix_socket: str = STATE_API_UNIX_SOCKET) -> None:
+        self.index = index
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.logger = setup_logger(__name__)
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self) -> str:
+        return self.unix_socket if self.unix_socket else f"http://{self.host}:{self.port}"
+
+    def start(self) -> None:
+        if self.unix_socket:
+            if os.path.exists(self.unix_socket):
+                os.unlink(self.unix_socket)  # Socket de uma execução anterior
+            self._server = _UnixHTTPServer(self.unix_socket, _StateRequestHandler)
+        else:
+            self._server = ThreadingHTTPServer((self.host, self.port), _StateRequestHandler)
+            self.port = self._server.server_address[1]  # port 0 = porta livre
+        self._server.state_index = self.index
+        self._server.logger = self.logger
+        self._thread = threading.Thread(target=self._server.serve_forever, name='state-api', daemon=True)
+        self._thread.start()
+        self.logger.info(f"API de estado em {self.address}")
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            if self.unix_socket and os.path.exists(self.unix_socket):
+                os.unlink(self.unix_socket)
+
+
+def start_state_api(port_offset: int = 0):
+    """Inicia a API se state_api.enabled; port_offset separa os workers em modo process"""
+    if not STATE_API_ENABLED:
+        return None
+    unix_socket = STATE_API_UNIX_SOCKET
+    if unix_socket and port_offset:
+        unix_socket = f"{unix_socket}.{port_offset}"
+    server = StateApiServer(port=STATE_API_PORT + port_offset, unix_socket=unix_socket)
+    try:
+        server.start()
+    except OSError as e:
+        server.logger.error(f"Erro ao iniciar a API de estado em {server.address}: {e}")
+        return None
+    return server
@@ -1,9 +1,12 @@
 import paho.mqtt.client as mqtt
 import yaml
+import socket
+import uuid
 from logger_config import setup_logger
 import threading
 from queue import Queue
-from datetime import datetime
+from time import monotonic_ns
+from ingest_queue import IngestRecord, shard_for_payload
 
 # Load constants from config file
 with open('config.yaml', 'r') as file:
@@ -15,16 +18,40 @@ BROKER_HOST = config['broker']['host']
 BROKER_PORT = config['broker']['port']
 TOPICS = config['topics']
 
+# Modo cluster (várias instâncias consumindo os mesmos tópicos)
+#   shared       assinatura compartilhada MQTT v5 ($share/<grupo>/...): o broker distribui as
+#                mensagens entre as instâncias (no mosquitto, uma a uma, não por gateway)
+#   partitioned  cada instância assina tudo e processa só os beacons da sua partição
+#                (crc32 do beacon_serial), mantendo o estado por beacon em uma única instância
+cluster_config = config.get('cluster') or {}
+CLUSTER_MODE = cluster_config.get('mode') or None
+CLUSTER_GROUP = cluster_config.get('group', 'ln2-ingest')
+CLUSTER_INSTANCE_ID = cluster_config.get('instance_id') or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+PARTITION_COUNT = int(cluster_config.get('partitions', 1)) if CLUSTER_MODE == 'partitioned' else 0
+PARTITION_INDEX = int(cluster_config.get('partition_index', 0))
+
 class MessageSubscriber:
     def __init__(self, message_queue: Queue) -> None:            
+        if CLUSTER_MODE not in (None, 'shared', 'partitioned'):
+            raise ValueError(f"cluster.mode inválido: {CLUSTER_MODE} (use shared ou partitioned)")
+        if PARTITION_COUNT and not 0 <= PARTITION_INDEX < PARTITION_COUNT:
+            raise ValueError(f"cluster.partition_index deve estar entre 0 e {PARTITION_COUNT - 1}")
+        self.client_id = f"{CLIENT_ID}-{CLUSTER_INSTANCE_ID}" if CLUSTER_MODE else CLIENT_ID
         self.client = self.create_client()
         self.logger = setup_logger(__name__)
         self.connect_thread = threading.Thread(target=self.connect_client)
         self.message_queue = message_queue
+        if CLUSTER_MODE:
+            partition = f", partição {PARTITION_INDEX}/{PARTITION_COUNT}" if PARTITION_COUNT else ""
+            self.logger.info(f"Modo cluster {CLUSTER_MODE} (client_id {self.client_id}{partition})")
 
 
     def create_client(self) -> mqtt.Client:
-        client = mqtt.Client(client_id=CLIENT_ID)
+        if CLUSTER_MODE == 'shared':
+            # Assinaturas compartilhadas fazem parte do MQTT v5
+            client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv5)
+        else:
+            client = mqtt.Client(client_id=self.client_id)
         client.username_pw_set(CLIENT_USERNAME, CLIENT_PASSWORD)
         client.on_connect = self.on_connect
         client.on_message = self.on_message
@@ -42,11 +69,13 @@ class MessageSubscriber:
 
     def subscribe_to_topics(self):
         for topic in TOPICS:
+            if CLUSTER_MODE == 'shared':
+                topic = f"$share/{CLUSTER_GROUP}/{topic}"
             self.client.subscribe(topic, qos=1)
             self.logger.info("Subscribed to topic: %s", topic)
 
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
             self.logger.info("Connected to broker with result code: %s", rc)
             self.subscribe_to_topics()  # Subscribe to topics upon successful connection
@@ -55,14 +84,12 @@ class MessageSubscriber:
 
 
     def on_message(self, client:mqtt.Client, userdata, message:mqtt.MQTTMessage):
-        message_timestamp = datetime.now()
-
-        self.logger.debug("Received message from topic: %s, payload: %s", message.topic, message.payload)
-
-        message_tuple = (message_timestamp, message)
-
+        # Roda na thread de rede do paho: só captura o instante, o tópico e o payload (sem cópia).
+        # Horário de parede, decodificação e logs ficam no consumidor
+        if PARTITION_COUNT and shard_for_payload(message.payload, PARTITION_COUNT) != PARTITION_INDEX:
+            return  # Beacon de outra instância do cluster
         try:
-            self.message_queue.put(message_tuple)
+            self.message_queue.put(IngestRecord(monotonic_ns(), message.topic, message.payload))
         except Exception as e:
             self.logger.error("Failed to put message on queue: %s", e)
 
@@ -0,0 +1,126 @@
+"""
+Processamento em paralelo com N MessageProcessors particionados por beacon.
+
+Cada pacote é encaminhado para um worker pelo hash dos bytes do beacon_serial,
+então todos os pacotes de um beacon caem sempre no mesmo worker: a ordem por
+beacon, `last_beacon_data`, `duplicates_dict` e o estado de notificações
+continuam consistentes. Cada worker abre as próprias conexões com os sinks.
+
+Modos:
+    thread   N threads no mesmo processo (sinks sobrepõem I/O; decode ainda divide o GIL)
+    process  N processos (spawn), cada um com seu próprio interpretador
+"""
+
+import os
+import threading
+from multiprocessing import get_context
+
+import yaml
+
+from ingest_queue import MAX_SIZE, OVERLOAD_POLICY, BoundedIngestQueue, shard_for_payload
+from logger_config import setup_logger
+from message_processor import MessageProcessor
+from sinks import state_path
+from spool import SPOOL_DIR
+from state_api import start_state_api
+from subscriber import PARTITION_COUNT
+
+# Load constants from config file
+with open('config.yaml', 'r') as file:
+    config = yaml.safe_load(file).get('processing') or {}
+WORKERS = int(config.get('workers', 1))
+WORKER_MODE = config.get('worker_mode', 'thread')
+
+
+class ShardedQueue:
+    """
+    Fila de entrada com a mesma interface de `put` da Queue usada pelo MessageSubscriber,
+    que distribui cada IngestRecord para a fila do worker do beacon.
+    """
+
+    def __init__(self, queues: list, stride: int = 1) -> None:
+        self.queues = queues
+        self.stride = stride  # Número de partições do cluster, para não correlacionar com elas
+
+    def put(self, record, block=True, timeout=None):
+        self.queues[shard_for_payload(record.payload, len(self.queues), self.stride)].put(record, block, timeout)
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+
+def _worker_spool_dir(index: int) -> str:
+    # Cada worker tem o próprio spool (o diretório é travado por um único MessageProcessor)
+    return os.path.join(state_path(SPOOL_DIR), f"worker-{index}")
+
+
+def _process_worker_main(message_queue, index: int) -> None:
+    """Ponto de entrada de um worker em modo process"""
+    processor = MessageProcessor(message_queue, spool_dir=_worker_spool_dir(index))
+    processor.logger.info(f"Worker {index} iniciado")
+    # O estado fica na memória de cada processo: o worker i serve em state_api.port + 1 + i
+    state_api = start_state_api(port_offset=index + 1)
+    try:
+        processor.run()
+    finally:
+        if state_api:
+            state_api.stop()
+        processor.cleanup()
+
+
+class ShardedProcessorPool:
+    """Conjunto de N MessageProcessors alimentados por um ShardedQueue"""
+
+    def __init__(self, workers: int = WORKERS, mode: str = WORKER_MODE) -> None:
+        if mode not in ('thread', 'process'):
+            raise ValueError(f"worker_mode inválido: {mode} (use 'thread' ou 'process')")
+        self.workers = workers
+        self.mode = mode
+        self.logger = setup_logger(__name__)
+        # O limite da fila de ingestão é dividido entre os workers
+        shard_size = max(1, MAX_SIZE // workers) if MAX_SIZE > 0 else 0
+        if mode == 'process':
+            # multiprocessing.Queue só bloqueia; as políticas de descarte valem no modo thread
+            if OVERLOAD_POLICY != 'block':
+                self.logger.warning(f"overload_policy '{OVERLOAD_POLICY}' não suportada em modo process, usando block")
+            self._context = get_context('spawn')
+            self.queues = [self._context.Queue(shard_size) for _ in range(workers)]
+        else:
+            self._context = None
+            self.queues = [BoundedIngestQueue(shard_size) for _ in range(workers)]
+        self.router = ShardedQueue(self.queues, stride=PARTITION_COUNT or 1)
+        self.processors = []
+        self._runners = []
+
+    def start(self) -> None:
+        if self.mode == 'thread':
+            self.processors = [MessageProcessor(q, spool_dir=_worker_spool_dir(i)) for i, q in enumerate(self.queues)]
+            # O cache MAC é só um cache; compartilhar evita que um worker sobrescreva o arquivo do outro
+            for processor in self.processors[1:]:
+                processor.mac_cache = self.processors[0].mac_cache
+                # Um único MacCacheSync (o do worker 0) atualiza o cache compartilhado
+                if processor.mac_sync:
+                    processor.mac_sync.stop()
+                processor.mac_sync = self.processors[0].mac_sync
+            self._runners = [threading.Thread(target=p.run, name=f"processor-{i}", daemon=True)
+                             for i, p in enumerate(self.processors)]
+        else:
+            self._runners = [self._context.Process(target=_process_worker_main, args=(q, i),
+                                                   name=f"processor-{i}", daemon=True)
+                             for i, q in enumerate(self.queues)]
+        for runner in self._runners:
+            runner.start()
+        self.logger.info(f"{self.workers} workers iniciados em modo {self.mode}")
+
+    def stats(self) -> list:
+        """Métricas das filas de cada worker (só no modo thread)"""
+        return [q.stats() for q in self.queues if isinstance(q, BoundedIngestQueue)]
+
+    def stop(self, timeout: float = 10) -> None:
+        for q in self.queues:
+            q.put(None)  # Sentinela de parada do MessageProcessor.run
+        for runner in self._runners:
+            runner.join(timeout)
+        for processor in self.processors:
+            processor.cleanup()
+        self.logger.info("Workers finalizados")